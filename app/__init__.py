@@ -7,25 +7,36 @@ Attributes:
     app (Flask): The Flask web application instance.
 """
 from flask import Flask
-import logging, json
+import logging, json, multiprocessing
 from config import *
 from app.api import api
 from cryptography.fernet import Fernet
 from app.database import create_blank_db
+from app.metrics import instrument_app
+from app.jobs import recover_jobs
+from app.statistics import get_statistics
 
 app = Flask(__name__)
 
+# Processes started through multiprocessing, like the thumbnail pool of
+# app/media.py, import this package again; they leave the data files, the
+# log file and the background jobs to the process that started them
+IS_MAIN_PROCESS = multiprocessing.current_process().name == 'MainProcess'
+
 # Configure logging
 logging.basicConfig(
-    level=logging.INFO,  # Set the logging level to INFO (you can adjust this)
+    level=logging.INFO if IS_MAIN_PROCESS else logging.WARNING,  # Set the logging level to INFO (you can adjust this)
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='app.log',  # Specify the log file name
+    filename=LOG_FILE if IS_MAIN_PROCESS else None,  # Other processes only report problems, to stderr
     filemode='a'  # Append mode, so log entries are added to the existing log file
 )
 
 app.config['SECRET_KEY'] = FLASK_SECRET_KEY
 
-if not FERNET_FILE.exists():
+# Time every request and template rendering (see app/metrics.py)
+instrument_app(app)
+
+if IS_MAIN_PROCESS and not FERNET_FILE.exists():
     # Generate a new key and save it
     key = Fernet.generate_key()
 
@@ -33,15 +44,22 @@ if not FERNET_FILE.exists():
     with open(FERNET_FILE, 'wb') as key_file:
         key_file.write(key)
         
-if not JOURNAL_JSON_DB_PATH.exists():
+if IS_MAIN_PROCESS and STORAGE_BACKEND in ('blob', 'log') and not JOURNAL_JSON_DB_PATH.exists():
     create_blank_db(json_filepath=JOURNAL_JSON_DB_PATH)
 
-if not ADMIN_JSON_FILE.exists():
+if IS_MAIN_PROCESS and not ADMIN_JSON_FILE.exists():
         # Save the dictionary to a JSON file with indentation
         with open(ADMIN_JSON_FILE, 'w', encoding='utf-8') as json_file:
             json.dump(DEFAULT_ADMIN, json_file, indent=4)
 
 app.register_blueprint(api, url_prefix='/api')
 
+if IS_MAIN_PROCESS:
+    # Resume the background jobs interrupted by the last shutdown
+    recover_jobs()
+
+    # Count the writes of this process into the journal statistics
+    get_statistics()
+
 # Import routes after configuring logging to ensure proper logging in routes.py
-from app import routes
+from app import routes, commands
@@ -1,15 +1,35 @@
+from datetime import datetime
+from email.utils import formatdate
 import os
-import json
-from flask import Blueprint, jsonify, send_file, request, Response
-from app.database import load_database
-from config import JOURNAL_JSON_DB_PATH, BASE_DIR
-from app.authentication import verify_token, admin_login_required
-from flask import flash, redirect, url_for
+from flask import Blueprint, jsonify, request, Response, stream_with_context
+from app.database import get_storage
+from app.importer import import_upload
+from app.pagination import PageArgs
+from app.search import get_search_index
+from app.archive import get_date_index
+from app.statistics import get_statistics
+from app.batch import BatchError, IdempotencyKeyReused, apply_idempotent_batch
+from app.timeformat import display_timezone, get_timezone
+from app.export import EXPORT_FORMATS, gzip_stream, iter_export_file
+from app.jobs import get_job_queue, submit_job, JobQueueFull
+from app.authentication import verify_token, admin_login_required, request_authorized
+from app.media import MediaBlob, MediaTooLargeError, attach_media, detach_media, find_media_item
+from app.caching import database_validators, not_modified, set_validators
+from flask import flash, redirect, render_template, url_for
 
 api = Blueprint('api', __name__)
 
 @api.route('/export/json/', methods=['GET'])
 def export_data():
+    """
+    Streams every entry of the journal.
+
+    Query parameters:
+        token: The token of the admin (required).
+        download: Send the data as a file attachment.
+        format: 'json' (default) or 'ndjson'.
+        gzip: Gzip-compress the response.
+    """
 
     token = request.args.get('token')
 
@@ -19,34 +39,407 @@ def export_data():
     # Verify the token
     if not verify_token(token):
         return "Unauthorized access: Invalid token", 401
-    
-    data = load_database(JOURNAL_JSON_DB_PATH)
+
+    export_format = request.args.get('format', 'json')
+    if export_format not in EXPORT_FORMATS:
+        return f"Unknown export format: {export_format}", 400
+    generator, mimetype, extension = EXPORT_FORMATS[export_format]
+
+    # Nothing to send if the client already has this version of the export
+    etag, last_modified = database_validators()
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    # The entries are serialized one by one while the response is sent, so
+    # memory use doesn't depend on the size of the journal
+    chunks = generator(get_storage().iter_entries())
+    headers = {}
+
+    # Check if the request wants a compressed response
+    if request.args.get('gzip', False):
+        chunks = gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
 
     # Check if the request wants to download the data
-    download = request.args.get('download', False)
-
-    if download:
-        # Save the data as a JSON file temporarily
-        temp_json_filename = BASE_DIR / 'exported_data.json'
-        with open(temp_json_filename, 'w') as json_file:
-            json.dump(data, json_file, indent=4)
-
-        # Send the file for download
-        response = send_file(
-            temp_json_filename,
-            as_attachment=True,
-            download_name='mindcanvas_data.json',
-            mimetype='application/json'
-        )
-
-        # Remove the temporary JSON file after sending
-        os.remove(temp_json_filename)
+    if request.args.get('download', False):
+        download_name = f'mindcanvas_data.{extension}'
+        if 'Content-Encoding' in headers:
+            # Download the compressed file as it is
+            download_name += '.gz'
+            mimetype = 'application/gzip'
+            del headers['Content-Encoding']
+        headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+
+    response = Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+    return set_validators(response, etag, last_modified)
+
+
+@api.route('/entries/', methods=['GET'])
+def list_entries():
+    """
+    Returns a page of entry summaries, newest first.
+
+    Query parameters: token, page, per_page, before and before_id (see
+    PageArgs).
+    """
+    token = request.args.get('token')
+
+    if token is None or not verify_token(token):
+        return "Unauthorized access: Invalid token", 401
+
+    etag, last_modified = database_validators()
+    response = not_modified(etag, last_modified)
+    if response is not None:
         return response
-    
+
+    storage = get_storage()
+    page_args = PageArgs.from_request_args(request.args)
+    summaries = storage.list_summaries(
+        offset=page_args.offset,
+        limit=page_args.per_page,
+        before=page_args.before,
+        before_id=page_args.before_id
+    )
+
+    return set_validators(jsonify({
+        "entries": summaries,
+        "page": page_args.page,
+        "per_page": page_args.per_page,
+        "total": storage.count(),
+        # Pass both as ?before=&before_id= to get the next page
+        "next_cursor": summaries[-1]['datetime_utc'] if len(summaries) == page_args.per_page else None,
+        "next_cursor_id": summaries[-1]['id'] if len(summaries) == page_args.per_page else None
+    }), etag, last_modified)
+
+
+@api.route('/entries/batch/', methods=['POST'])
+def batch_entries():
+    """
+    Creates, updates and deletes entries in one write (see app/batch.py).
+    Either every operation is applied or none; the response has the result
+    of each one, with status 200 if the batch was applied and 409 otherwise.
+
+    Query parameters: token.
+    Headers: Idempotency-Key (optional), so that a retried batch is answered
+        without being applied twice.
+    Body: {"operations": [{"op": "create" | "update" | "delete", ...}, ...]}
+    """
+    token = request.args.get('token')
+
+    if token is None:
+        return "Unauthorized access: You need a token", 401
+
+    # Verify the token
+    if not verify_token(token):
+        return "Unauthorized access: Invalid token", 401
+
+    payload = request.get_json(silent=True)
+    try:
+        response, replayed = apply_idempotent_batch(payload, request.headers.get('Idempotency-Key'))
+    except BatchError as e:
+        return str(e), 400
+    except IdempotencyKeyReused as e:
+        return str(e), 422
+
+    headers = {'Idempotent-Replayed': 'true'} if replayed else {}
+    return jsonify(response), 200 if response['applied'] else 409, headers
+
+
+@api.route('/search/', methods=['GET'])
+def search_entries():
+    """
+    Returns a page of ranked search results with snippets.
+
+    Query parameters: token, q, page and per_page.
+    """
+    token = request.args.get('token')
+
+    if token is None or not verify_token(token):
+        return "Unauthorized access: Invalid token", 401
+
+    query = request.args.get('q', '')
+    page_args = PageArgs.from_request_args(request.args)
+    total, results = get_search_index().search(
+        query,
+        offset=(page_args.page - 1) * page_args.per_page,
+        limit=page_args.per_page
+    )
+
+    return jsonify({
+        "query": query,
+        "results": results,
+        "page": page_args.page,
+        "per_page": page_args.per_page,
+        "total": total
+    })
+
+
+@api.route('/calendar/', methods=['GET'])
+def calendar_heatmap():
+    """
+    Returns the number of entries of every day of a year, for a calendar
+    heatmap. Days are those of the display timezone and days without entries
+    are left out. Answered from the date index, without reading any entry.
+
+    Query parameters: token and year (default: the current year).
+    """
+    token = request.args.get('token')
+
+    if token is None or not verify_token(token):
+        return "Unauthorized access: Invalid token", 401
+
+    etag, last_modified = database_validators()
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    timezone = display_timezone()
+    year = request.args.get('year', type=int) or datetime.now(get_timezone(timezone)).year
+    index = get_date_index()
+    days = index.days(year, timezone=timezone)
+
+    return set_validators(jsonify({
+        "year": year,
+        "timezone": timezone,
+        "total": sum(days.values()),
+        "max": max(days.values(), default=0),
+        "days": days,
+        "years": {str(y): count for y, count in index.years(timezone=timezone).items()}
+    }), etag, last_modified)
+
+
+@api.route('/statistics/', methods=['GET'])
+def journal_statistics():
+    """
+    Returns the statistics of the journal: total entries, words per entry,
+    entries per week, writing streaks and the longest entries. They are kept
+    up to date on every write, so the journal itself is not read.
+
+    Query parameters: token.
+    """
+    token = request.args.get('token')
+
+    if token is None or not verify_token(token):
+        return "Unauthorized access: Invalid token", 401
+
+    etag, last_modified = database_validators()
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    return set_validators(jsonify(get_statistics().summary()), etag, last_modified)
+
+
+@api.route('/jobs/', methods=['GET'])
+def list_jobs():
+    """
+    Returns the background jobs known to the app (queued, running and the
+    recently finished ones), newest first.
+
+    Query parameters: token.
+    """
+    token = request.args.get('token')
+
+    if token is None or not verify_token(token):
+        return "Unauthorized access: Invalid token", 401
+
+    return jsonify({"jobs": get_job_queue().list()[::-1]})
+
+
+@api.route('/jobs/<job_id>/', methods=['GET'])
+def job_status(job_id):
+    """
+    Returns the status of one background job.
+
+    Query parameters: token.
+    """
+    token = request.args.get('token')
+
+    if token is None or not verify_token(token):
+        return "Unauthorized access: Invalid token", 401
+
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return "Job not found", 404
+    return jsonify(job)
+
+
+@api.route('/jobs/export/', methods=['POST'])
+def start_export():
+    """
+    Starts exporting the journal in the background, for journals too large
+    to be streamed by /export/json/ in one request. Poll the returned job
+    and fetch the export from /jobs/<job_id>/download/ once it is done.
+
+    Query parameters: token, format ('json' or 'ndjson') and gzip.
+    """
+    token = request.args.get('token')
+
+    if token is None or not verify_token(token):
+        return "Unauthorized access: Invalid token", 401
+
+    export_format = request.args.get('format', 'json')
+    if export_format not in EXPORT_FORMATS:
+        return f"Unknown export format: {export_format}", 400
+
+    try:
+        job = submit_job('export', {"format": export_format, "gzip": bool(request.args.get('gzip', False))},
+                         run_if_full=False)
+    except JobQueueFull:
+        return "Too many background jobs, try again later", 503
+
+    response = jsonify(job)
+    response.status_code = 202
+    response.headers['Location'] = url_for('api.job_status', job_id=job['id'], token=token)
+    return response
+
+
+@api.route('/jobs/<job_id>/download/', methods=['GET'])
+def download_export(job_id):
+    """
+    Streams the result of a finished export job as a file attachment.
+
+    Query parameters: token.
+    """
+    token = request.args.get('token')
+
+    if token is None or not verify_token(token):
+        return "Unauthorized access: Invalid token", 401
+
+    job = get_job_queue().get(job_id)
+    if job is None or job['kind'] != 'export':
+        return "Export not found", 404
+    if job['status'] != 'done':
+        return f"The export is {job['status']}", 409
+
+    _, mimetype, extension = EXPORT_FORMATS[job['args']['format']]
+    download_name = f'mindcanvas_data.{extension}'
+    if job['args']['gzip']:
+        download_name += '.gz'
+        mimetype = 'application/gzip'
+
+    try:
+        chunks = iter_export_file(job['result']['file'])
+        first = next(chunks, b'')
+    except FileNotFoundError:
+        return "The export has expired", 410
+
+    def stream():
+        yield first
+        yield from chunks
+
+    return Response(stream(), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{download_name}"',
+        'Content-Length': str(job['result']['bytes'])
+    })
+
+
+@api.route('/entries/<uuid:entry_id>/media/', methods=['POST'])
+def upload_media(entry_id):
+    """
+    Attaches the request body, streamed to the encrypted media store, to the
+    entry. Open to a logged in admin or with the admin token.
+
+    Query parameters: token and filename. The Content-Type header of the
+    request is recorded as the media type.
+    """
+    if not request_authorized():
+        return "Unauthorized access: Invalid token", 401
+
+    filename = request.args.get('filename', 'upload')
+    content_type = request.mimetype if request.mimetype not in ('', 'application/octet-stream') else None
+
+    try:
+        item = attach_media(str(entry_id), request.stream, filename, content_type)
+    except MediaTooLargeError as e:
+        return str(e), 413
+
+    if item is None:
+        return "Entry not found", 404
+    return jsonify(item), 201
+
+
+@api.route('/entries/<uuid:entry_id>/media/<digest>/', methods=['GET'])
+def get_media(entry_id, digest):
+    """
+    Streams a media of the entry, honouring single byte ranges (for video
+    seeking). Open to a logged in admin or with the admin token.
+
+    Query parameters: token, thumbnail (serve the thumbnail of an image)
+    and download (send as a file attachment).
+    """
+    if not request_authorized():
+        return "Unauthorized access: Invalid token", 401
+
+    entry = get_storage().get_entry(str(entry_id))
+    item = None if entry is None else find_media_item(entry, digest)
+    if item is None:
+        return "Media not found", 404
+
+    mimetype = item['content_type']
+    if request.args.get('thumbnail', False):
+        if not item.get('thumbnail'):
+            return "No thumbnail", 404
+        digest, mimetype = item['thumbnail'], 'image/jpeg'
+
+    try:
+        blob = MediaBlob(digest)
+    except FileNotFoundError:
+        return "Media not found", 404
+
+    # A blob never changes, so its hash is a strong validator, and so is the
+    # time it was stored
+    last_modified = int(os.path.getmtime(blob.path))
+    headers = {
+        'ETag': f'"{digest}"',
+        'Last-Modified': formatdate(last_modified, usegmt=True),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'X-Content-Type-Options': 'nosniff'
+    }
+    if request.args.get('download', False):
+        filename = item['filename'].replace('"', '')
+        headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+
+    if request.if_none_match.contains(digest):
+        return Response(status=304, headers=headers)
+
+    # With If-Range, the range only applies to the copy the client has, else
+    # the whole blob is sent
+    if_range = request.if_range
+    if if_range.etag is not None:
+        range_applies = if_range.etag == digest
+    elif if_range.date is not None:
+        range_applies = int(if_range.date.timestamp()) == last_modified
     else:
-        # If not downloading, return the data as JSON for viewing in the browser
-        return jsonify(data)
-    
+        range_applies = True
+
+    status, start, end = 200, 0, blob.size - 1
+    byte_range = request.range
+    if byte_range is not None and len(byte_range.ranges) == 1 and range_applies:
+        bounds = byte_range.range_for_length(blob.size)
+        if bounds is None:
+            return Response(status=416, headers=dict(headers, **{'Content-Range': f'bytes */{blob.size}'}))
+        status, (start, end) = 206, (bounds[0], bounds[1] - 1)
+        headers['Content-Range'] = f'bytes {start}-{end}/{blob.size}'
+
+    headers['Content-Length'] = str(end - start + 1)
+    return Response(blob.iter_range(start, end), status=status, mimetype=mimetype,
+                    headers=headers, direct_passthrough=True)
+
+
+@api.route('/entries/<uuid:entry_id>/media/<digest>/', methods=['DELETE'])
+def delete_media(entry_id, digest):
+    """Detaches a media from the entry. Open to a logged in admin or with the admin token."""
+    if not request_authorized():
+        return "Unauthorized access: Invalid token", 401
+
+    if not detach_media(str(entry_id), digest):
+        return "Media not found", 404
+    return "", 204
+
 
 @api.route('/upload/json/', methods=['POST'])
 @admin_login_required  # Ensure only admins can access this route
@@ -59,12 +452,21 @@ def upload_json_file():
     json_file = request.files['json_file']
 
     # Check if the file has a valid JSON extension
-    if not json_file.filename.endswith('.json'):
+    if not json_file.filename.endswith(('.json', '.ndjson')):
         flash('Invalid file format. Please upload a JSON file.', 'error')
         return redirect(url_for('upload_database'))  # Redirect to an admin page
 
-    # Save the uploaded file to the JOURNAL_JSON_DB_PATH location, replacing the existing file
-    json_file.save(JOURNAL_JSON_DB_PATH)
+    # Either replace the whole journal or merge the uploaded entries by id
+    mode = request.form.get('mode', 'replace')
+    # Replacing the journal with an upload without entries has to be asked for
+    allow_empty = request.form.get('allow_empty') == 'on'
+
+    # Parse, validate and write the upload incrementally
+    try:
+        report = import_upload(json_file.stream, mode=mode, allow_empty=allow_empty)
+    except ValueError as e:
+        flash(f'Upload rejected: {e}', 'error')
+        return render_template('upload_database.html'), 400
 
-    flash('JSON file uploaded and database replaced successfully.', 'success')
-    return redirect(url_for('view_entries'))  # Redirect to an admin page
\ No newline at end of file
+    flash(f'JSON file uploaded successfully. {report}.', 'success')
+    return redirect(url_for('view_entries'))  # Redirect to an admin page
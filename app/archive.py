@@ -0,0 +1,214 @@
+# app/archive.py
+#
+# Calendar archive of the journal entries.
+#
+# The date index holds the (datetime, id) of every entry in a sorted list,
+# the order of the storage listings, and the number of entries of every
+# year, month and day. It is built from the entry summaries on the first
+# query, so no entry text is read, and afterwards kept up to date
+# incrementally through JournalStorage.subscribe(): a write moves one key
+# and one day counter. The entries of a month or a day are found by
+# bisecting the sorted keys. If the data is changed behind our back the
+# storage signature no longer matches and the next query moves the keys of
+# the entries written since, as found in the change log of the storage
+# (JournalStorage.changes_since()), as done by the search index; it is only
+# rebuilt when the log can't tell. A write of this process is only applied
+# to an index that was current right before it.
+#
+# Years, months and days are those of the display timezone. The counters are
+# kept for one timezone at a time and recounted from the keys, without
+# reading the storage, when the display timezone changes.
+
+from bisect import bisect_left, insort
+from calendar import monthrange
+from datetime import datetime, timedelta
+from app.database import get_storage
+from app.journal import parse_datetime
+from app.timeformat import display_timezone, get_timezone
+import pytz, threading
+
+
+def _utc(value:str):
+    """The datetime_utc `value` as an aware UTC datetime"""
+    value = parse_datetime(value)
+    # Naive datetimes are in UTC by definition of the datetime_utc field
+    return value.astimezone(pytz.utc) if value.tzinfo is not None else value.replace(tzinfo=pytz.utc)
+
+
+def local_range(year:int, month:int=None, day:int=None, timezone:str=None):
+    """
+    The UTC bounds [start, end) of a year, month or day of `timezone`
+    (default: the display timezone).
+
+    Raises:
+        ValueError: If the date doesn't exist.
+    """
+    tz = get_timezone(timezone or display_timezone())
+    start = datetime(year, month or 1, day or 1)
+    if day is not None:
+        end = start + timedelta(days=1)
+    elif month is not None:
+        end = start + timedelta(days=monthrange(year, month)[1])
+    else:
+        end = start.replace(year=year + 1)
+    return tz.localize(start).astimezone(pytz.utc), tz.localize(end).astimezone(pytz.utc)
+
+
+class DateIndex:
+    """The entries of a storage ordered by datetime, with their counts per day."""
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._lock = threading.RLock()
+        self._keys = []         # sorted (UTC datetime, entry_id)
+        self._datetimes = {}    # entry_id -> UTC datetime
+        self._timezone = None   # the timezone of _days; None if not counted
+        self._days = {}         # year -> month -> day -> number of entries
+        self._signature = None  # the storage signature the index reflects; None if not built
+        self._version = None    # the database version the index reflects
+        storage.subscribe(self._entries_changed)
+
+    def _entries_changed(self, storage, changes:list, old_signature):
+        with self._lock:
+            if self._signature is None:
+                # Not built yet; it will be built from scratch when needed
+                return
+            if self._signature != old_signature:
+                # The index missed writes of another process before this one;
+                # caught up with them, and this one, on the next query
+                return
+            for op, entry_id, entry in changes:
+                if op == 'reset':
+                    # Rebuilt on the next query; it only takes the datetimes
+                    self._signature = None
+                    return
+                self._remove(entry_id)
+                if entry is not None:
+                    self._add(entry_id, entry['datetime_utc'])
+            self._signature, self._version = storage.signature(), storage.version()
+
+    def _ensure_current(self, timezone:str):
+        signature = self._storage.signature()
+        if self._signature is not None and self._signature != signature:
+            self._catch_up(signature)
+        if self._signature is None or self._signature != signature:
+            # Read first: a write landing meanwhile is applied again by the
+            # next catch-up, which is harmless
+            version = self._storage.version()
+            self._keys = sorted((_utc(datetime_utc), entry_id) for entry_id, datetime_utc in self._storage.list_datetimes())
+            self._datetimes = {entry_id: value for value, entry_id in self._keys}
+            self._timezone = None
+            self._signature, self._version = signature, version
+
+        if self._timezone != timezone:
+            self._timezone, self._days = timezone, {}
+            for value, _ in self._keys:
+                self._count(value, 1)
+
+    def _catch_up(self, signature):
+        """Moves the keys of the entries written by other processes; unbuilds the index if the change log can't tell"""
+        changed = self._storage.changes_since(self._version)
+        if changed is None:
+            self._signature = None
+            return
+        version, entry_ids = changed
+        datetimes = {summary['id']: summary['datetime_utc'] for summary in self._storage.get_summaries(list(entry_ids))}
+        for entry_id in entry_ids:
+            self._remove(entry_id)
+            if entry_id in datetimes:
+                self._add(entry_id, datetimes[entry_id])
+        self._signature, self._version = signature, version
+
+    def _count(self, value:datetime, delta:int):
+        local = value.astimezone(get_timezone(self._timezone))
+        months = self._days.setdefault(local.year, {})
+        days = months.setdefault(local.month, {})
+        days[local.day] = days.get(local.day, 0) + delta
+        if days[local.day] == 0:
+            del days[local.day]
+            if not days:
+                del months[local.month]
+                if not months:
+                    del self._days[local.year]
+
+    def _add(self, entry_id:str, datetime_utc:str):
+        value = _utc(datetime_utc)
+        insort(self._keys, (value, entry_id))
+        self._datetimes[entry_id] = value
+        if self._timezone is not None:
+            self._count(value, 1)
+
+    def _remove(self, entry_id:str):
+        value = self._datetimes.pop(entry_id, None)
+        if value is None:
+            return
+        del self._keys[bisect_left(self._keys, (value, entry_id))]
+        if self._timezone is not None:
+            self._count(value, -1)
+
+    def years(self, timezone:str=None):
+        """Returns {year: number of entries}, newest year first"""
+        with self._lock:
+            self._ensure_current(timezone or display_timezone())
+            return {
+                year: sum(sum(days.values()) for days in months.values())
+                for year, months in sorted(self._days.items(), reverse=True)
+            }
+
+    def months(self, year:int, timezone:str=None):
+        """Returns {month: number of entries} of the months of `year` having entries"""
+        with self._lock:
+            self._ensure_current(timezone or display_timezone())
+            return {
+                month: sum(days.values())
+                for month, days in sorted(self._days.get(year, {}).items())
+            }
+
+    def days(self, year:int, month:int=None, timezone:str=None):
+        """
+        Returns the number of entries of the days of `year` (or of one of its
+        months) having entries, as {'YYYY-MM-DD': count} in date order.
+        """
+        with self._lock:
+            self._ensure_current(timezone or display_timezone())
+            months = self._days.get(year, {})
+            return {
+                f'{year:04d}-{m:02d}-{d:02d}': count
+                for m in sorted(months) if month is None or m == month
+                for d, count in sorted(months[m].items())
+            }
+
+    def count(self, year:int, month:int=None, day:int=None, timezone:str=None):
+        """Returns the number of entries of a year, month or day"""
+        with self._lock:
+            self._ensure_current(timezone or display_timezone())
+            months = self._days.get(year, {})
+            if month is None:
+                return sum(sum(days.values()) for days in months.values())
+            days = months.get(month, {})
+            return sum(days.values()) if day is None else days.get(day, 0)
+
+    def between(self, start:datetime=None, end:datetime=None):
+        """
+        Returns the ids of the entries with start <= datetime < end, newest
+        first, i.e. in the order of the storage listings.
+        """
+        with self._lock:
+            self._ensure_current(self._timezone or display_timezone())
+            # A 1-tuple sorts before every key of the same datetime
+            low = 0 if start is None else bisect_left(self._keys, (start,))
+            high = len(self._keys) if end is None else bisect_left(self._keys, (end,))
+            return [entry_id for _, entry_id in reversed(self._keys[low:high])]
+
+
+_date_index = None
+_date_index_lock = threading.Lock()
+
+
+def get_date_index():
+    """Returns the date index of the configured storage"""
+    global _date_index
+    with _date_index_lock:
+        if _date_index is None:
+            _date_index = DateIndex(get_storage())
+        return _date_index
@@ -5,7 +5,7 @@
 from config import *
 import json, hashlib, secrets
 from itsdangerous import URLSafeSerializer, BadSignature
-from flask import session, redirect, url_for
+from flask import session, redirect, url_for, request
 from functools import wraps
 
 # Initialize the serializer
@@ -23,6 +23,20 @@ def verify_token(token):
     except BadSignature:
         return False  # Token is invalid
 
+def request_authorized():
+    """
+    Returns True if the request comes from a logged in admin or carries a
+    valid admin token, as ?token= or as a bearer token.
+    """
+    if session.get('admin_logged_in'):
+        return True
+
+    token = request.args.get('token')
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    return token is not None and verify_token(token)
+
 def sha256_hash(raw_text):
     """Return the hex hash value"""
     hashed = hashlib.sha256(raw_text.encode()).hexdigest()
@@ -100,4 +114,23 @@ def save_new_admin_credentials(new_username=None, new_password=None):
 
     # Save the updated admin data to the JSON file
     with open(ADMIN_JSON_FILE, 'w') as json_file:
-        json.dump(old_admin_data, json_file, indent=4)
\ No newline at end of file
+        json.dump(old_admin_data, json_file, indent=4)
+
+
+def save_admin_preferences(timezone=None):
+    """
+    Saves the display preferences of the admin into ADMIN_JSON_FILE.
+
+    :param timezone: The timezone to display dates in, e.g. 'Europe/Paris' (optional)
+    """
+    try:
+        with open(ADMIN_JSON_FILE, 'r') as json_file:
+            admin_data = json.load(json_file)
+    except FileNotFoundError:
+        admin_data = dict(DEFAULT_ADMIN)
+
+    if timezone is not None:
+        admin_data['timezone'] = timezone
+
+    with open(ADMIN_JSON_FILE, 'w') as json_file:
+        json.dump(admin_data, json_file, indent=4)
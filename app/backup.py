@@ -0,0 +1,386 @@
+# app/backup.py
+#
+# Incremental, deduplicated and encrypted backups of the journal database.
+#
+# Layout of BACKUP_DIR:
+#
+#     objects/<sha256>          one encrypted journal entry, addressed by the
+#                               hash of its JournalEntry.to_dict() payload
+#     snapshots/backup_<ts>     encrypted manifest listing the hashes of the
+#                               entries present at that point in time
+#     catalog                   encrypted index of every backup, newest first:
+#                               {"version": 1, "backups": [{"file", "timestamp",
+#                                "size", "entries", "checksum", "legacy"}, ...]}
+#
+# An unchanged entry is stored only once no matter how many snapshots refer
+# to it, so a backup costs one small manifest plus the entries that changed
+# since the previous one.
+#
+# Listing the backups only reads the catalog. It is kept up to date by every
+# change below and rebuilt by scanning BACKUP_DIR if it is missing. After each
+# backup the retention rules (BACKUP_KEEP_LAST, BACKUP_KEEP_DAILY and
+# BACKUP_KEEP_WEEKLY) prune the snapshots they don't keep. The objects only
+# they referred to are collected by a 'collect_backup_garbage' job, at most
+# once per BACKUP_GC_INTERVAL, since finding them reads every manifest; the
+# time of the last collection is that of the `gc` file.
+#
+# Older versions of MindCanvas wrote a full plaintext copy per save as
+# `BACKUP_DIR/backup_<ts>.json`; those files are still listed so that they
+# can be pruned with delete_backups_before() and by the retention rules.
+
+from config import *
+from cryptography.fernet import MultiFernet
+from app.database import durable_replace, write_lock
+from app.jobs import submit_job
+from app.keys import get_cipher
+from datetime import datetime
+import hashlib, json, os, time
+
+OBJECTS_DIR = BACKUP_DIR / 'objects'
+SNAPSHOTS_DIR = BACKUP_DIR / 'snapshots'
+CATALOG_PATH = BACKUP_DIR / 'catalog'
+GC_MARKER_PATH = BACKUP_DIR / 'gc'
+
+SNAPSHOT_PREFIX = 'backup_'
+SNAPSHOT_TIME_FORMAT = '%Y-%m-%d_%H-%M-%S-%f'
+LEGACY_TIME_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+
+def entry_hash(entry:dict):
+    """Returns the content address of a journal entry dict"""
+    payload = json.dumps(entry, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest(), payload
+
+
+def create_backup(data:dict):
+    """
+    Stores a point-in-time snapshot of the database dict `data`, then prunes
+    the backups the retention rules don't keep and queues the collection of
+    the objects they leave behind.
+
+    Only entries not already present in the object store are written, and
+    no snapshot is written if the content is the same as in the latest one.
+
+    Returns:
+        str: The id of the new (or latest) snapshot.
+    """
+    OBJECTS_DIR.mkdir(parents=True, exist_ok=True)
+    SNAPSHOTS_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Under the catalog lock, so that no garbage collection of another
+    # process removes the objects before the manifest refers to them, and
+    # that a key rotation re-encrypts them only once they are written
+    with write_lock(CATALOG_PATH):
+        fer = get_cipher()
+        hashes, size = [], 0
+        for entry in data.get('entries', []):
+            digest, payload = entry_hash(entry)
+            hashes.append(digest)
+
+            object_path = OBJECTS_DIR / digest
+            if not object_path.exists():
+                _write_encrypted(object_path, fer.encrypt(payload.encode()))
+            size += os.path.getsize(object_path)
+
+        checksum = manifest_checksum(hashes)
+
+        def add(backups):
+            latest = next((backup for backup in backups if not backup['legacy']), None)
+            if latest is not None and latest['checksum'] == checksum:
+                # Nothing changed since the latest snapshot
+                return latest['file'], []
+
+            now = datetime.now()
+            snapshot_id = SNAPSHOT_PREFIX + now.strftime(SNAPSHOT_TIME_FORMAT)
+            manifest = {
+                "id": snapshot_id,
+                "created": now.isoformat(),
+                "entries": hashes
+            }
+            _write_encrypted(SNAPSHOTS_DIR / snapshot_id, fer.encrypt(json.dumps(manifest).encode()))
+
+            backups.insert(0, {
+                "file": snapshot_id,
+                "timestamp": now.timestamp(),
+                "size": size,
+                "entries": len(hashes),
+                "checksum": checksum,
+                "legacy": False
+            })
+            return snapshot_id, _apply_retention(backups)
+
+        snapshot_id, pruned = _modify_catalog(add)
+        if pruned:
+            _delete_files(pruned)
+
+    if pruned:
+        _queue_garbage_collection()
+    return snapshot_id
+
+
+def manifest_checksum(hashes:list):
+    """Checksum of the list of entry hashes of a snapshot"""
+    return hashlib.sha256(json.dumps(hashes).encode()).hexdigest()
+
+
+def is_snapshot_id(snapshot_id:str):
+    """Whether `snapshot_id` has the form of the ids given to the snapshots"""
+    return _parse_time(snapshot_id, SNAPSHOT_TIME_FORMAT) is not None
+
+
+def load_backup(snapshot_id:str):
+    """
+    Reconstructs the database dict as it was at the snapshot `snapshot_id`.
+
+    Raises:
+        ValueError: If `snapshot_id` isn't a snapshot id or the manifest
+            doesn't match the catalog.
+        FileNotFoundError: If there is no such snapshot.
+    """
+    fer = get_cipher()
+    manifest = _read_manifest(snapshot_id, fer)
+
+    backup = next((backup for backup in list_backups() if backup['file'] == snapshot_id), None)
+    if backup is not None and backup['checksum'] != manifest_checksum(manifest['entries']):
+        raise ValueError(f"The manifest of {snapshot_id} doesn't match its checksum")
+
+    entries = []
+    for digest in manifest['entries']:
+        with open(OBJECTS_DIR / digest, 'rb') as f:
+            entries.append(json.loads(fer.decrypt(f.read()).decode()))
+
+    return {"entries": entries}
+
+
+def list_backups():
+    """
+    Returns info about every backup, newest first, from the catalog:
+        [{'file': <snapshot id or file name>, 'timestamp': <unix time>,
+          'size': <bytes of its encrypted entries>, 'entries': <number of entries>,
+          'checksum': <manifest checksum>, 'legacy': bool}, ...]
+    """
+    backups = _read_catalog(get_cipher())
+    if backups is None:
+        backups = _modify_catalog(lambda backups: list(backups))
+    return backups
+
+
+def delete_backups_before(delete_date:datetime):
+    """
+    Deletes every snapshot (and legacy plaintext backup) older than
+    `delete_date`, then removes the entry objects no snapshot refers to.
+
+    Returns:
+        int: The number of backups deleted.
+    """
+    def remove(backups):
+        deleted = [backup for backup in backups if datetime.fromtimestamp(backup['timestamp']) < delete_date]
+        backups[:] = [backup for backup in backups if backup not in deleted]
+        return deleted
+
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    with write_lock(CATALOG_PATH):
+        deleted = _modify_catalog(remove)
+        if deleted:
+            _delete_files(deleted)
+            collect_garbage()
+
+    return len(deleted)
+
+
+def prune_backups():
+    """
+    Deletes the backups the retention rules don't keep.
+
+    Returns:
+        int: The number of backups deleted.
+    """
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    with write_lock(CATALOG_PATH):
+        pruned = _modify_catalog(_apply_retention)
+        if pruned:
+            _delete_files(pruned)
+            collect_garbage()
+    return len(pruned)
+
+
+def collect_garbage():
+    """Deletes the objects that are not referenced by any snapshot"""
+    if not OBJECTS_DIR.exists():
+        return
+
+    with write_lock(CATALOG_PATH):
+        fer = get_cipher()
+        referenced = set()
+        if SNAPSHOTS_DIR.exists():
+            for snapshot_id in os.listdir(SNAPSHOTS_DIR):
+                if not snapshot_id.endswith('.tmp'):
+                    referenced.update(_read_manifest(snapshot_id, fer)['entries'])
+
+        for digest in os.listdir(OBJECTS_DIR):
+            if digest not in referenced:
+                os.remove(OBJECTS_DIR / digest)
+        GC_MARKER_PATH.touch()
+
+
+def _queue_garbage_collection():
+    """Queues collect_garbage() unless it ran less than BACKUP_GC_INTERVAL seconds ago"""
+    try:
+        last_run = os.path.getmtime(GC_MARKER_PATH)
+    except FileNotFoundError:
+        last_run = 0
+    if time.time() - last_run >= BACKUP_GC_INTERVAL:
+        submit_job('collect_backup_garbage', key='collect_backup_garbage')
+
+
+######################################################################
+#                       Catalog and retention
+######################################################################
+
+def select_retained(backups:list, keep_last:int=BACKUP_KEEP_LAST, keep_daily:int=BACKUP_KEEP_DAILY,
+                    keep_weekly:int=BACKUP_KEEP_WEEKLY):
+    """
+    Returns the names of the backups (newest first) to keep: the `keep_last`
+    newest ones, plus the newest one of each of the last `keep_daily` days
+    and `keep_weekly` ISO weeks that have backups. None counts as 0.
+    """
+    retained = {backup['file'] for backup in backups[:keep_last or 0]}
+    for count, period_format in ((keep_daily, '%Y-%m-%d'), (keep_weekly, '%G-W%V')):
+        periods = set()
+        for backup in backups:
+            if len(periods) >= (count or 0):
+                break
+            period = datetime.fromtimestamp(backup['timestamp']).strftime(period_format)
+            if period not in periods:
+                periods.add(period)
+                retained.add(backup['file'])
+    return retained
+
+
+def _apply_retention(backups:list):
+    """Removes the backups not retained from the catalog list; returns them"""
+    if BACKUP_KEEP_LAST is None and BACKUP_KEEP_DAILY is None and BACKUP_KEEP_WEEKLY is None:
+        # Retention is disabled
+        return []
+    retained = select_retained(backups, BACKUP_KEEP_LAST, BACKUP_KEEP_DAILY, BACKUP_KEEP_WEEKLY)
+    pruned = [backup for backup in backups if backup['file'] not in retained]
+    backups[:] = [backup for backup in backups if backup['file'] in retained]
+    return pruned
+
+
+def _read_catalog(fer:MultiFernet):
+    """The catalog list, newest first, or None if there is no catalog yet"""
+    try:
+        with open(CATALOG_PATH, 'rb') as f:
+            return json.loads(fer.decrypt(f.read()).decode())['backups']
+    except FileNotFoundError:
+        return None
+
+
+def _modify_catalog(func):
+    """Applies `func(backups)` to the catalog list and writes it; returns its result"""
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    with write_lock(CATALOG_PATH):
+        fer = get_cipher()
+        backups = _read_catalog(fer)
+        if backups is None:
+            backups = _scan_backups(fer)
+        result = func(backups)
+        backups.sort(key=lambda backup: backup['timestamp'], reverse=True)
+        durable_replace(CATALOG_PATH, fer.encrypt(json.dumps({"version": 1, "backups": backups}).encode()))
+        return result
+
+
+def _scan_backups(fer:MultiFernet):
+    """Builds the catalog list from the files in BACKUP_DIR (reads every manifest)"""
+    backups = []
+
+    if SNAPSHOTS_DIR.exists():
+        for snapshot_id in os.listdir(SNAPSHOTS_DIR):
+            created = _parse_time(snapshot_id, SNAPSHOT_TIME_FORMAT)
+            if created is None:
+                continue
+            hashes = _read_manifest(snapshot_id, fer)['entries']
+            backups.append({
+                "file": snapshot_id,
+                "timestamp": created.timestamp(),
+                "size": sum(os.path.getsize(OBJECTS_DIR / digest) for digest in hashes
+                            if (OBJECTS_DIR / digest).exists()),
+                "entries": len(hashes),
+                "checksum": manifest_checksum(hashes),
+                "legacy": False
+            })
+
+    if BACKUP_DIR.exists():
+        for file in os.listdir(BACKUP_DIR):
+            if file.endswith('.json'):
+                created = _parse_time(file[:-len('.json')], LEGACY_TIME_FORMAT)
+                if created is not None:
+                    backups.append({
+                        "file": file,
+                        "timestamp": created.timestamp(),
+                        "size": os.path.getsize(BACKUP_DIR / file),
+                        "entries": None,
+                        "checksum": None,
+                        "legacy": True
+                    })
+
+    return sorted(backups, key=lambda x: x['timestamp'], reverse=True)
+
+
+def _delete_files(backups:list):
+    for backup in backups:
+        path = BACKUP_DIR / backup['file'] if backup['legacy'] else SNAPSHOTS_DIR / backup['file']
+        if path.exists():
+            os.remove(path)
+
+
+def reencrypt_backups(cipher:MultiFernet):
+    """
+    Re-encrypts every object, manifest and the catalog with the primary key
+    of `cipher`, under the catalog lock so that no backup writes with an
+    older key meanwhile.
+    """
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    with write_lock(CATALOG_PATH):
+        if CATALOG_PATH.exists():
+            with open(CATALOG_PATH, 'rb') as f:
+                token = f.read()
+            durable_replace(CATALOG_PATH, cipher.rotate(token))
+
+        for directory in (OBJECTS_DIR, SNAPSHOTS_DIR):
+            if not directory.exists():
+                continue
+            for name in os.listdir(directory):
+                if name.endswith('.tmp'):
+                    continue
+                path = directory / name
+                with open(path, 'rb') as f:
+                    token = f.read()
+                _write_encrypted(path, cipher.rotate(token))
+
+
+def _read_manifest(snapshot_id:str, fer:MultiFernet):
+    if not is_snapshot_id(snapshot_id):
+        # Also keeps paths like '..' away from the filesystem
+        raise ValueError(f"Invalid snapshot id: {snapshot_id}")
+    with open(SNAPSHOTS_DIR / snapshot_id, 'rb') as f:
+        return json.loads(fer.decrypt(f.read()).decode())
+
+
+def _write_encrypted(path, token:bytes):
+    # Write next to the target and rename so that a crash never leaves a
+    # truncated object behind
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(token)
+    os.replace(tmp_path, path)
+
+
+def _parse_time(name:str, time_format:str):
+    if not name.startswith(SNAPSHOT_PREFIX):
+        return None
+    try:
+        return datetime.strptime(name[len(SNAPSHOT_PREFIX):], time_format)
+    except ValueError:
+        return None
@@ -0,0 +1,236 @@
+# app/batch.py
+#
+# Batched writes (POST /api/entries/batch/).
+#
+# A batch is a list of operations keyed by entry id:
+#
+#     {"op": "create", "entry": {"title", "text", "datetime_utc", "media_content", "id"}}
+#     {"op": "update", "entry": {"id", and the fields to change}, "expected_version": <n>}
+#     {"op": "delete", "id": <entry id>}
+#
+# The operations are checked in order, against the stored entries and the
+# earlier operations of the batch, under the write lock of the storage. If
+# they all pass, the batch is written with JournalStorage.write_batch(): one
+# write and one new version, hence one backup, whatever its size. If any
+# fails nothing is written. Either way every operation gets a result.
+#
+# A client may send an Idempotency-Key header so that a retried batch is not
+# applied twice. The response of an applied batch is kept under its key in
+# BATCH_IDEMPOTENCY_FILE for BATCH_IDEMPOTENCY_TTL seconds, along with a hash
+# of the request, and returned again when the same request comes back with
+# the same key. The key is recorded under the write lock, right after the
+# write, so a retry can't slip in between.
+
+from config import BATCH_IDEMPOTENCY_FILE, BATCH_IDEMPOTENCY_TTL, MAX_BATCH_OPERATIONS
+from datetime import datetime, timezone
+from app.database import durable_replace, get_storage, write_lock
+from app.importer import validate_record
+import hashlib, json, time, uuid
+
+OPERATIONS = ('create', 'update', 'delete')
+
+# Fields of an entry an update may change
+UPDATABLE_FIELDS = ('title', 'text', 'datetime_utc', 'media_content')
+
+
+class BatchError(ValueError):
+    """The request is not a batch of operations."""
+
+
+class IdempotencyKeyReused(ValueError):
+    """The idempotency key was already used for a different request."""
+
+
+class _Rejected(Exception):
+    def __init__(self, status:str, error:str):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+
+
+def parse_batch(payload):
+    """
+    Returns the list of operations of the decoded JSON request `payload`.
+
+    Raises:
+        BatchError: If it is not {"operations": [...]} with at most
+            MAX_BATCH_OPERATIONS items.
+    """
+    if not isinstance(payload, dict) or not isinstance(payload.get('operations'), list):
+        raise BatchError('Expected {"operations": [...]}')
+    operations = payload['operations']
+    if not operations:
+        raise BatchError("The batch has no operations")
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise BatchError(f"A batch has at most {MAX_BATCH_OPERATIONS} operations")
+    return operations
+
+
+def _entry_id(value):
+    """The canonical form of the entry id `value`; entry ids are UUIDs"""
+    try:
+        return str(uuid.UUID(value))
+    except (AttributeError, TypeError, ValueError):
+        raise _Rejected('invalid', "id is not a UUID")
+
+
+def _validated(record:dict):
+    try:
+        return validate_record(record)
+    except (ValueError, TypeError) as e:
+        raise _Rejected('invalid', str(e))
+
+
+def _check(operation, lookup):
+    """
+    Checks one operation against `lookup(entry_id)`, the current entries.
+
+    Returns:
+        tuple: (op, entry_id, the new entry or None)
+    """
+    if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+        raise _Rejected('invalid', f"op must be one of {', '.join(OPERATIONS)}")
+    op = operation['op']
+
+    if op == 'delete':
+        entry_id = _entry_id(operation.get('id'))
+        if lookup(entry_id) is None:
+            raise _Rejected('not_found', "no entry with this id")
+        return op, entry_id, None
+
+    fields = operation.get('entry')
+    if not isinstance(fields, dict):
+        raise _Rejected('invalid', "entry is not an object")
+
+    if op == 'create':
+        record = dict(fields, id=_entry_id(fields['id']) if fields.get('id') is not None else None)
+        record.setdefault('text', '')
+        record.setdefault('datetime_utc', datetime.now(timezone.utc).isoformat())
+        entry = _validated(record)
+        if lookup(entry['id']) is not None:
+            raise _Rejected('exists', "an entry with this id exists")
+        return op, entry['id'], entry
+
+    entry_id = _entry_id(fields.get('id'))
+    current = lookup(entry_id)
+    if current is None:
+        raise _Rejected('not_found', "no entry with this id")
+    expected_version = operation.get('expected_version')
+    if expected_version is not None and (not isinstance(expected_version, int) or isinstance(expected_version, bool)):
+        raise _Rejected('invalid', "expected_version is not an integer")
+    if expected_version is not None and current.get('revision', 0) > expected_version:
+        raise _Rejected('stale', f"the entry was modified after version {expected_version}")
+    changes = {field: fields[field] for field in UPDATABLE_FIELDS if field in fields}
+    return op, entry_id, _validated(dict(current, **changes))
+
+
+def apply_batch(operations:list, storage=None):
+    """
+    Checks the operations and, if they all pass, writes them in one go.
+
+    Returns:
+        dict: {"applied": bool, "version": the new version or None,
+            "results": [{"index", "op", "id", "status", ...}, ...]}, status
+            being created, updated or deleted, or why the operation failed
+            (invalid, not_found, exists, stale), or skipped when another
+            one failed.
+    """
+    storage = storage or get_storage()
+    with storage.write_lock():
+        pending = {}     # entry_id -> the entry after the operations so far, None once deleted
+        existed = {}     # entry_id -> whether it was stored before the batch
+
+        def lookup(entry_id):
+            if entry_id in pending:
+                return pending[entry_id]
+            entry = storage.get_entry(entry_id)
+            existed[entry_id] = entry is not None
+            return entry
+
+        results, failed = [], False
+        for index, operation in enumerate(operations):
+            try:
+                op, entry_id, entry = _check(operation, lookup)
+            except _Rejected as e:
+                failed = True
+                results.append({"index": index, "op": operation.get('op') if isinstance(operation, dict) else None,
+                                "status": e.status, "error": e.error})
+                continue
+            pending[entry_id] = entry
+            results.append({"index": index, "op": op, "id": entry_id,
+                            "status": {'create': 'created', 'update': 'updated', 'delete': 'deleted'}[op]})
+
+        if failed:
+            for result in results:
+                if 'error' not in result:
+                    result['status'] = 'skipped'
+            return {"applied": False, "version": None, "results": results}
+
+        # The net change of every entry touched by the batch
+        changes = []
+        for entry_id, entry in pending.items():
+            if entry is None:
+                if existed[entry_id]:
+                    changes.append(('delete', entry_id, None))
+            else:
+                changes.append(('update' if existed[entry_id] else 'add', entry_id, entry))
+
+        version = storage.write_batch(changes)
+        for result in results:
+            if pending[result['id']] is not None:
+                result['revision'] = version
+        return {"applied": True, "version": version, "results": results}
+
+
+######################################################################
+#                          Idempotency keys
+######################################################################
+
+def request_hash(payload):
+    """The hash identifying a batch request, whatever its key order"""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def _read_keys():
+    try:
+        with open(BATCH_IDEMPOTENCY_FILE, 'rb') as f:
+            keys = json.loads(f.read().decode())
+    except FileNotFoundError:
+        return {}
+    # Forget the expired keys
+    now = time.time()
+    return {key: record for key, record in keys.items() if record['created'] > now - BATCH_IDEMPOTENCY_TTL}
+
+
+def apply_idempotent_batch(payload, idempotency_key:str=None, storage=None):
+    """
+    apply_batch() of the operations of `payload`, at most once per
+    `idempotency_key`.
+
+    Returns:
+        tuple: (the response of apply_batch(), whether it is the response
+            of an earlier request with the same key)
+
+    Raises:
+        BatchError: If `payload` is not a batch.
+        IdempotencyKeyReused: If the key came with a different request.
+    """
+    operations = parse_batch(payload)
+    if idempotency_key is None:
+        return apply_batch(operations, storage), False
+
+    storage = storage or get_storage()
+    digest = request_hash(payload)
+    with storage.write_lock(), write_lock(BATCH_IDEMPOTENCY_FILE):
+        keys = _read_keys()
+        record = keys.get(idempotency_key)
+        if record is not None:
+            if record['hash'] != digest:
+                raise IdempotencyKeyReused(f"The idempotency key {idempotency_key} was used for another request")
+            return record['response'], True
+
+        response = apply_batch(operations, storage)
+        if response['applied']:
+            keys[idempotency_key] = {"hash": digest, "created": time.time(), "response": response}
+            durable_replace(BATCH_IDEMPOTENCY_FILE, json.dumps(keys).encode())
+        return response, False
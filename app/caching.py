@@ -0,0 +1,139 @@
+# app/caching.py
+#
+# Caching of rendered HTML and HTTP validators.
+#
+# Rendered fragments (entry cards, view_entry pages) are kept in a bounded
+# LRU cache keyed by the entry id, its revision and the display timezone,
+# so an entry is only rendered again once it was written. Whole responses get an ETag and a
+# Last-Modified header derived from the database version, so clients
+# revalidating an unchanged page get a 304 without it being rendered at all.
+
+from config import FRAGMENT_CACHE_SIZE
+from collections import OrderedDict
+from email.utils import formatdate
+from functools import wraps
+from flask import request, session, make_response
+from app.database import get_storage
+from app.timeformat import display_timezone
+import hashlib, threading
+
+
+class FragmentCache:
+    """
+    Thread-safe LRU cache of rendered fragments. Once it holds `maxsize`
+    fragments, the least recently used one is evicted.
+    """
+
+    def __init__(self, maxsize:int=FRAGMENT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key:tuple, render):
+        """Returns the fragment cached under `key`, calling `render()` on a miss"""
+        with self._lock:
+            fragment = self._store.get(key)
+            if fragment is not None:
+                self._store.move_to_end(key)
+                self.hits += 1
+                return fragment
+            self.misses += 1
+
+        # Render outside the lock; two threads may render the same fragment
+        fragment = render()
+        with self._lock:
+            self._store[key] = fragment
+            self._store.move_to_end(key)
+            while len(self._store) > self.maxsize:
+                self._store.popitem(last=False)
+        return fragment
+
+    def invalidate(self):
+        """Drops every cached fragment"""
+        with self._lock:
+            self._store.clear()
+
+    def stats(self):
+        """Returns the hit/miss counters of the cache."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._store)}
+
+
+# The cache shared by every request handled by this process
+fragment_cache = FragmentCache()
+
+
+######################################################################
+#                         HTTP validators
+######################################################################
+
+def database_validators(storage=None):
+    """
+    Returns (ETag, Last-Modified timestamp) of the current request against
+    the current content of the storage. The ETag covers the database version,
+    the full path with its query string, whether an admin is logged in and
+    the display timezone.
+    """
+    storage = storage or get_storage()
+    last_modified = storage.last_modified()
+    key = (f"{storage.version()}:{last_modified}:{request.full_path}:{bool(session.get('admin_logged_in'))}"
+           f":{display_timezone()}")
+    return hashlib.sha256(key.encode()).hexdigest()[:32], last_modified
+
+
+def not_modified(etag:str, last_modified:float):
+    """
+    Returns a 304 response if the client's cached copy is still current,
+    else None. If-None-Match takes precedence over If-Modified-Since.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since is not None:
+        fresh = int(last_modified) <= request.if_modified_since.timestamp()
+    else:
+        fresh = False
+
+    if not fresh:
+        return None
+    return set_validators(make_response('', 304), etag, last_modified)
+
+
+def set_validators(response, etag:str, last_modified:float):
+    """
+    Sets ETag, Last-Modified and Cache-Control on `response`. Clients must
+    revalidate every time, and shared caches must not keep journal content.
+    """
+    response.set_etag(etag, weak=True)
+    response.headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def conditional_on_database(view):
+    """
+    Decorator answering GET requests with a 304 while the database is
+    unchanged, and adding the validators to the 200 responses of `view`.
+    Place it below any login check.
+    """
+    @wraps(view)
+    def decorated_view(*args, **kwargs):
+        if session.get('_flashes'):
+            # Pending flash messages are rendered into the page, so neither
+            # may a cached copy be reused nor may this one be cached
+            return view(*args, **kwargs)
+
+        etag, last_modified = database_validators()
+        response = not_modified(etag, last_modified)
+        if response is not None:
+            return response
+
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            set_validators(response, etag, last_modified)
+        return response
+    return decorated_view
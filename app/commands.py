@@ -0,0 +1,60 @@
+# app/commands.py
+#
+# Maintenance commands, run with `flask --app run <command>`.
+
+import click
+from pathlib import Path
+from app import app
+from app.database import import_json_database, get_storage
+from app.keys import rotate_key, read_keys
+from app.sharding import journal_storage, list_journals
+from app.statistics import get_statistics
+from config import JOURNAL_JSON_DB_PATH, STORAGE_BACKEND, FERNET_FILE
+
+
+@app.cli.command('import-json')
+@click.argument('json_file', type=click.Path(exists=True, dir_okay=False, path_type=Path),
+                default=JOURNAL_JSON_DB_PATH)
+@click.option('--journal', default=None, help="Import into this journal instead of JOURNAL_NAME ('sharded' only).")
+def import_json(json_file, journal):
+    """
+    Import JSON_FILE (a journal_entries.json, encrypted or exported) into the
+    storage selected by STORAGE_BACKEND, replacing its content.
+    """
+    if journal is not None:
+        if STORAGE_BACKEND != 'sharded':
+            raise click.UsageError("--journal needs STORAGE_BACKEND = 'sharded'.")
+        storage = journal_storage(journal)
+    else:
+        storage = get_storage()
+    if STORAGE_BACKEND in ('blob', 'log') and json_file.resolve() == JOURNAL_JSON_DB_PATH.resolve():
+        raise click.UsageError("JSON_FILE is the database itself; set STORAGE_BACKEND first.")
+
+    count = import_json_database(json_file, storage)
+    click.echo(f"Imported {count} entries from {json_file} into the '{STORAGE_BACKEND}' storage.")
+
+
+@app.cli.command('list-journals')
+def list_sharded_journals():
+    """List the journals in SHARDS_DIR ('sharded' storage)."""
+    for name in list_journals():
+        storage = journal_storage(name)
+        click.echo(f"{name}: {storage.count()} entries")
+
+
+@app.cli.command('rebuild-statistics')
+def rebuild_statistics():
+    """Count the journal statistics again from every entry, e.g. to repair them."""
+    statistics = get_statistics()
+    statistics.rebuild()
+    click.echo(f"Rebuilt the statistics of {statistics.summary()['total_entries']} entries in {statistics.path}.")
+
+
+@app.cli.command('rotate-key')
+def rotate_fernet_key():
+    """
+    Generate a new primary Fernet key and re-encrypt the journal and its
+    backups with it. The app can keep running meanwhile.
+    """
+    rotate_key(background=True).join()
+    click.echo(f"Rotated the Fernet key; {FERNET_FILE} now holds {len(read_keys())} key(s).")
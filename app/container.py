@@ -0,0 +1,393 @@
+# app/container.py
+#
+# Random-access encrypted container (STORAGE_BACKEND = 'container').
+#
+# Every journal entry is encrypted as its own record, so reading one entry
+# only decrypts that entry. The container is made of three files:
+#
+#     CONTAINER_PATH              the index: a Fernet token of
+#                                 {"version": <n>, "data_file": <name>,
+#                                  "live_bytes": <n>,
+#                                  "entries": [[id, offset, length, datetime_utc], ...]}
+#                                 sorted by (datetime_utc, id)
+#     CONTAINER_PATH.log          the changes of the index since it was
+#                                 written: one Fernet token per line of
+#                                 {"version": <n>, "data_file": <name>,
+#                                  "live_bytes": <n>, "drop": [id, ...],
+#                                  "put": [[id, offset, length, datetime_utc], ...]}
+#     CONTAINER_PATH.<gen>.data   the records: for every entry a token of its
+#                                 summary (title, snippet, length, revision)
+#                                 and a token of the entry, on two lines
+#
+# New and updated entries are appended to the data file and a write appends
+# the index items it changes to the index log, so its cost doesn't depend on
+# the size of the journal. Every process caches the index and brings it up
+# to date by reading the end of the log; once the log grows past
+# LOG_COMPACTION_THRESHOLD bytes it is folded into the index. The data file
+# is read through mmap, so a lookup touches one record, and a page of
+# summaries only decrypts the summaries of the page. As the index is sorted
+# like the listings, a page is found by bisecting it, also with a cursor.
+#
+# Replaced records become garbage; once they make up most of the data file
+# a background job compacts it into a new generation, and switching
+# generations is an atomic replace of the index, after which the log is
+# removed. A log record only applies to the index of its data file at the
+# version before its own, so the log left by a crash in between is ignored.
+
+import json, mmap, os, threading
+from pathlib import Path
+from cryptography.fernet import InvalidToken, MultiFernet
+from app.database import JournalStorage, durable_replace, file_signature, summarize_entry
+from app.jobs import submit_job
+from app.keys import get_cipher
+from config import CONTAINER_COMPACTION_RATIO, LOG_COMPACTION_THRESHOLD
+
+
+class ContainerLogError(Exception):
+    """The index log doesn't follow the index it belongs to."""
+
+
+def _item_key(item:list):
+    # The order of the index items: (datetime_utc, id)
+    return (item[3], item[0])
+
+
+def _bisect(items:list, key:tuple):
+    """The position of the first of the sorted index `items` whose key is not lower than `key`"""
+    low, high = 0, len(items)
+    while low < high:
+        middle = (low + high) // 2
+        if _item_key(items[middle]) < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _summary_payload(entry:dict):
+    summary = summarize_entry(entry)
+    return {"title": summary['title'], "snippet": summary['snippet'], "length": summary['length'],
+            "revision": summary['revision']}
+
+
+class ContainerStorage(JournalStorage):
+    """Journal entries in a random-access encrypted container."""
+
+    def __init__(self, container_path):
+        super().__init__()
+        self.path = Path(container_path)
+        self.log_path = Path(str(self.path) + '.log')
+        self._lock = threading.RLock()
+        self._index = None            # [signature, decoded index, {id: item}, log position]
+        self._mmap = None             # (data file signature, file object, mmap)
+
+    def signature(self):
+        return (file_signature(self.path), file_signature(self.log_path))
+
+    ##################################################################
+    #                          The index
+    ##################################################################
+
+    def _read_index(self):
+        """Returns (index dict, {id: index item}), cached per process and kept up to date from the log"""
+        with self._lock:
+            while True:
+                signature = file_signature(self.path)
+                if signature is None:
+                    self._write_index({"version": 0, "data_file": self._data_file_name(0),
+                                       "live_bytes": 0, "entries": []})
+                    continue
+
+                fresh = self._index is None or self._index[0] != signature
+                if fresh:
+                    with open(self.path, 'rb') as f:
+                        index = json.loads(get_cipher().decrypt(f.read()).decode())
+                    # Containers written before the index was sorted; the next
+                    # write stores it sorted, after which this is a linear check
+                    index['entries'].sort(key=_item_key)
+                    self._index = [signature, index, {item[0]: item for item in index['entries']}, 0]
+
+                follows = self._read_log()
+                if follows and file_signature(self.path) == signature:
+                    return self._index[1], self._index[2]
+                if not follows and fresh and file_signature(self.path) == signature:
+                    raise ContainerLogError(f"The index log of {self.path} doesn't follow its index")
+                # The log was folded into the index by another process meanwhile
+                self._index = None
+
+    def _read_log(self):
+        """Applies the records appended to the index log since it was read; returns False on a gap"""
+        _, index, items, position = self._index
+        try:
+            with open(self.log_path, 'rb') as f:
+                f.seek(position)
+                tail = f.read()
+        except FileNotFoundError:
+            return True
+
+        fer = get_cipher()
+        # An unfinished last line is read again next time
+        complete = tail[:tail.rfind(b'\n') + 1]
+        for line in complete.splitlines():
+            try:
+                record = json.loads(fer.decrypt(line).decode())
+            except (InvalidToken, ValueError):
+                # Cut short by a crash; the next write started a new line
+                continue
+            if record['version'] <= index['version']:
+                # Already in the index
+                continue
+            if record['version'] != index['version'] + 1 or record['data_file'] != index['data_file']:
+                return False
+            self._apply(index, items, record)
+        self._index[3] = position + len(complete)
+        return True
+
+    @staticmethod
+    def _apply(index:dict, items:dict, record:dict):
+        """Applies a record of the index log to the index"""
+        entries = index['entries']
+        for entry_id in record['drop'] + [item[0] for item in record['put']]:
+            item = items.pop(entry_id, None)
+            if item is not None:
+                del entries[_bisect(entries, _item_key(item))]
+        for item in record['put']:
+            entries.insert(_bisect(entries, _item_key(item)), item)
+            items[item[0]] = item
+        index['version'] = record['version']
+        index['live_bytes'] = record['live_bytes']
+
+    def _write_index(self, index:dict):
+        """Writes the whole index, the log being folded into it, and removes the log"""
+        durable_replace(self.path, get_cipher().encrypt(json.dumps(index, separators=(',', ':')).encode()))
+        if self.log_path.exists():
+            os.remove(self.log_path)
+
+    def _append_log(self, record:dict):
+        """Appends a record to the index log; returns the size of the log"""
+        line = get_cipher().encrypt(json.dumps(record, separators=(',', ':')).encode()) + b'\n'
+        with open(self.log_path, 'a+b') as f:
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # After a line cut short by a crash
+                    line = b'\n' + line
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+    ##################################################################
+    #                            Reading
+    ##################################################################
+
+    def _read_region(self, index:dict, item:list):
+        """The bytes of the record of `item` in the data file, read through mmap"""
+        data_path = self.path.parent / index['data_file']
+        with self._lock:
+            signature = file_signature(data_path)
+            if self._mmap is None or self._mmap[0] != (data_path, signature):
+                self._close_mmap()
+                f = open(data_path, 'rb')
+                self._mmap = ((data_path, signature), f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            return self._mmap[2][item[1]:item[1] + item[2]]
+
+    def _read_entry(self, index:dict, item:list, fer:MultiFernet):
+        region = self._read_region(index, item)
+        # The entry is the last line of the record
+        return json.loads(fer.decrypt(region[region.rfind(b'\n') + 1:]).decode())
+
+    def _read_summary(self, index:dict, item:list, fer:MultiFernet):
+        if len(item) > 4:
+            # Kept in the index by containers written before the summaries
+            # moved to the data file
+            summary = item[4]
+        else:
+            region = self._read_region(index, item)
+            summary = json.loads(fer.decrypt(region[:region.index(b'\n')]).decode())
+        return dict(summary, id=item[0], datetime_utc=item[3])
+
+    def _close_mmap(self):
+        if self._mmap is not None:
+            self._mmap[2].close()
+            self._mmap[1].close()
+            self._mmap = None
+
+    def version(self):
+        return self._read_index()[0]['version']
+
+    def count(self):
+        return len(self._read_index()[0]['entries'])
+
+    def get_entry(self, entry_id:str):
+        with self._lock:
+            index, items = self._read_index()
+            item = items.get(str(entry_id))
+        return None if item is None else self._read_entry(index, item, get_cipher())
+
+    def load(self):
+        index, _ = self._read_index()
+        return {"version": index['version'], "entries": list(self.iter_entries())}
+
+    def iter_entries(self):
+        with self._lock:
+            index, _ = self._read_index()
+            entries = list(index['entries'])
+        fer = get_cipher()
+        for item in entries:
+            yield self._read_entry(index, item, fer)
+
+    def list_entries(self, offset:int=0, limit:int=None, before:str=None, before_id:str=None):
+        index, page = self._page(offset, limit, before, before_id)
+        fer = get_cipher()
+        return [self._read_entry(index, item, fer) for item in page]
+
+    def list_summaries(self, offset:int=0, limit:int=None, before:str=None, before_id:str=None):
+        index, page = self._page(offset, limit, before, before_id)
+        fer = get_cipher()
+        return [self._read_summary(index, item, fer) for item in page]
+
+    def list_datetimes(self):
+        with self._lock:
+            index, _ = self._read_index()
+            return [(item[0], item[3]) for item in reversed(index['entries'])]
+
+    def get_summaries(self, entry_ids:list):
+        with self._lock:
+            index, items = self._read_index()
+            page = [items[str(entry_id)] for entry_id in entry_ids if str(entry_id) in items]
+        fer = get_cipher()
+        return [self._read_summary(index, item, fer) for item in page]
+
+    def _page(self, offset:int, limit:int, before:str, before_id:str=None):
+        """Returns (index, the index items of a page, newest first)"""
+        # The datetime is in the index, so skipped entries are never decrypted
+        with self._lock:
+            index, _ = self._read_index()
+            items = index['entries']
+            high = len(items)
+            if before is not None:
+                # A 1-tuple sorts before every key of the same datetime
+                high = _bisect(items, (before,) if before_id is None else (before, before_id))
+            high -= offset
+            low = 0 if limit is None else max(high - limit, 0)
+            return index, [items[i] for i in range(high - 1, low - 1, -1)]
+
+    ##################################################################
+    #                            Writing
+    ##################################################################
+
+    def _data_file_name(self, generation:int):
+        return f'{self.path.name}.{generation}.data'
+
+    @staticmethod
+    def _records(entries, fer:MultiFernet):
+        """Yields (entry, the bytes of its record) for `entries`"""
+        for entry in entries:
+            summary = fer.encrypt(json.dumps(_summary_payload(entry), separators=(',', ':')).encode())
+            yield entry, summary + b'\n' + fer.encrypt(json.dumps(entry, separators=(',', ':')).encode())
+
+    def _append_all(self, index:dict, entries:list):
+        """Appends the records of `entries` to the data file in one write; returns their index items"""
+        if not entries:
+            return []
+        records = list(self._records(entries, get_cipher()))
+        data_path = self.path.parent / index['data_file']
+        items = []
+        with open(data_path, 'ab') as f:
+            offset = f.tell()
+            for entry, record in records:
+                items.append([entry['id'], offset, len(record), entry['datetime_utc']])
+                offset += len(record) + 1
+            f.write(b''.join(record + b'\n' for _, record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        return items
+
+    def _commit(self, entries:list, deleted:list, version:int):
+        """Appends the records of `entries` and logs them, and the deletion of `deleted`, in the index"""
+        # The last change of an entry wins
+        entries = list({entry['id']: entry for entry in entries}.values())
+        with self._lock:
+            index, items = self._read_index()
+            put = self._append_all(index, entries)
+            changed = set(deleted) | {item[0] for item in put}
+            live_bytes = (index['live_bytes'] + sum(item[2] + 1 for item in put)
+                          - sum(items[entry_id][2] + 1 for entry_id in changed if entry_id in items))
+            record = {"version": version, "data_file": index['data_file'], "live_bytes": live_bytes,
+                      "drop": list(deleted), "put": put}
+            log_size = self._append_log(record)
+
+            self._apply(index, items, record)
+            self._index[3] = log_size
+            if log_size >= LOG_COMPACTION_THRESHOLD:
+                self._write_index(index)
+                self._index = None
+        self._maybe_compact(index)
+
+    def _add(self, entry:dict, version:int):
+        self._commit([entry], [], version)
+
+    def _update(self, entry:dict, version:int):
+        self._commit([entry], [], version)
+
+    def _delete(self, entry_id:str, version:int):
+        self._commit([], [entry_id], version)
+
+    def _write_batch(self, changes:list, version:int):
+        self._commit(
+            [entry for _, _, entry in changes if entry is not None],
+            [entry_id for _, entry_id, entry in changes if entry is None],
+            version
+        )
+
+    def _import_entries(self, entries, replace:bool, version:int):
+        existing = {} if replace else {entry['id']: entry for entry in self.iter_entries()}
+        if replace:
+            # Stream straight into the new generation
+            self._rewrite(entries, version)
+            return
+        for entry in entries:
+            existing[entry['id']] = entry
+        self._rewrite(existing.values(), version)
+
+    def _rewrite(self, entries, version:int, fer:MultiFernet=None):
+        """Writes `entries` to a new data file generation and switches to it"""
+        fer = fer or get_cipher()
+        index, _ = self._read_index()
+        old_data_file = index['data_file']
+        generation = int(old_data_file.rsplit('.', 2)[-2]) + 1
+
+        new_index = {"version": version, "data_file": self._data_file_name(generation), "live_bytes": 0}
+        items = {}
+        with open(self.path.parent / new_index['data_file'], 'wb') as f:
+            for entry, record in self._records(entries, fer):
+                # A later duplicate replaces the earlier one
+                items[entry['id']] = [entry['id'], f.tell(), len(record), entry['datetime_utc']]
+                f.write(record + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        new_index['live_bytes'] = sum(item[2] + 1 for item in items.values())
+        new_index['entries'] = sorted(items.values(), key=_item_key)
+
+        with self._lock:
+            self._write_index(new_index)
+            self._index = None
+        old_data_path = self.path.parent / old_data_file
+        if old_data_path.exists():
+            os.remove(old_data_path)
+
+    def _maybe_compact(self, index:dict):
+        data_path = self.path.parent / index['data_file']
+        size = data_path.stat().st_size if data_path.exists() else 0
+        if size and index['live_bytes'] < size * CONTAINER_COMPACTION_RATIO:
+            submit_job('compact_container', key=f'compact_container:{self.path}')
+
+    def compact(self):
+        """Rewrites the data file without the records that were replaced or deleted"""
+        with self.write_lock():
+            self._rewrite(list(self.iter_entries()), self.version())
+
+    def reencrypt(self, cipher:MultiFernet):
+        with self.write_lock():
+            self._rewrite(list(self.iter_entries()), self.version(), fer=cipher)
@@ -1,68 +1,1205 @@
-
 from config import *
-from cryptography.fernet import Fernet
-import json
-from datetime import datetime
+from cryptography.fernet import MultiFernet
+import json, os, sqlite3, tempfile, threading
+
+try:
+    import fcntl
+except ImportError:  # Windows; writers are then only coordinated within a process
+    fcntl = None
+from pathlib import Path
+from app.journal import SNIPPET_LENGTH, JournalEntry, JournalCollection
+from app.keys import get_cipher
+from app.metrics import span
+from app.serialization import serialize, deserialize, split_header
+
+
+class DatabaseCache:
+    """
+    In-process cache of decrypted databases.
+
+    Each cached database is keyed on its path and remembered together with the
+    file's (mtime, size, inode) signature. A lookup only costs an `os.stat`; as
+    soon as the file changes on disk (e.g. an upload through the api blueprint
+    or a write from another worker) the signature no longer matches and the
+    file is decrypted again.
+    """
+
+    def __init__(self):
+        self._store = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, copy:bool=True):
+        """
+        Returns the cached content of `path` or None if it is stale. With
+        `copy=False` the cached dict itself is returned and must not be modified.
+        """
+        signature = _database_signature(path)
+        with self._lock:
+            cached = self._store.get(str(path))
+            if cached is not None and signature is not None and cached[0] == signature:
+                self.hits += 1
+                return _copy_database(cached[1]) if copy else cached[1]
+            self.misses += 1
+            return None
+
+    def put(self, path, content:dict):
+        """Remembers `content` as the current content of `path`."""
+        signature = _database_signature(path)
+        if signature is None:
+            return
+        with self._lock:
+            self._store[str(path)] = (signature, _copy_database(content))
+
+    def update(self, path, old_signature, func):
+        """
+        Applies `func` to the cached content of `path` in place, provided the
+        cache was current at `old_signature`. Otherwise the entry is dropped
+        and the next load reads the file again.
+        """
+        signature = _database_signature(path)
+        with self._lock:
+            cached = self._store.get(str(path))
+            if cached is None or cached[0] != old_signature or signature is None:
+                self._store.pop(str(path), None)
+                return
+            func(cached[1])
+            self._store[str(path)] = (signature, cached[1])
+
+    def invalidate(self, path=None):
+        """Drops the cached content of `path` (or of every database)."""
+        with self._lock:
+            if path is None:
+                self._store.clear()
+            else:
+                self._store.pop(str(path), None)
+
+    def stats(self):
+        """Returns the hit/miss counters of the cache."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._store)}
+
+
+def file_signature(path):
+    """Returns (mtime, size, inode) of `path` or None if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _parse_change(line:bytes):
+    """A record of the change log, None for an empty line or one cut short by a crash"""
+    try:
+        record = json.loads(line) if line.strip() else None
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) else None
+
+
+def _database_signature(path):
+    """
+    Returns the signature of the database at `path` together with its journal
+    logs, or None if the snapshot doesn't exist.
+    """
+    snapshot = file_signature(path)
+    if snapshot is None:
+        return None
+    return (snapshot,) + tuple(file_signature(p) for p in _journal_log_paths(path))
+
+
+def _copy_database(content:dict):
+    """
+    Copies the database dict deep enough that callers can freely modify the
+    entries list and the entry dicts without touching the cached version.
+    """
+    copied = dict(content)
+    if isinstance(copied.get('entries'), list):
+        copied['entries'] = [dict(entry) for entry in copied['entries']]
+    return copied
+
+
+# The cache shared by every request handled by this process
+db_cache = DatabaseCache()
+
 
-def load_database(json_filePath):
-    """Loads the database"""
+######################################################################
+#                        Write coordination
+######################################################################
 
-    # Get the Fernet key
-    key = open(FERNET_FILE, 'rb').read()
-    fer = Fernet(key)
+class StaleEntryError(Exception):
+    """The entry was modified after the version the caller based its edit on."""
 
-    with open(json_filePath, 'rb') as f:
-        content_with_header = f.read()
-    
+
+class EntryNotFoundError(Exception):
+    """No entry has the given id, e.g. it was deleted in the meantime."""
+
+
+class FileLock:
+    """
+    Exclusive lock held with `flock` on a lock file, so it serializes the
+    writers of every thread and every worker process. Re-entrant within a
+    thread.
+    """
+
+    def __init__(self, lock_path):
+        self.path = Path(lock_path)
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            self._file = open(self.path, 'a+b')
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+
+_write_locks = {}
+_write_locks_guard = threading.Lock()
+
+
+def write_lock(path):
+    """Returns the FileLock guarding the read-modify-write cycles on `path`"""
+    with _write_locks_guard:
+        lock = _write_locks.get(str(path))
+        if lock is None:
+            lock = _write_locks[str(path)] = FileLock(str(path) + '.lock')
+        return lock
+
+
+def durable_replace(path, content:bytes):
+    """
+    Writes `content` to a temporary file, fsyncs it and renames it over
+    `path`, so that a crash leaves either the old or the new file but never
+    a truncated one.
+    """
+    path = Path(path)
+    fd, temp_path = tempfile.mkstemp(prefix=path.name + '.', suffix='.tmp', dir=path.parent)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    # Persist the rename itself
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def read_database_file(json_filePath, fer=None):
+    """
+    Decodes a database file, either encrypted (with the ENCRYPTED marker) or
+    plaintext JSON such as the one produced by the export api. Bypasses the
+    cache and ignores any journal log.
+    """
+    with span('file_read'), open(json_filePath, 'rb') as f:
+        content = f.read()
+    return decode_database_content(content, fer)
+
+
+def decode_database_content(content_with_header:bytes, fer=None):
+    """Decodes the bytes of a database file (see read_database_file)"""
     if content_with_header.startswith(b'ENCRYPTED\n'):
-        encrypted_content = content_with_header[len(b'ENCRYPTED\n'):]
-        json_content = fer.decrypt(encrypted_content).decode()
-        content = json.loads(json_content)
-    else:
-        # If it doesn't have the encryption marker, assume it's plaintext JSON
-        with open(json_filePath, 'r') as f:
-            content = json.loads(f.read())
+        # The format header tells how the payload was serialized
+        format_name, encrypted_content = split_header(content_with_header[len(b'ENCRYPTED\n'):])
+        fer = fer or get_cipher()
+        with span('decrypt'):
+            payload = fer.decrypt(encrypted_content)
+        with span('parse'):
+            return deserialize(payload, format_name)
 
-    return content  # returns a dictionary
+    # If it doesn't have the encryption marker, assume it's plaintext JSON
+    with span('parse'):
+        return json.loads(content_with_header.decode())
 
 
-def save_database(data:dict, outputFileName):
-    """Saves the dict to the DATABASE_FILE"""
+def load_database(json_filePath, copy:bool=True):
+    """
+    Loads the database. Pass `copy=False` for read-only access to the cached
+    content without copying the entries.
+    """
 
-    # If Journal db exists then backup it
-    if JOURNAL_JSON_DB_PATH.exists():
-        # Define the backup directory path
-        backup_dir = BACKUP_DIR  # Replace with your actual backup directory path
-        if not backup_dir.exists():
-            backup_dir.mkdir()
+    cached = db_cache.get(json_filePath, copy=copy)
+    if cached is not None:
+        return cached
 
-        # Create a timestamped backup of the current database
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        backup_filename = f"backup_{timestamp}.json"
-        backup_path = backup_dir / backup_filename
+    # Get the cipher
+    fer = get_cipher()
 
-        # Getting the decrypted content of the current database using load_database()
-        db_content = load_database(json_filePath=JOURNAL_JSON_DB_PATH)
+    content = read_database_file(json_filePath, fer)
 
-        # Backup this decrypted content into a json
-        with open(backup_path, 'w') as f:
-            f.write(json.dumps(db_content, indent=4))
+    # Replay the mutations appended since the snapshot was written
+    with span('journal_replay'):
+        for record in _read_journal_records(json_filePath, fer):
+            _apply_record(content, record)
 
-    # Get the Fernet key
-    key = open(FERNET_FILE, 'rb').read()
-    fer = Fernet(key)
+    db_cache.put(json_filePath, content)
 
-    # Create the json content
-    json_content = json.dumps(data, indent=4)
+    return content  # returns a dictionary
+
+
+def save_database(data:dict, outputFileName, backup:bool=True):
+    """
+    Saves the dict to the DATABASE_FILE. With `backup`, a backup job then
+    snapshots the journal database in the background; the writes of
+    JournalStorage queue their own backup instead.
+    """
+
+    # Get the cipher
+    fer = get_cipher()
+
+    # Serialize the content in DATABASE_FORMAT
+    with span('serialize'):
+        format_header, payload = serialize(data, DATABASE_FORMAT)
 
     # Encrypt the content
-    encrypted_content = fer.encrypt(json_content.encode())
+    with span('encrypt'):
+        encrypted_content = fer.encrypt(payload)
+
+    # Add a marker/header to indicate that the content is encrypted, followed
+    # by the one telling its format
+    encrypted_content_with_header = b'ENCRYPTED\n' + format_header + encrypted_content
+
+    # Replace the file atomically so that it is never seen half-written
+    with span('write'):
+        durable_replace(outputFileName, encrypted_content_with_header)
+
+    # The written data is now the current content of the file
+    db_cache.put(outputFileName, data)
+
+    # Take an incremental backup of the new content, off the request path.
+    # A backup still waiting in the queue will see this content anyway.
+    if backup and Path(outputFileName).resolve() == JOURNAL_JSON_DB_PATH.resolve():
+        # Imported here as app.jobs builds on this module
+        from app.jobs import submit_job
+        submit_job('backup', {"path": str(JOURNAL_JSON_DB_PATH)}, key=f'backup:{JOURNAL_JSON_DB_PATH}')
+
+
+######################################################################
+#                      Append-only journal log
+######################################################################
+#
+# With STORAGE_BACKEND = 'log' every mutation is appended to
+# `<db>.log` as one Fernet token per line, instead of rewriting the whole
+# snapshot. A record looks like
+#
+#     {"op": "add" | "update" | "delete", "id": <entry id>, "entry": {...},
+#      "version": <database version after the change>}
+#
+# load_database() replays the records on top of the snapshot. Once the log
+# grows past LOG_COMPACTION_THRESHOLD bytes it is renamed to
+# `<db>.log.compacting` and folded back into the snapshot by a background
+# job while new records go to a fresh log. Replaying a record twice
+# is harmless, so a crash in the middle of a compaction loses nothing.
+
+_compaction_locks = {}
+_compaction_locks_guard = threading.Lock()
+
+
+def _compaction_lock(json_filePath):
+    """The lock held by the thread compacting the journal log of `json_filePath`"""
+    with _compaction_locks_guard:
+        return _compaction_locks.setdefault(str(json_filePath), threading.Lock())
+
+
+def journal_log_path(json_filePath):
+    """Returns the path of the journal log that belongs to `json_filePath`"""
+    return Path(str(json_filePath) + '.log')
+
+
+def _journal_log_paths(json_filePath):
+    """The logs to replay on top of the snapshot, oldest first."""
+    log_path = journal_log_path(json_filePath)
+    return [Path(str(log_path) + '.compacting'), log_path]
+
+
+def _read_journal_records(json_filePath, fer):
+    """Yields the decrypted records of the journal logs of `json_filePath`"""
+    for log_path in _journal_log_paths(json_filePath):
+        if not log_path.exists():
+            continue
+        with open(log_path, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(fer.decrypt(line).decode())
+
+
+def _apply_record(content:dict, record:dict):
+    """Applies one journal record to the database dict in place"""
+    entries = content.setdefault('entries', [])
+    entry_id = record['id']
+
+    index = None
+    for i, journal_entry in enumerate(entries):
+        if journal_entry.get('id') == entry_id:
+            index = i
+            break
+
+    if record['op'] == 'delete':
+        if index is not None:
+            entries.pop(index)
+    elif index is None:
+        entries.append(dict(record['entry']))
+    else:
+        entries[index] = dict(record['entry'])
+
+    content['version'] = record.get('version', content.get('version', 0) + 1)
+
+
+def append_journal_records(json_filePath, records:list):
+    """
+    Appends encrypted mutation records to the journal log of `json_filePath`
+    in one write. The cost is proportional to the size of the entries, not
+    of the journal. Must be called with write_lock(json_filePath) held.
+    """
+    with span('encrypt'):
+        fer = get_cipher()
+        lines = b''.join(fer.encrypt(json.dumps(record, separators=(',', ':')).encode()) + b'\n' for record in records)
+
+    log_path = journal_log_path(json_filePath)
+    old_signature = _database_signature(json_filePath)
+    with span('write'), open(log_path, 'ab') as f:
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+    def apply_records(content):
+        for record in records:
+            _apply_record(content, record)
+    db_cache.update(json_filePath, old_signature, apply_records)
+
+    if log_path.stat().st_size >= LOG_COMPACTION_THRESHOLD:
+        from app.jobs import submit_job
+        submit_job('compact_journal', {"path": str(json_filePath)}, key=f'compact_journal:{json_filePath}')
+
+
+def compact_journal(json_filePath):
+    """Folds the journal log of `json_filePath` back into its snapshot"""
+    lock = _compaction_lock(json_filePath)
+    if not lock.acquire(blocking=False):
+        # Another thread is already compacting this journal
+        return
+
+    try:
+        with write_lock(json_filePath):
+            log_path, compacting_path = journal_log_path(json_filePath), _journal_log_paths(json_filePath)[0]
+            if not compacting_path.exists():
+                if not log_path.exists():
+                    return
+                # New records go to a fresh log from now on
+                os.replace(log_path, compacting_path)
+
+            content = load_database(json_filePath)
+            save_database(data=content, outputFileName=json_filePath)
+            os.remove(compacting_path)
+            db_cache.put(json_filePath, content)
+    finally:
+        lock.release()
+
+
+def discard_journal_log(json_filePath):
+    """Removes the journal logs, e.g. after the snapshot was replaced wholesale"""
+    for log_path in _journal_log_paths(json_filePath):
+        if log_path.exists():
+            os.remove(log_path)
+    db_cache.invalidate(json_filePath)
+
+
+######################################################################
+#                         Storage backends
+######################################################################
+
+class JournalStorage:
+    """
+    Interface of the places journal entries can be stored in.
+
+    Entries are handled as dicts, i.e. the output of JournalEntry.to_dict().
+    Use get_storage() to get the backend selected by STORAGE_BACKEND.
+
+    Every write runs under write_lock() and bumps the database version, a
+    counter that only ever increases. Each stored entry remembers the version
+    that last wrote it as its 'revision', which lets update() reject edits
+    based on an outdated copy.
+
+    Backends implement the underscored write methods; the public ones also
+    notify the listeners registered with subscribe(), which is how indexes
+    built on top of the storage stay up to date without rescanning it, and
+    queue a backup of the journal served by the app.
+
+    Every write also appends the ids it wrote to the change log next to the
+    storage, <path>.changes, one JSON line of {"version": <n>, "ids": [...]}
+    per version, "ids" being null when the whole content was replaced. It
+    holds no content. With changes_since() an index that missed the writes
+    of other processes re-reads the entries they wrote instead of the whole
+    journal. Once the log grows past LOG_COMPACTION_THRESHOLD bytes its
+    older half is dropped.
+    """
+
+    def __init__(self):
+        self._listeners = []
+
+    def subscribe(self, listener):
+        """
+        Registers `listener(storage, changes, old_signature)` to be called
+        after every write, with the write lock held. `changes` is a list of
+        (op, entry_id, entry) tuples where op is 'add', 'update' or 'delete',
+        or [('reset', None, None)] after the whole content was replaced.
+        `old_signature` is the signature() right before the write: a listener
+        reflecting another one missed writes of other processes, so it must
+        not just apply `changes`.
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, changes:list, old_signature):
+        for listener in self._listeners:
+            listener(self, changes, old_signature)
+
+    @property
+    def changes_path(self):
+        return Path(str(self.path) + '.changes')
+
+    def _log_changes(self, version:int, entry_ids:list=None):
+        """Appends the ids written by `version` to the change log; None for a replaced content"""
+        line = json.dumps({"version": version, "ids": entry_ids}, separators=(',', ':')).encode() + b'\n'
+        with open(self.changes_path, 'a+b') as f:
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # After a line cut short by a crash
+                    line = b'\n' + line
+            f.write(line)
+            size = f.tell()
+        if size > LOG_COMPACTION_THRESHOLD:
+            # Under the write lock, so no line is appended meanwhile; readers
+            # missing the dropped changes rebuild
+            with open(self.changes_path, 'rb') as f:
+                lines = f.read().splitlines(keepends=True)
+            durable_replace(self.changes_path, b''.join(lines[len(lines) // 2:]))
+
+    def changes_since(self, version:int):
+        """
+        The ids of the entries written after `version`, from the change log.
+
+        Returns:
+            tuple: (current version, set of entry ids), or None if the log
+                doesn't go back that far, misses a write (e.g. of an older
+                release) or the whole content was replaced meanwhile, in
+                which case the caller has to rebuild from the entries.
+        """
+        current = self.version()
+        if current == version:
+            return current, set()
+        try:
+            f = open(self.changes_path, 'rb')
+        except FileNotFoundError:
+            return None
+
+        with f:
+            # Read backwards, so the cost is that of the changes missed
+            position, tail, records = f.seek(0, os.SEEK_END), b'', []
+            while position > 0 and (not records or records[0]['version'] > version + 1):
+                start = max(position - 64 * 1024, 0)
+                f.seek(start)
+                tail = f.read(position - start) + tail
+                position = start
+                lines = tail.split(b'\n')
+                # Unless at the start, the first line may begin before the part read
+                records = [record for record in map(_parse_change, lines[1 if position else 0:]) if record]
+
+        records = [record for record in records if record['version'] > version]
+        if [record['version'] for record in records] != list(range(version + 1, version + 1 + len(records))):
+            return None
+        if not records or records[-1]['version'] < current:
+            return None
+        if any(record['ids'] is None for record in records):
+            return None
+        return records[-1]['version'], {entry_id for record in records for entry_id in record['ids']}
+
+    def _queue_backup(self):
+        """
+        Queues a backup after a write to the journal served by the app. A
+        backup still waiting in the queue takes the place of the new one, as
+        it will see the written content anyway.
+        """
+        if self.path.resolve() != get_storage().path.resolve():
+            return
+        # Imported here as app.jobs builds on this module
+        from app.jobs import submit_job
+        submit_job('backup', {"storage": str(self.path)}, key=f'backup:{self.path}')
+
+    def signature(self):
+        """
+        A cheap value that changes whenever the stored data changes, also when
+        it is written by another process.
+        """
+        raise NotImplementedError
+
+    def write_lock(self):
+        """The lock serializing the writers of this storage across processes"""
+        return write_lock(self.path)
+
+    def last_modified(self):
+        """The time of the last write as a unix timestamp (0 if never written)"""
+        signature = file_signature(self.path)
+        return 0.0 if signature is None else signature[0] / 1e9
+
+    def version(self):
+        """Returns the current version of the database"""
+        raise NotImplementedError
+
+    def load(self):
+        """Returns the whole database as {"entries": [...]} in insertion order"""
+        raise NotImplementedError
+
+    def get_entry(self, entry_id:str):
+        """Returns the entry with the given id or None"""
+        raise NotImplementedError
+
+    def add(self, entry:dict):
+        """Adds a new entry"""
+        with self.write_lock():
+            old_signature = self.signature()
+            version = self.version() + 1
+            entry = dict(entry, revision=version)
+            self._add(entry, version)
+            self._log_changes(version, [entry['id']])
+            self._notify([('add', entry['id'], entry)], old_signature)
+        self._queue_backup()
+
+    def update(self, entry:dict, expected_version:int=None):
+        """
+        Replaces the entry having the same id as `entry`.
+
+        Args:
+            entry (dict): The new content of the entry.
+            expected_version (int): The database version the edit is based on.
+                If the entry was written after it, StaleEntryError is raised
+                instead of silently overwriting that change.
+
+        Raises:
+            EntryNotFoundError: If no entry has that id, rather than adding
+                back an entry deleted in the meantime.
+        """
+        with self.write_lock():
+            current = self.get_entry(entry['id'])
+            if current is None:
+                raise EntryNotFoundError(f"No entry {entry['id']}")
+            if expected_version is not None and current.get('revision', 0) > expected_version:
+                raise StaleEntryError(f"Entry {entry['id']} was modified after version {expected_version}")
+
+            old_signature = self.signature()
+            version = self.version() + 1
+            entry = dict(entry, revision=version)
+            self._update(entry, version)
+            self._log_changes(version, [entry['id']])
+            self._notify([('update', entry['id'], entry)], old_signature)
+        self._queue_backup()
+
+    def delete(self, entry_id:str):
+        """Deletes the entry with the given id"""
+        with self.write_lock():
+            old_signature = self.signature()
+            version = self.version() + 1
+            self._delete(str(entry_id), version)
+            self._log_changes(version, [str(entry_id)])
+            self._notify([('delete', str(entry_id), None)], old_signature)
+        self._queue_backup()
+
+    def replace_all(self, entries:list):
+        """Replaces the whole content of the storage with `entries`"""
+        self.import_entries(entries, replace=True)
+
+    def count(self):
+        """Returns the number of entries"""
+        return len(self.load()['entries'])
+
+    def import_entries(self, entries, replace:bool=True):
+        """
+        Writes the entries of the iterable `entries` in one go.
+
+        Args:
+            entries: Iterable of entry dicts.
+            replace (bool): Replace the whole content of the storage; otherwise
+                merge by id, i.e. entries with a known id replace the stored
+                ones and the others are added.
+        """
+        with self.write_lock():
+            old_signature = self.signature()
+            version = self.version() + 1
+            self._import_entries((dict(entry, revision=version) for entry in entries), replace, version)
+            self._log_changes(version)
+            self._notify([('reset', None, None)], old_signature)
+        self._queue_backup()
+
+    def write_batch(self, changes:list):
+        """
+        Applies several changes in one write, as one new version.
+
+        Args:
+            changes (list): (op, entry_id, entry) tuples as passed to the
+                listeners of subscribe(), op being 'add', 'update' or
+                'delete' (with entry None). Each id appears at most once.
+
+        Returns:
+            int: The new version, i.e. the revision of the written entries.
+        """
+        with self.write_lock():
+            old_signature = self.signature()
+            version = self.version() + 1
+            changes = [
+                (op, entry_id, None if entry is None else dict(entry, revision=version))
+                for op, entry_id, entry in changes
+            ]
+            self._write_batch(changes, version)
+            self._log_changes(version, [entry_id for _, entry_id, _ in changes])
+            self._notify(changes, old_signature)
+        self._queue_backup()
+        return version
+
+    def iter_entries(self):
+        """Yields every entry in insertion order"""
+        yield from self.load()['entries']
+
+    def list_entries(self, offset:int=0, limit:int=None, before:str=None, before_id:str=None):
+        """
+        Returns a page of entries, newest first, i.e. by descending
+        (datetime_utc, id), without materializing the rest of the journal.
+
+        Args:
+            offset (int): Number of entries to skip.
+            limit (int): Maximum number of entries to return (None for all).
+            before (str): Only entries whose datetime_utc is older than this
+                ISO timestamp (cursor based paging).
+            before_id (str): With `before`, also the entries of that very
+                timestamp whose id sorts before this one, so that the
+                datetime and id of the last entry of a page are the cursor of
+                the next one.
+        """
+        raise NotImplementedError
+
+    def list_summaries(self, offset:int=0, limit:int=None, before:str=None, before_id:str=None):
+        """
+        Same as list_entries() but returns the summaries of the entries (see
+        summarize_entry()). Backends keeping the summaries apart from the
+        entries answer this without decrypting any entry text.
+        """
+        return [summarize_entry(entry) for entry in self.list_entries(offset, limit, before, before_id)]
+
+    def get_summaries(self, entry_ids:list):
+        """Returns the summaries of the entries with the given ids, in that order, skipping unknown ids"""
+        entries = (self.get_entry(entry_id) for entry_id in entry_ids)
+        return [summarize_entry(entry) for entry in entries if entry is not None]
+
+    def list_datetimes(self):
+        """Returns (id, datetime_utc) of every entry, newest first"""
+        return [(summary['id'], summary['datetime_utc']) for summary in self.list_summaries()]
+
+    def reencrypt(self, cipher:MultiFernet):
+        """Re-encrypts everything stored with the primary key of `cipher`"""
+        raise NotImplementedError
+
+    def _add(self, entry:dict, version:int):
+        raise NotImplementedError
+
+    def _update(self, entry:dict, version:int):
+        raise NotImplementedError
+
+    def _delete(self, entry_id:str, version:int):
+        raise NotImplementedError
+
+    def _import_entries(self, entries, replace:bool, version:int):
+        raise NotImplementedError
+
+    def _write_batch(self, changes:list, version:int):
+        raise NotImplementedError
+
+
+class JsonStorage(JournalStorage):
+    """
+    The encrypted JSON file at `json_filePath`. With `append_only` the
+    mutations go to its journal log instead of rewriting the file.
+
+    The file holds {"version": <n>, "entries": [...]}; files written before
+    versioning simply start at version 0.
+
+    Lookups by id and listings go through a JournalCollection of the cached
+    entries, which this process keeps up to date with its own writes.
+    """
+
+    def __init__(self, json_filePath, append_only:bool=False):
+        super().__init__()
+        self.path = Path(json_filePath)
+        self.append_only = append_only
+        self._index = None        # (signature, JournalCollection)
+
+    def signature(self):
+        return _database_signature(self.path)
+
+    def last_modified(self):
+        signatures = [file_signature(p) for p in [self.path] + _journal_log_paths(self.path)]
+        return max((signature[0] / 1e9 for signature in signatures if signature is not None), default=0.0)
+
+    def version(self):
+        return self._content().get('version', 0)
+
+    def load(self):
+        # Create the JSON database file if it doesn't exist
+        if not self.path.exists():
+            create_blank_db(json_filepath=self.path)
+        return load_database(self.path)
+
+    def get_entry(self, entry_id:str):
+        entry = self._collection().get(str(entry_id))
+        return None if entry is None else entry.to_dict()
+
+    def count(self):
+        return len(self._entries())
+
+    def iter_entries(self):
+        # Iterate over a copy of the list (not of the entries) so that a
+        # concurrent append to the cached content doesn't disturb it
+        for journal_entry in list(self._entries()):
+            yield dict(journal_entry)
+
+    def list_entries(self, offset:int=0, limit:int=None, before:str=None, before_id:str=None):
+        return [entry.to_dict() for entry in self._collection().page(offset, limit, before, before_id)]
+
+    def reencrypt(self, cipher:MultiFernet):
+        with self.write_lock():
+            # Writing the snapshot encrypts it with the primary key and folds
+            # the log records, which may still use an old key, into it
+            content = self.load()
+            save_database(data=content, outputFileName=self.path)
+            if any(p.exists() for p in _journal_log_paths(self.path)):
+                discard_journal_log(self.path)
+                db_cache.put(self.path, content)
+
+    def _content(self):
+        """The cached database dict; read-only"""
+        if not self.path.exists():
+            create_blank_db(json_filepath=self.path)
+        return load_database(self.path, copy=False)
+
+    def _entries(self):
+        """The cached entries list; read-only"""
+        return self._content()['entries']
+
+    def _collection(self):
+        """The JournalCollection of the current entries; read-only"""
+        signature = self.signature()
+        cached = self._index
+        if cached is None or cached[0] != signature:
+            cached = self._index = (signature, JournalCollection.from_dicts(self._entries()))
+        return cached[1]
+
+    def _update_collection(self, old_signature, records:list):
+        """Applies the records written by this process to a copy of the collection"""
+        cached = self._index
+        if cached is None or cached[0] != old_signature:
+            return
+        collection = cached[1].copy()
+        for record in records:
+            if record['op'] == 'delete':
+                collection.remove(record['id'])
+            else:
+                collection.add(JournalEntry.from_dict(record['entry']))
+        self._index = (self.signature(), collection)
+
+    def _add(self, entry:dict, version:int):
+        self._write_records([{"op": "add", "id": entry['id'], "entry": entry, "version": version}])
+
+    def _update(self, entry:dict, version:int):
+        self._write_records([{"op": "update", "id": entry['id'], "entry": entry, "version": version}])
+
+    def _delete(self, entry_id:str, version:int):
+        self._write_records([{"op": "delete", "id": entry_id, "entry": None, "version": version}])
+
+    def _write_batch(self, changes:list, version:int):
+        self._write_records([
+            {"op": op, "id": entry_id, "entry": entry, "version": version}
+            for op, entry_id, entry in changes
+        ])
+
+    def _import_entries(self, entries, replace:bool, version:int):
+        merged = {} if replace else {entry['id']: entry for entry in self.iter_entries()}
+        for entry in entries:
+            merged[entry['id']] = entry
+
+        save_database(data={"version": version, "entries": list(merged.values())}, outputFileName=self.path,
+                      backup=False)
+        discard_journal_log(self.path)
+
+    def _write_records(self, records:list):
+        old_signature = self.signature()
+        if self.append_only:
+            append_journal_records(self.path, records)
+        else:
+            # Rewrite the whole snapshot once; it already includes any leftover log
+            content = self.load()
+            for record in records:
+                _apply_record(content, record)
+            save_database(data=content, outputFileName=self.path, backup=False)
+            if any(p.exists() for p in _journal_log_paths(self.path)):
+                discard_journal_log(self.path)
+                db_cache.put(self.path, content)
+        self._update_collection(old_signature, records)
+
+
+class SQLiteStorage(JournalStorage):
+    """
+    One row per journal entry in a SQLite database (WAL mode).
+
+    `id` and `datetime_utc` are stored in clear and indexed; title, text and
+    media_content are encrypted per entry so the at-rest guarantee of the
+    JSON file is kept. The database version lives in the `meta` table.
+
+    The `summaries` table mirrors every entry with its title, snippet and
+    length encrypted together, so listings never read or decrypt the text.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            datetime_utc TEXT NOT NULL,
+            title BLOB NOT NULL,
+            text BLOB NOT NULL,
+            media_content BLOB NOT NULL,
+            revision INTEGER NOT NULL DEFAULT 0
+        );
+        DROP INDEX IF EXISTS idx_entries_datetime_utc;
+        CREATE INDEX IF NOT EXISTS idx_entries_datetime_utc_id ON entries (datetime_utc, id);
+        CREATE TABLE IF NOT EXISTS summaries (
+            id TEXT PRIMARY KEY,
+            datetime_utc TEXT NOT NULL,
+            summary BLOB NOT NULL
+        );
+        DROP INDEX IF EXISTS idx_summaries_datetime_utc;
+        CREATE INDEX IF NOT EXISTS idx_summaries_datetime_utc_id ON summaries (datetime_utc, id);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+    """
+
+    COLUMNS = 'id, datetime_utc, title, text, media_content, revision'
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.path = Path(db_path)
+        self._local = threading.local()
+
+    def signature(self):
+        # Commits land in the write-ahead log first
+        return (file_signature(self.path), file_signature(str(self.path) + '-wal'))
+
+    def last_modified(self):
+        signatures = [file_signature(self.path), file_signature(str(self.path) + '-wal')]
+        return max((signature[0] / 1e9 for signature in signatures if signature is not None), default=0.0)
+
+    @property
+    def connection(self):
+        """The connection of the current thread"""
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(entries)')]
+            if columns and 'revision' not in columns:
+                # Databases created before versioning
+                conn.execute('ALTER TABLE entries ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+            conn.executescript(self.SCHEMA)
+            if conn.execute('SELECT NOT EXISTS (SELECT 1 FROM summaries) AND EXISTS (SELECT 1 FROM entries)').fetchone()[0]:
+                # Databases created before the summaries table
+                self._rebuild_summaries(conn)
+            self._local.connection = conn
+        return conn
+
+    def version(self):
+        return self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def load(self):
+        fer = get_cipher()
+        rows = self.connection.execute(f'SELECT {self.COLUMNS} FROM entries ORDER BY seq')
+        return {"version": self.version(), "entries": [self._row_to_entry(row, fer) for row in rows]}
+
+    def get_entry(self, entry_id:str):
+        row = self.connection.execute(
+            f'SELECT {self.COLUMNS} FROM entries WHERE id = ?',
+            (str(entry_id),)
+        ).fetchone()
+        return None if row is None else self._row_to_entry(row, get_cipher())
+
+    def _add(self, entry:dict, version:int):
+        fer = get_cipher()
+        with self.connection as conn:
+            conn.execute(
+                f'INSERT INTO entries ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)',
+                self._entry_to_row(entry, fer)
+            )
+            self._put_summary(conn, entry, fer)
+            self._set_version(conn, version)
+
+    def _update(self, entry:dict, version:int):
+        fer = get_cipher()
+        entry_id, datetime_utc, title, text, media_content, revision = self._entry_to_row(entry, fer)
+        with self.connection as conn:
+            conn.execute(
+                'UPDATE entries SET datetime_utc = ?, title = ?, text = ?, media_content = ?, revision = ? WHERE id = ?',
+                (datetime_utc, title, text, media_content, revision, entry_id)
+            )
+            self._put_summary(conn, entry, fer)
+            self._set_version(conn, version)
+
+    def _delete(self, entry_id:str, version:int):
+        with self.connection as conn:
+            conn.execute('DELETE FROM entries WHERE id = ?', (entry_id,))
+            conn.execute('DELETE FROM summaries WHERE id = ?', (entry_id,))
+            self._set_version(conn, version)
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def _import_entries(self, entries, replace:bool, version:int):
+        # Stream the entries into a single transaction without holding them
+        fer = get_cipher()
+        with self.connection as conn:
+            if replace:
+                conn.execute('DELETE FROM entries')
+                conn.execute('DELETE FROM summaries')
+            for entry in entries:
+                conn.execute(
+                    f"""
+                    INSERT INTO entries ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET datetime_utc = excluded.datetime_utc, title = excluded.title,
+                        text = excluded.text, media_content = excluded.media_content, revision = excluded.revision
+                    """,
+                    self._entry_to_row(entry, fer)
+                )
+                self._put_summary(conn, entry, fer)
+            self._set_version(conn, version)
+
+    def _write_batch(self, changes:list, version:int):
+        # One transaction; an upsert keeps the seq, i.e. the position, of updated entries
+        fer = get_cipher()
+        with self.connection as conn:
+            for op, entry_id, entry in changes:
+                if entry is None:
+                    conn.execute('DELETE FROM entries WHERE id = ?', (entry_id,))
+                    conn.execute('DELETE FROM summaries WHERE id = ?', (entry_id,))
+                    continue
+                conn.execute(
+                    f"""
+                    INSERT INTO entries ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET datetime_utc = excluded.datetime_utc, title = excluded.title,
+                        text = excluded.text, media_content = excluded.media_content, revision = excluded.revision
+                    """,
+                    self._entry_to_row(entry, fer)
+                )
+                self._put_summary(conn, entry, fer)
+            self._set_version(conn, version)
+
+    def iter_entries(self):
+        fer = get_cipher()
+        cursor = self.connection.execute(f'SELECT {self.COLUMNS} FROM entries ORDER BY seq')
+        while True:
+            rows = cursor.fetchmany(100)
+            if not rows:
+                break
+            for row in rows:
+                yield self._row_to_entry(row, fer)
+
+    def list_entries(self, offset:int=0, limit:int=None, before:str=None, before_id:str=None):
+        query = f'SELECT {self.COLUMNS} FROM entries' + self._page_clause(before, before_id)
+        params = self._page_params(offset, limit, before, before_id)
+        fer = get_cipher()
+        return [self._row_to_entry(row, fer) for row in self.connection.execute(query, params)]
+
+    def list_summaries(self, offset:int=0, limit:int=None, before:str=None, before_id:str=None):
+        # Same order as list_entries(), walking the (datetime_utc, id) index
+        # of the summaries only
+        query = 'SELECT id, datetime_utc, summary FROM summaries' + self._page_clause(before, before_id)
+        params = self._page_params(offset, limit, before, before_id)
+        fer = get_cipher()
+        return [
+            dict(json.loads(fer.decrypt(summary).decode()), id=entry_id, datetime_utc=datetime_utc)
+            for entry_id, datetime_utc, summary in self.connection.execute(query, params)
+        ]
+
+    def get_summaries(self, entry_ids:list):
+        entry_ids = [str(entry_id) for entry_id in entry_ids]
+        fer = get_cipher()
+        summaries = {}
+        # Bounded by SQLITE_MAX_VARIABLE_NUMBER
+        for i in range(0, len(entry_ids), 500):
+            chunk = entry_ids[i:i + 500]
+            query = f'SELECT id, datetime_utc, summary FROM summaries WHERE id IN ({",".join("?" * len(chunk))})'
+            for entry_id, datetime_utc, summary in self.connection.execute(query, chunk):
+                summaries[entry_id] = dict(json.loads(fer.decrypt(summary).decode()), id=entry_id, datetime_utc=datetime_utc)
+        return [summaries[entry_id] for entry_id in entry_ids if entry_id in summaries]
+
+    def list_datetimes(self):
+        # From the summaries table, which keeps the datetime unencrypted
+        query = 'SELECT id, datetime_utc FROM summaries ORDER BY datetime_utc DESC, id DESC'
+        return [(entry_id, datetime_utc) for entry_id, datetime_utc in self.connection.execute(query)]
+
+    @staticmethod
+    def _page_clause(before:str, before_id:str):
+        if before is None:
+            where = ''
+        elif before_id is None:
+            where = ' WHERE datetime_utc < ?'
+        else:
+            where = ' WHERE (datetime_utc, id) < (?, ?)'
+        return where + ' ORDER BY datetime_utc DESC, id DESC LIMIT ? OFFSET ?'
+
+    @staticmethod
+    def _page_params(offset:int, limit:int, before:str, before_id:str):
+        params = [] if before is None else [before] if before_id is None else [before, before_id]
+        return params + [-1 if limit is None else limit, offset]
+
+    def reencrypt(self, cipher:MultiFernet):
+        with self.write_lock(), self.connection as conn:
+            rows = conn.execute('SELECT seq, title, text, media_content FROM entries').fetchall()
+            conn.executemany(
+                'UPDATE entries SET title = ?, text = ?, media_content = ? WHERE seq = ?',
+                ((cipher.rotate(title), cipher.rotate(text), cipher.rotate(media_content), seq)
+                 for seq, title, text, media_content in rows)
+            )
+            rows = conn.execute('SELECT id, summary FROM summaries').fetchall()
+            conn.executemany(
+                'UPDATE summaries SET summary = ? WHERE id = ?',
+                ((cipher.rotate(summary), entry_id) for entry_id, summary in rows)
+            )
+
+    def _rebuild_summaries(self, conn):
+        fer = get_cipher()
+        with conn:
+            conn.execute('DELETE FROM summaries')
+            for row in conn.execute(f'SELECT {self.COLUMNS} FROM entries').fetchall():
+                self._put_summary(conn, self._row_to_entry(row, fer), fer)
+
+    @staticmethod
+    def _put_summary(conn, entry:dict, fer:MultiFernet):
+        summary = summarize_entry(entry)
+        payload = {"title": summary['title'], "snippet": summary['snippet'], "length": summary['length'],
+                   "revision": summary['revision']}
+        conn.execute(
+            """
+            INSERT INTO summaries (id, datetime_utc, summary) VALUES (?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET datetime_utc = excluded.datetime_utc, summary = excluded.summary
+            """,
+            (entry['id'], entry['datetime_utc'], fer.encrypt(json.dumps(payload).encode()))
+        )
+
+    @staticmethod
+    def _set_version(conn, version:int):
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'version'", (version,))
+
+    @staticmethod
+    def _entry_to_row(entry:dict, fer:MultiFernet):
+        return (
+            entry['id'],
+            entry['datetime_utc'],
+            fer.encrypt(entry.get('title', '').encode()),
+            fer.encrypt(entry.get('text', '').encode()),
+            fer.encrypt(json.dumps(entry.get('media_content', [])).encode()),
+            entry.get('revision', 0)
+        )
+
+    @staticmethod
+    def _row_to_entry(row, fer:MultiFernet):
+        entry_id, datetime_utc, title, text, media_content, revision = row
+        return {
+            "title": fer.decrypt(title).decode(),
+            "datetime_utc": datetime_utc,
+            "text": fer.decrypt(text).decode(),
+            "media_content": json.loads(fer.decrypt(media_content).decode()),
+            "id": entry_id,
+            "revision": revision
+        }
+
+
+def summarize_entry(entry:dict, snippet_length:int=SNIPPET_LENGTH):
+    """The lightweight summary of an entry used by listings"""
+    text = entry.get('text', '')
+    return {
+        "id": entry['id'],
+        "title": entry['title'],
+        "datetime_utc": entry['datetime_utc'],
+        "snippet": text[:snippet_length],
+        "length": len(text),
+        "revision": entry.get('revision', 0)
+    }
+
+
+_storage = None
+
+
+def get_storage():
+    """Returns the storage backend selected by STORAGE_BACKEND"""
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND == 'sqlite':
+            _storage = SQLiteStorage(SQLITE_DB_PATH)
+        elif STORAGE_BACKEND in ('blob', 'log'):
+            _storage = JsonStorage(JOURNAL_JSON_DB_PATH, append_only=STORAGE_BACKEND == 'log')
+        elif STORAGE_BACKEND == 'container':
+            # Imported here as app.container builds on this module
+            from app.container import ContainerStorage
+            _storage = ContainerStorage(CONTAINER_PATH)
+        elif STORAGE_BACKEND == 'sharded':
+            # Imported here as app.sharding builds on this module
+            from app.sharding import journal_storage
+            _storage = journal_storage(JOURNAL_NAME)
+        else:
+            raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return _storage
+
+
+def import_json_database(json_filePath, storage:JournalStorage=None):
+    """
+    Imports a journal_entries.json file (encrypted or plaintext, including
+    its journal log if any) into `storage`, replacing its content.
+
+    Returns:
+        int: The number of imported entries.
+    """
+    storage = storage or get_storage()
+    fer = get_cipher()
+
+    content = read_database_file(json_filePath, fer)
+    for record in _read_journal_records(json_filePath, fer):
+        _apply_record(content, record)
 
-    # Add a marker/header to indicate that the content is encrypted
-    encrypted_content_with_header = b'ENCRYPTED\n' + encrypted_content
-    
-    with open(outputFileName, 'wb') as f:
-        f.write(encrypted_content_with_header)
+    storage.replace_all(content['entries'])
+    return len(content['entries'])
 
 
 def create_blank_db(json_filepath):
@@ -72,4 +1209,4 @@ def create_blank_db(json_filepath):
             "entries": []
         }
     """
-    save_database(data={"entries": []}, outputFileName=json_filepath)
\ No newline at end of file
+    save_database(data={"entries": []}, outputFileName=json_filepath, backup=False)
\ No newline at end of file
@@ -0,0 +1,130 @@
+# app/export.py
+#
+# Generators producing the export formats of the journal entry by entry, so
+# that exporting never holds more than one serialized entry in memory.
+#
+# Exports run as background jobs (see app/jobs.py) are written to
+# EXPORTS_DIR as one Fernet token per line, each encrypting the next
+# EXPORT_CHUNK_SIZE bytes of the export, so they are never stored in clear
+# and can be streamed back chunk by chunk. They are deleted after EXPORT_TTL
+# seconds.
+
+from config import EXPORTS_DIR, EXPORT_TTL
+from cryptography.fernet import MultiFernet
+from app.database import write_lock
+from app.keys import get_cipher
+import json, os, time, zlib
+
+EXPORT_CHUNK_SIZE = 1024 * 1024
+
+
+def iter_json_export(entries):
+    """
+    Yields the export as a JSON document `{"entries": [...]}`, i.e. the same
+    structure as the database itself, one entry per line.
+    """
+    yield '{"entries": ['
+    first = True
+    for entry in entries:
+        yield ('\n' if first else ',\n') + json.dumps(entry)
+        first = False
+    yield '\n]}\n'
+
+
+def iter_ndjson_export(entries):
+    """Yields the export as newline delimited JSON, one entry per line"""
+    for entry in entries:
+        yield json.dumps(entry) + '\n'
+
+
+def gzip_stream(chunks, level:int=6):
+    """Gzip-compresses an iterable of str chunks on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def write_export_file(export_id:str, entries, export_format:str='json', gzip:bool=False):
+    """
+    Writes the export of `entries` encrypted to EXPORTS_DIR/<export_id>.export
+    and removes the expired ones.
+
+    Returns:
+        dict: The file name and the size of the export (before encryption).
+    """
+    EXPORTS_DIR.mkdir(parents=True, exist_ok=True)
+
+    chunks = EXPORT_FORMATS[export_format][0](entries)
+    chunks = gzip_stream(chunks) if gzip else (chunk.encode() for chunk in chunks)
+
+    name = f'{export_id}.export'
+    tmp_path = EXPORTS_DIR / (name + '.tmp')
+    size, buffer = 0, bytearray()
+    # Under the lock of the exports, so that a key rotation re-encrypts the
+    # file only once it is written
+    with write_lock(EXPORTS_DIR):
+        _remove_expired_exports()
+        fer = get_cipher()
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                buffer += chunk
+                if len(buffer) >= EXPORT_CHUNK_SIZE:
+                    f.write(fer.encrypt(bytes(buffer)) + b'\n')
+                    size += len(buffer)
+                    buffer.clear()
+            if buffer:
+                f.write(fer.encrypt(bytes(buffer)) + b'\n')
+                size += len(buffer)
+        os.replace(tmp_path, EXPORTS_DIR / name)
+
+    return {"file": name, "bytes": size}
+
+
+def iter_export_file(name:str):
+    """Yields the decrypted chunks of the export file `name`"""
+    if os.path.basename(name) != name:
+        raise ValueError(f"Invalid export file: {name}")
+
+    fer = get_cipher()
+    with open(EXPORTS_DIR / name, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield fer.decrypt(line.strip())
+
+
+def reencrypt_exports(cipher:MultiFernet):
+    """Re-encrypts the export files with the primary key of `cipher`, keeping their expiry"""
+    if not EXPORTS_DIR.exists():
+        return
+    with write_lock(EXPORTS_DIR):
+        for name in os.listdir(EXPORTS_DIR):
+            if not name.endswith('.export'):
+                continue
+            path = EXPORTS_DIR / name
+            st = path.stat()
+            tmp_path = EXPORTS_DIR / (name + '.tmp')
+            with open(path, 'rb') as source, open(tmp_path, 'wb') as f:
+                for line in source:
+                    if line.strip():
+                        f.write(cipher.rotate(line.strip()) + b'\n')
+            # The expiry of an export goes by its modification time
+            os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(tmp_path, path)
+
+
+def _remove_expired_exports():
+    expiry = time.time() - EXPORT_TTL
+    for name in os.listdir(EXPORTS_DIR):
+        path = EXPORTS_DIR / name
+        if path.stat().st_mtime < expiry:
+            os.remove(path)
+
+
+EXPORT_FORMATS = {
+    # format: (generator, mimetype, file extension)
+    'json': (iter_json_export, 'application/json', 'json'),
+    'ndjson': (iter_ndjson_export, 'application/x-ndjson', 'ndjson'),
+}
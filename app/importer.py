@@ -0,0 +1,282 @@
+# app/importer.py
+#
+# Streaming import of uploaded journal data.
+#
+# The upload is parsed incrementally, one record at a time, whether it is
+#   - the export/database format   {"entries": [{...}, {...}]}
+#   - a bare JSON array            [{...}, {...}]
+#   - newline delimited JSON       {...}\n{...}\n
+# Every record is validated through JournalEntry.from_dict before it is
+# handed over to the storage, which writes the result in a single atomic step.
+# A replacing upload without any valid entry is refused, as it would empty
+# the journal, unless the caller explicitly allows it.
+
+import codecs, json, logging, time, uuid
+from datetime import timezone
+from app.journal import JournalEntry
+from app.database import get_storage, decode_database_content
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# How many validation errors are kept for the report
+MAX_REPORTED_ERRORS = 10
+
+
+class ImportFormatError(ValueError):
+    """The upload is not one of the supported JSON layouts"""
+
+
+class ImportReport:
+    """Counts and timing of one import"""
+
+    def __init__(self, mode:str):
+        self.mode = mode
+        self.imported = 0
+        self.invalid = 0
+        self.errors = []
+        self.seconds = 0.0
+
+    def to_dict(self):
+        return {
+            "mode": self.mode,
+            "imported": self.imported,
+            "invalid": self.invalid,
+            "errors": self.errors,
+            "seconds": round(self.seconds, 3)
+        }
+
+    def __str__(self):
+        message = f"Imported {self.imported} entries ({self.mode}) in {self.seconds:.2f}s"
+        if self.invalid:
+            message += f"; skipped {self.invalid} invalid records"
+        return message
+
+
+class _JSONStreamReader:
+    """Incrementally decodes JSON values from a binary file object."""
+
+    def __init__(self, fileobj, chunk_size:int=CHUNK_SIZE):
+        self._file = fileobj
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size:int=None):
+        """Reads more data; returns False at the end of the file"""
+        if self._eof:
+            return False
+        chunk = self._file.read(size or self._chunk_size)
+        if not chunk:
+            self._eof = True
+            self._buffer = self._buffer[self._pos:] + self._text_decoder.decode(b'', final=True)
+        else:
+            # Drop what was consumed so that the buffer stays bounded
+            self._buffer = self._buffer[self._pos:] + self._text_decoder.decode(chunk)
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character ('' at the end)"""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char:str):
+        if self.peek() != char:
+            raise ImportFormatError(f"Expected {char!r} in the uploaded JSON")
+        self._pos += 1
+
+    def value(self):
+        """Decodes the next complete JSON value"""
+        self.peek()
+        size = self._chunk_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A number may continue in the next chunk
+                if end < len(self._buffer) or self._eof or not isinstance(value, (int, float)):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self._eof:
+                    raise ImportFormatError(f"Invalid JSON: {e}") from e
+            # The value is not complete yet; read more (growing for huge values)
+            self._fill(size)
+            size *= 2
+
+
+def iter_upload_records(fileobj):
+    """Yields the raw records of an uploaded JSON/NDJSON file object"""
+    head = fileobj.read(len(b'ENCRYPTED\n'))
+    if head == b'ENCRYPTED\n':
+        # An encrypted database can only be decrypted as a whole
+        yield from _iter_encrypted_records(head + fileobj.read())
+        return
+
+    reader = _JSONStreamReader(_Prepend(head, fileobj))
+    first = reader.peek()
+
+    if first == '[':
+        yield from _iter_array(reader)
+    elif first == '{':
+        # Either {"entries": [...]} or a stream of objects (NDJSON)
+        yield from _iter_objects(reader)
+    elif first == '':
+        return
+    else:
+        raise ImportFormatError("The uploaded file is not a JSON array, object or NDJSON")
+
+
+def _iter_array(reader:_JSONStreamReader):
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.expect(']')
+        return
+    while True:
+        yield reader.value()
+        if reader.peek() == ',':
+            reader.expect(',')
+        else:
+            reader.expect(']')
+            return
+
+
+def _iter_objects(reader:_JSONStreamReader):
+    # The members of each top-level object are decoded one by one; an
+    # "entries" array is streamed, anything else makes the object a record
+    while reader.peek():
+        reader.expect('{')
+        record, has_entries = {}, False
+        if reader.peek() != '}':
+            while True:
+                if reader.peek() != '"':
+                    raise ImportFormatError("Expected a member name in the uploaded JSON")
+                key = reader.value()
+                reader.expect(':')
+                if key == 'entries' and reader.peek() == '[':
+                    has_entries = True
+                    yield from _iter_array(reader)
+                else:
+                    record[key] = reader.value()
+                # Like the items of an array, members are separated by commas
+                if reader.peek() != ',':
+                    break
+                reader.expect(',')
+        reader.expect('}')
+        if not has_entries:
+            yield record
+
+
+def _iter_encrypted_records(content:bytes):
+    yield from decode_database_content(content).get('entries', [])
+
+
+class _Prepend:
+    """File object that returns `head` before the rest of `fileobj`"""
+
+    def __init__(self, head:bytes, fileobj):
+        self._head = head
+        self._file = fileobj
+
+    def read(self, size:int=-1):
+        if self._head:
+            head, self._head = self._head, b''
+            return head
+        return self._file.read(size)
+
+
+def validate_record(record):
+    """
+    Validates one uploaded record through JournalEntry.from_dict.
+
+    Returns:
+        dict: The normalised entry (JournalEntry.to_dict()): its datetime_utc
+            in UTC and its id, if given, a canonical UUID string.
+
+    Raises:
+        ValueError: If the record is not a valid journal entry.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("record is not an object")
+    if not isinstance(record.get('title'), str):
+        raise ValueError("missing title")
+    if not isinstance(record.get('text', ''), str):
+        raise ValueError("text is not a string")
+    if not isinstance(record.get('datetime_utc'), str):
+        raise ValueError("missing datetime_utc")
+    if not isinstance(record.get('media_content', []), list):
+        raise ValueError("media_content is not a list")
+    if record.get('id') is not None:
+        try:
+            record = dict(record, id=str(uuid.UUID(record['id'])))
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError("id is not a UUID")
+
+    entry = JournalEntry.from_dict(record)
+    if entry._datetime_utc.tzinfo is None:
+        # Naive datetimes are in UTC by definition of the field
+        entry._datetime_utc = entry._datetime_utc.replace(tzinfo=timezone.utc)
+    else:
+        # The storages order, bisect and shard on the stored string, so
+        # every datetime_utc is stored with the same +00:00 offset
+        entry._datetime_utc = entry._datetime_utc.astimezone(timezone.utc)
+    return entry.to_dict()
+
+
+def import_upload(fileobj, mode:str='replace', storage=None, allow_empty:bool=False):
+    """
+    Imports the uploaded file object into the storage.
+
+    Args:
+        fileobj: Binary file object with the upload.
+        mode (str): 'replace' the whole journal, or 'merge' by entry id.
+        storage: The storage to import into (defaults to get_storage()).
+        allow_empty (bool): Let a 'replace' upload without any entry empty
+            the journal.
+
+    Returns:
+        ImportReport
+
+    Raises:
+        ImportFormatError: If the upload is not valid JSON, or has no valid
+            entry while replacing without `allow_empty`; nothing is written.
+    """
+    if mode not in ('replace', 'merge'):
+        raise ValueError(f"Unknown import mode: {mode}")
+
+    storage = storage or get_storage()
+    report = ImportReport(mode)
+    start = time.perf_counter()
+
+    def valid_entries():
+        for number, record in enumerate(iter_upload_records(fileobj), start=1):
+            try:
+                entry = validate_record(record)
+            except (ValueError, TypeError) as e:
+                report.invalid += 1
+                if len(report.errors) < MAX_REPORTED_ERRORS:
+                    report.errors.append(f"record {number}: {e}")
+                continue
+            report.imported += 1
+            yield entry
+
+        # Don't let a wrong or empty file wipe the journal; raising here aborts the write
+        if report.invalid and not report.imported:
+            raise ImportFormatError(f"No valid journal entry in the upload ({report.errors[0]})")
+        if mode == 'replace' and not report.imported and not allow_empty:
+            raise ImportFormatError("The upload has no journal entry; replacing the journal with it would empty it")
+
+    storage.import_entries(valid_entries(), replace=mode == 'replace')
+
+    report.seconds = time.perf_counter() - start
+    logger.info(f"Upload import: {report}")
+    return report
@@ -0,0 +1,421 @@
+# app/jobs.py
+#
+# Background jobs.
+#
+# Backups, journal and container compaction, search index rebuilds, large
+# exports and thumbnails run on a small pool of worker threads, so the
+# request that triggers them returns as soon as its own write is durable.
+#
+# Every job is recorded in JOBS_FILE, so every worker process sees the same
+# jobs. It is a log of JSON lines appended under a file lock: the record of
+# a job when it is submitted,
+#
+#     {"id": <hex>, "kind": "backup", "args": {...}, "key": <str or null>,
+#      "status": "queued" | "running" | "done" | "failed", "owner": <token>,
+#      "created": <unix time>, "started": ..., "finished": ...,
+#      "result": ..., "error": <str or null>}
+#
+# then one line per change of its status, holding its id and the changed
+# fields. Appends are not fsynced, so submitting a job costs one small write
+# after the durable write of the request; a crash of the machine may lose the
+# last records, which only makes a maintenance job run again later. Once the
+# log grows past LOG_COMPACTION_THRESHOLD bytes it is rewritten with one line
+# per job, keeping the last JOB_HISTORY finished ones.
+#
+# The owner of a job is a token made of the pid and the start time of the
+# process, as a restarted server often gets its old pid back (e.g. pid 1 in
+# a container). Jobs left queued or running by a process that is gone are
+# queued again by recover_jobs(), so a handler may run twice and must be
+# idempotent. A job with a `key` is coalesced with a job having the same
+# key that waits in the queue of this process, without recording anything.
+# Each process queues at most JOB_QUEUE_SIZE jobs; beyond that submit_job()
+# runs maintenance jobs in the calling thread.
+
+from config import JOBS_FILE, JOB_WORKERS, JOB_QUEUE_SIZE, JOB_HISTORY, LOG_COMPACTION_THRESHOLD, SHARD_APPEND_ONLY
+from app.database import durable_replace, write_lock
+from pathlib import Path
+import json, logging, os, queue, threading, time, uuid
+
+logger = logging.getLogger(__name__)
+
+# Statuses of jobs that still have to run
+PENDING = ('queued', 'running')
+
+
+class JobQueueFull(Exception):
+    """The job queue of this process is full."""
+
+
+# kind -> handler(job) returning a JSON-serializable result
+JOB_HANDLERS = {}
+
+
+def job_handler(kind:str):
+    """Decorator registering the handler of the jobs of `kind`"""
+    def register(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return register
+
+
+def _start_time(pid:int):
+    """The start time of the process `pid` in clock ticks since boot, or None without /proc"""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            # The command name may hold spaces; the fields after it follow the last ')'
+            return int(f.read().rsplit(b')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+_owner_token = (None, None)
+
+
+def _owner():
+    """The token of this process stored as the owner of its jobs: '<pid>:<start time>'"""
+    global _owner_token
+    pid = os.getpid()
+    if _owner_token[0] != pid:
+        # Computed again in a forked worker
+        start = _start_time(pid)
+        _owner_token = (pid, f'{pid}:{start if start is not None else uuid.uuid4().hex}')
+    return _owner_token[1]
+
+
+def _owner_alive(owner):
+    """Whether the process that stored the owner token `owner` is still running"""
+    if owner == _owner():
+        return True
+    # Bare pids were stored before the owners were tokens
+    pid, _, start = str(owner).partition(':')
+    try:
+        pid = int(pid)
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        # An earlier process that had the pid of this one
+        return False
+    if os.name != 'posix':
+        # Signal 0 would terminate the process on Windows; assume it is gone
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    # Unless the pid was given to another process since
+    current = _start_time(pid)
+    return current is None or not start.isdigit() or int(start) == current
+
+
+class JobQueue:
+    """A bounded queue of jobs recorded in `jobs_file`, run by `workers` threads."""
+
+    def __init__(self, jobs_file, workers:int=JOB_WORKERS, maxsize:int=JOB_QUEUE_SIZE):
+        self.path = Path(jobs_file)
+        self.workers = workers
+        self._queue = queue.Queue(maxsize)
+        self._held = {}             # job_id -> record of the jobs waiting in self._queue
+        self._held_keys = {}        # key -> job_id of one of them
+        self._held_lock = threading.Lock()
+        self._threads = []
+        self._threads_lock = threading.Lock()
+
+    ##################################################################
+    #                          Job records
+    ##################################################################
+
+    def _read(self):
+        """Returns the job records folded from the log, oldest first"""
+        try:
+            with open(self.path, 'rb') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+        jobs = {}
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Cut short by a crash
+                continue
+            # The first line may be the JSON list of jobs written before the log
+            for record in record if isinstance(record, list) else [record]:
+                if record['id'] in jobs:
+                    jobs[record['id']].update(record)
+                elif 'kind' in record:
+                    jobs[record['id']] = record
+
+        # Forget the oldest finished jobs
+        jobs = list(jobs.values())
+        finished = [job for job in jobs if job['status'] not in PENDING]
+        if len(finished) > JOB_HISTORY:
+            forgotten = {job['id'] for job in finished[:len(finished) - JOB_HISTORY]}
+            jobs = [job for job in jobs if job['id'] not in forgotten]
+        return jobs
+
+    def _append(self, records:list):
+        """Appends job records or changes to the log"""
+        lines = b''.join(json.dumps(record, separators=(',', ':')).encode() + b'\n' for record in records)
+        with write_lock(self.path):
+            with open(self.path, 'a+b') as f:
+                if f.seek(0, os.SEEK_END) > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        # After a line cut short by a crash, or the JSON list
+                        # written before the log
+                        lines = b'\n' + lines
+                f.write(lines)
+                size = f.tell()
+            if size >= LOG_COMPACTION_THRESHOLD:
+                durable_replace(self.path, b''.join(
+                    json.dumps(job, separators=(',', ':')).encode() + b'\n' for job in self._read()
+                ))
+
+    def _set(self, job:dict, **fields):
+        """Records the changed `fields` of `job`; returns its new record"""
+        self._append([dict(fields, id=job['id'])])
+        return dict(job, **fields)
+
+    def get(self, job_id:str):
+        """Returns the job record with the given id or None"""
+        for job in self._read():
+            if job['id'] == job_id:
+                return job
+        return None
+
+    def list(self):
+        """Returns every known job record, oldest first"""
+        return self._read()
+
+    ##################################################################
+    #                          Submitting
+    ##################################################################
+
+    def submit(self, kind:str, args:dict=None, key:str=None):
+        """
+        Records a new job and queues it, unless a job with the same `key`
+        waits in the queue of this process. Returns the job record.
+
+        Raises:
+            JobQueueFull: If the queue of this process is full.
+        """
+        self._check_kind(kind)
+        with self._held_lock:
+            if key is not None and key in self._held_keys:
+                # Not started yet, so it will see whatever the caller wrote
+                return dict(self._held[self._held_keys[key]])
+            if self._queue.full():
+                raise JobQueueFull(f"More than {self._queue.maxsize} jobs are queued")
+            job = self._new_job(kind, args, key)
+            self._append([job])
+            # Only put by threads holding _held_lock, so there is room
+            self._hold(job)
+        self._start_workers()
+        return dict(job)
+
+    def run_now(self, kind:str, args:dict=None, key:str=None):
+        """
+        Records a new job and runs it in the calling thread, bypassing the
+        queue. Returns its final record, so its id and result can be looked
+        up like those of any other job.
+        """
+        self._check_kind(kind)
+        job = self._new_job(kind, args, key)
+        self._append([job])
+        return self.run(job['id'], job)
+
+    @staticmethod
+    def _check_kind(kind:str):
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job kind: {kind}")
+
+    @staticmethod
+    def _new_job(kind:str, args:dict, key:str):
+        return {
+            "id": uuid.uuid4().hex, "kind": kind, "args": args or {}, "key": key,
+            "status": "queued", "owner": _owner(), "created": time.time(),
+            "started": None, "finished": None, "result": None, "error": None
+        }
+
+    def _hold(self, job:dict):
+        """Puts `job` in the queue of this process; called with _held_lock"""
+        self._held[job['id']] = job
+        if job['key'] is not None:
+            self._held_keys.setdefault(job['key'], job['id'])
+        self._queue.put_nowait(job['id'])
+
+    def _release(self, job_id:str):
+        """Forgets that `job_id` waits in the queue, as it starts; returns its record"""
+        with self._held_lock:
+            job = self._held.pop(job_id, None)
+            if job is not None and self._held_keys.get(job['key']) == job_id:
+                del self._held_keys[job['key']]
+            return job
+
+    def recover(self):
+        """
+        Queues again the pending jobs of processes that are gone, as many as
+        the queue of this process has room for; the others are left to them
+        for the next recover_jobs().
+        """
+        if not self.path.exists():
+            return 0
+
+        with self._held_lock, write_lock(self.path):
+            jobs = self._read()
+            room = self._queue.maxsize - self._queue.qsize() if self._queue.maxsize > 0 else len(jobs)
+            claimed = [
+                job for job in jobs if job['status'] in PENDING and not _owner_alive(job['owner'])
+            ][:room]
+            changes = {"status": 'queued', "owner": _owner(), "started": None}
+            if claimed:
+                self._append([dict(changes, id=job['id']) for job in claimed])
+            for job in claimed:
+                self._hold(dict(job, **changes))
+
+        if claimed:
+            logger.info(f"Recovered {len(claimed)} background job(s).")
+            self._start_workers()
+        return len(claimed)
+
+    def join(self):
+        """Blocks until every job queued by this process has run"""
+        self._queue.join()
+
+    ##################################################################
+    #                            Running
+    ##################################################################
+
+    def _start_workers(self):
+        with self._threads_lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='mindcanvas-job-worker', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self.run(job_id, self._release(job_id))
+            finally:
+                self._queue.task_done()
+
+    def run(self, job_id:str, job:dict=None):
+        """Runs the job `job_id` (whose record is `job`, if known) in the calling thread and records its outcome"""
+        job = job or self.get(job_id)
+        if job is None:
+            return None
+
+        job = self._set(job, status='running', owner=_owner(), started=time.time())
+        try:
+            result = JOB_HANDLERS[job['kind']](job)
+        except Exception as e:
+            logger.exception(f"Background job {job['kind']} {job_id} failed.")
+            return self._set(job, status='failed', finished=time.time(), error=f"{type(e).__name__}: {e}")
+        return self._set(job, status='done', finished=time.time(), result=result)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Returns the job queue of this process"""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(JOBS_FILE)
+        return _job_queue
+
+
+def submit_job(kind:str, args:dict=None, key:str=None, run_if_full:bool=True):
+    """
+    Submits a job to the queue of this process. If the queue is full and
+    `run_if_full` is set, the job runs in the calling thread instead;
+    otherwise JobQueueFull is raised.
+    """
+    job_queue = get_job_queue()
+    try:
+        return job_queue.submit(kind, args, key)
+    except JobQueueFull:
+        if not run_if_full:
+            raise
+
+    logger.warning(f"The job queue is full; running the {kind} job in the request.")
+    return job_queue.run_now(kind, args, key)
+
+
+def recover_jobs():
+    """Queues the jobs interrupted by the end of their process again"""
+    return get_job_queue().recover()
+
+
+######################################################################
+#                           Job handlers
+######################################################################
+# The storage modules import this one, so they are imported when needed.
+
+@job_handler('backup')
+def _backup(job):
+    from app.database import load_database
+    from app.backup import create_backup
+    from app.metrics import span
+
+    if 'storage' in job['args']:
+        # Queued by a write to the storage served by the app, whatever its backend
+        from app.database import get_storage
+        content = get_storage().load()
+    elif 'journal' in job['args']:
+        # A sharded journal, queued before every backend queued its backups
+        from app.sharding import ShardedStorage
+        content = ShardedStorage(job['args']['journal'], append_only=SHARD_APPEND_ONLY).load()
+    else:
+        content = load_database(job['args']['path'], copy=False)
+    with span('backup_write'):
+        return create_backup(content)
+
+
+@job_handler('collect_backup_garbage')
+def _collect_backup_garbage(job):
+    from app.backup import collect_garbage
+    collect_garbage()
+
+
+@job_handler('compact_journal')
+def _compact_journal(job):
+    from app.database import compact_journal
+    compact_journal(job['args']['path'])
+
+
+@job_handler('compact_container')
+def _compact_container(job):
+    from app.database import get_storage
+    storage = get_storage()
+    if hasattr(storage, 'compact'):
+        storage.compact()
+
+
+@job_handler('rebuild_search_index')
+def _rebuild_search_index(job):
+    from app.search import get_search_index
+    get_search_index().refresh()
+
+
+@job_handler('export')
+def _export(job):
+    from app.database import get_storage
+    from app.export import write_export_file
+    return write_export_file(job['id'], get_storage().iter_entries(), job['args']['format'], job['args']['gzip'])
+
+
+@job_handler('thumbnail')
+def _thumbnail(job):
+    from app.media import create_thumbnail, set_thumbnail
+    thumbnail = create_thumbnail(job['args']['hash'])
+    set_thumbnail(job['args']['entry_id'], job['args']['hash'], thumbnail)
+    return thumbnail
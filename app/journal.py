@@ -1,13 +1,41 @@
 import json
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
+from functools import lru_cache
 import pytz, uuid
 
+# Number of characters of the text shown in entry listings
+SNIPPET_LENGTH = 60
+
+
+@lru_cache(maxsize=65536)
+def parse_datetime(value:str):
+    """datetime.fromisoformat(value), parsed once per distinct string"""
+    return datetime.fromisoformat(value)
+
+
+# Indian Standard Time, the timezone of convert_utc_to_ist()
+IST = pytz.timezone('Asia/Kolkata')
+
+
+def _sort_key(value:datetime):
+    # Naive datetimes are in UTC by definition of the field
+    return value if value.tzinfo is not None else value.replace(tzinfo=pytz.utc)
+
+
+def _entry_key(entry):
+    # The order of JournalCollection
+    return (_sort_key(entry.datetime_utc), entry.id)
+
+
 class JournalEntry:
     """
     Represents a journal entry with attributes such as title, datetime, text, photos, and videos.
     """
 
-    def __init__(self, title:str, datetime_utc:datetime, text:str="", media_content=None, id:str=None):
+    __slots__ = ('_title', '_datetime_utc', '_text', '_media_content', '_id', '_revision')
+
+    def __init__(self, title:str, datetime_utc:datetime, text:str="", media_content=None, id:str=None, revision:int=0):
         """
         Initialize a JournalEntry instance.
 
@@ -16,12 +44,14 @@ class JournalEntry:
             datetime_utc (datetime): The datetime in UTC.
             text (str): The text content of the journal entry (optional).
             media_contents (list): A list of photo, videos filenames or URLs (optional).
+            revision (int): The database version that last wrote the entry (set by the storage).
         """
         self._title = title
         self._datetime_utc = datetime_utc
         self._text = text
         self._media_content = media_content or []
         self._id = id if id else str(uuid.uuid4())
+        self._revision = revision
 
     def convert_utc_to_ist(self):
         """
@@ -30,9 +60,19 @@ class JournalEntry:
         Returns:
             datetime: The datetime in IST.
         """
-        ist_timezone = pytz.timezone('Asia/Kolkata')
-        ist_datetime = self._datetime_utc.astimezone(ist_timezone)
-        return ist_datetime
+        return self.localize(IST)
+
+    def localize(self, tz):
+        """
+        Converts the UTC datetime to the timezone `tz`.
+
+        Args:
+            tz (tzinfo): The timezone, e.g. app.timeformat.get_timezone('Europe/Paris').
+
+        Returns:
+            datetime: The datetime in `tz`.
+        """
+        return _sort_key(self._datetime_utc).astimezone(tz)
 
 
     def __str__(self):
@@ -61,6 +101,34 @@ class JournalEntry:
     def id(self, new:str):
         self._id = new
 
+    @property
+    def revision(self):
+        return self._revision
+
+    @property
+    def title(self):
+        return self._title
+
+    @property
+    def datetime_utc(self):
+        return self._datetime_utc
+
+    @property
+    def text(self):
+        return self._text
+
+    @property
+    def media_content(self):
+        return self._media_content
+
+    @property
+    def snippet(self):
+        return self._text[:SNIPPET_LENGTH]
+
+    @property
+    def length(self):
+        return len(self._text)
+
     def to_dict(self):
         """
         Serialize the journal entry into a JSON representation.
@@ -73,7 +141,8 @@ class JournalEntry:
             "datetime_utc": self._datetime_utc.isoformat(),
             "text": self._text,
             "media_content": self._media_content,
-            "id":self._id
+            "id":self._id,
+            "revision": self._revision
         }
         return entry_data
     
@@ -89,19 +158,185 @@ class JournalEntry:
             JournalEntry: A new JournalEntry object.
         """
         title = data.get("title")
-        datetime_utc = datetime.fromisoformat(data.get("datetime_utc"))
+        datetime_utc = parse_datetime(data.get("datetime_utc"))
         text = data.get("text", "")
         media_content = data.get("media_content", [])
         _id = data.get("id")
+        revision = data.get("revision", 0)
         return cls(
             title=title,
             datetime_utc=datetime_utc,
             text=text,
             media_content=media_content,
-            id=_id
+            id=_id,
+            revision=revision
         )
 
 
+class LazyJournalEntry(JournalEntry):
+    """
+    A JournalEntry built from an entry summary (see JournalStorage.list_summaries()).
+
+    The title, datetime, snippet and length come from the summary; the text
+    and media content are only loaded, with `load(entry_id)`, when first
+    accessed.
+    """
+
+    __slots__ = ('_snippet', '_length', '_load', '_body')
+
+    def __init__(self, summary:dict, load):
+        """
+        Initialize a LazyJournalEntry instance.
+
+        Args:
+            summary (dict): The summary of the entry.
+            load (callable): Returns the entry dict of an id (e.g. JournalStorage.get_entry).
+        """
+        self._title = summary['title']
+        self._datetime_utc = parse_datetime(summary['datetime_utc'])
+        self._id = summary['id']
+        self._snippet = summary['snippet']
+        self._length = summary['length']
+        self._revision = summary.get('revision', 0)
+        self._load = load
+        self._body = None
+
+    def _get_body(self):
+        if self._body is None:
+            entry = self._load(self._id) or {}
+            self._body = {
+                "text": entry.get("text", ""),
+                "media_content": entry.get("media_content", [])
+            }
+        return self._body
+
+    @property
+    def _text(self):
+        return self._get_body()["text"]
+
+    @_text.setter
+    def _text(self, value:str):
+        self._get_body()["text"] = value
+        self._snippet, self._length = value[:SNIPPET_LENGTH], len(value)
+
+    @property
+    def _media_content(self):
+        return self._get_body()["media_content"]
+
+    @_media_content.setter
+    def _media_content(self, value:list):
+        self._get_body()["media_content"] = value
+
+    @property
+    def snippet(self):
+        return self._snippet
+
+    @property
+    def length(self):
+        return self._length
+
+
+class JournalCollection:
+    """
+    Journal entries sorted by (datetime_utc, id), with an id -> position
+    index. The id orders entries of the same datetime, so that a page cursor
+    made of both never skips or repeats one of them.
+
+    Ranges of dates are found by bisection and iterating newest first walks
+    the list backwards, so neither sorts nor copies the entries. A collection
+    is not modified once it is shared between threads; copy() it and swap
+    the copy in instead.
+    """
+
+    __slots__ = ('_entries', '_keys', '_positions')
+
+    def __init__(self, entries=()):
+        self._entries = sorted(entries, key=_entry_key)
+        self._keys = [_entry_key(entry) for entry in self._entries]
+        self._positions = {entry.id: i for i, entry in enumerate(self._entries)}
+
+    @classmethod
+    def from_dicts(cls, entries):
+        """Builds the collection from entry dicts (JournalEntry.to_dict())"""
+        return cls(JournalEntry.from_dict(entry) for entry in entries)
+
+    def copy(self):
+        collection = JournalCollection.__new__(JournalCollection)
+        collection._entries = list(self._entries)
+        collection._keys = list(self._keys)
+        collection._positions = dict(self._positions)
+        return collection
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        """Oldest first"""
+        return iter(self._entries)
+
+    def __reversed__(self):
+        """Newest first"""
+        return reversed(self._entries)
+
+    def __contains__(self, entry_id:str):
+        return entry_id in self._positions
+
+    def get(self, entry_id:str):
+        """Returns the entry with the given id or None"""
+        position = self._positions.get(entry_id)
+        return None if position is None else self._entries[position]
+
+    def between(self, start:datetime=None, end:datetime=None):
+        """Returns the entries with start <= datetime_utc < end, oldest first"""
+        # A 1-tuple sorts before every key of the same datetime
+        low = 0 if start is None else bisect_left(self._keys, (_sort_key(start),))
+        high = len(self._keys) if end is None else bisect_left(self._keys, (_sort_key(end),))
+        return self._entries[low:high]
+
+    def page(self, offset:int=0, limit:int=None, before:str=None, before_id:str=None):
+        """
+        Returns a page of entries, newest first.
+
+        Args:
+            offset (int): Number of entries to skip.
+            limit (int): Maximum number of entries to return (None for all).
+            before (str): Only entries older than this ISO timestamp.
+            before_id (str): With `before`, also the entries of that very
+                timestamp whose id sorts before this one.
+        """
+        high = len(self._keys)
+        if before is not None:
+            cursor = (_sort_key(parse_datetime(before)),) if before_id is None else \
+                (_sort_key(parse_datetime(before)), before_id)
+            high = bisect_left(self._keys, cursor)
+        high -= offset
+        low = 0 if limit is None else max(high - limit, 0)
+        return [self._entries[i] for i in range(high - 1, low - 1, -1)]
+
+    def add(self, entry:JournalEntry):
+        """Inserts `entry`, replacing the entry with the same id if any"""
+        self.remove(entry.id)
+        key = _entry_key(entry)
+        position = bisect_right(self._keys, key)
+        self._entries.insert(position, entry)
+        self._keys.insert(position, key)
+        self._reindex(position)
+
+    def remove(self, entry_id:str):
+        """Removes the entry with the given id, if any"""
+        position = self._positions.pop(entry_id, None)
+        if position is None:
+            return
+        del self._entries[position]
+        del self._keys[position]
+        self._reindex(position)
+
+    def _reindex(self, start:int):
+        # Only the entries after `start` moved; adding today's entry moves none
+        for i in range(start, len(self._entries)):
+            self._positions[self._entries[i].id] = i
+
+
 # Example usage:
 if __name__ == "__main__":
     utc_datetime = datetime(2023, 10, 3, 12, 0, 0, tzinfo=pytz.utc)
@@ -0,0 +1,102 @@
+# app/keys.py
+#
+# Management of the Fernet keys protecting the journal at rest.
+#
+# FERNET_FILE holds one key per line, the first one being the primary key
+# used for encryption; the others are only used to decrypt data that has not
+# been re-encrypted yet. The keys are read once per process and only read
+# again when the file changes on disk (e.g. after a rotation run from
+# another process).
+
+from config import FERNET_FILE
+from cryptography.fernet import Fernet, MultiFernet
+from app.metrics import span
+import os, tempfile, threading, logging
+
+logger = logging.getLogger(__name__)
+
+_cipher = None
+_cipher_signature = None
+_cipher_lock = threading.Lock()
+
+
+def _key_file_signature():
+    st = os.stat(FERNET_FILE)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def read_keys():
+    """Returns the keys stored in FERNET_FILE, primary key first"""
+    with open(FERNET_FILE, 'rb') as f:
+        return [line.strip() for line in f.read().splitlines() if line.strip()]
+
+
+def get_cipher():
+    """
+    Returns the MultiFernet built from FERNET_FILE. It is shared by the whole
+    process and costs a single `os.stat` per call once loaded.
+    """
+    global _cipher, _cipher_signature
+    signature = _key_file_signature()
+    with _cipher_lock:
+        if _cipher is None or signature != _cipher_signature:
+            with span('key_read'):
+                _cipher = MultiFernet([Fernet(key) for key in read_keys()])
+            _cipher_signature = signature
+        return _cipher
+
+
+def _write_keys(keys:list):
+    fd, temp_path = tempfile.mkstemp(prefix=FERNET_FILE.name + '.', dir=FERNET_FILE.parent)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b'\n'.join(keys) + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(temp_path, 0o600)
+    os.replace(temp_path, FERNET_FILE)
+
+
+def rotate_key(background:bool=True):
+    """
+    Makes a freshly generated key the primary key and re-encrypts every
+    stored token (journal, backups, exports, media and statistics) with it. Until the re-encryption is done the old keys are
+    kept for decryption, so the app keeps serving throughout; afterwards
+    they are retired.
+
+    Args:
+        background (bool): Re-encrypt in a background thread.
+
+    Returns:
+        threading.Thread or None: The re-encryption thread, if any.
+    """
+    old_keys = read_keys()
+    _write_keys([Fernet.generate_key()] + old_keys)
+    logger.info("Generated a new primary Fernet key.")
+
+    if not background:
+        _reencrypt_and_retire(old_keys)
+        return None
+
+    thread = threading.Thread(target=_reencrypt_and_retire, args=(old_keys,), daemon=True)
+    thread.start()
+    return thread
+
+
+def _reencrypt_and_retire(old_keys:list):
+    # Imported here as the storage modules depend on this one
+    from app.database import get_storage
+    from app.backup import reencrypt_backups
+    from app.export import reencrypt_exports
+    from app.media import reencrypt_media
+    from app.statistics import get_statistics
+
+    cipher = get_cipher()
+    get_storage().reencrypt(cipher)
+    reencrypt_backups(cipher)
+    reencrypt_exports(cipher)
+    reencrypt_media(cipher)
+    get_statistics().reencrypt(cipher)
+
+    # Nothing is encrypted with the old keys any more
+    _write_keys([key for key in read_keys() if key not in old_keys])
+    logger.info(f"Re-encrypted the journal and retired {len(old_keys)} old key(s).")
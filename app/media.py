@@ -0,0 +1,352 @@
+# app/media.py
+#
+# Content-addressed, encrypted store of the media attached to entries.
+#
+# Every blob is stored once, whatever the number of entries referring to
+# it, under MEDIA_DIR/objects/<first two hex digits>/<sha256 of its content>:
+#
+#     MCMEDIA/1 <chunk size> <size>\n          (plaintext header)
+#     <Fernet token of chunk 0>\n
+#     <Fernet token of chunk 1>\n
+#     ...
+#
+# Each chunk holds `chunk size` bytes of the content, the last one the rest.
+# The tokens of full chunks all have the same length, so the chunk holding
+# any byte offset is found by arithmetic and a byte range is served by
+# decrypting only the chunks it covers, one at a time.
+#
+# An entry refers to its media through its media_content list, whose items
+# are {"hash", "filename", "content_type", "size", "thumbnail"}; older
+# entries may hold plain file names or URLs instead.
+#
+# Thumbnails of images are made by a pool of processes (MEDIA_THUMBNAIL_WORKERS)
+# so the image work never holds the GIL of the request threads. They need
+# the optional Pillow package and are stored as blobs too.
+
+from config import MEDIA_DIR, MEDIA_CHUNK_SIZE, MAX_MEDIA_SIZE, MEDIA_THUMBNAIL_SIZE, MEDIA_THUMBNAIL_WORKERS
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.fernet import MultiFernet
+from app.database import get_storage, write_lock
+from app.jobs import submit_job
+from app.keys import get_cipher
+import hashlib, io, math, mimetypes, multiprocessing, os, re, tempfile, threading
+
+try:
+    import PIL
+except ImportError:
+    PIL = None
+
+OBJECTS_DIR = MEDIA_DIR / 'objects'
+HEADER_MAGIC = b'MCMEDIA/1 '
+
+# Width of the size field of the header, which is written before the size is known
+_SIZE_DIGITS = 15
+
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Larger images get no thumbnail, as they are decoded in memory
+THUMBNAIL_MAX_SOURCE_SIZE = 50 * 1024 * 1024
+
+
+class MediaTooLargeError(ValueError):
+    """The upload is larger than MAX_MEDIA_SIZE."""
+
+
+def _token_length(chunk_size:int):
+    """Length of the Fernet token of `chunk_size` bytes (fixed by the Fernet spec)"""
+    # version + timestamp + IV + padded AES-CBC ciphertext + HMAC, base64 encoded
+    raw_length = 1 + 8 + 16 + (chunk_size // 16 + 1) * 16 + 32
+    return 4 * math.ceil(raw_length / 3)
+
+
+def blob_path(digest:str):
+    """Path of the blob `digest`; raises ValueError for anything but a sha256 hex digest"""
+    if not _DIGEST_RE.match(digest):
+        raise ValueError(f"Invalid media hash: {digest}")
+    return OBJECTS_DIR / digest[:2] / digest
+
+
+def has_blob(digest:str):
+    return blob_path(digest).exists()
+
+
+def store_stream(stream, max_size:int=MAX_MEDIA_SIZE, chunk_size:int=MEDIA_CHUNK_SIZE):
+    """
+    Encrypts the binary file object `stream` chunk by chunk into the store,
+    never holding more than one chunk in memory.
+
+    Returns:
+        tuple: (sha256 hex digest, size in bytes)
+
+    Raises:
+        MediaTooLargeError: If the stream is longer than `max_size`.
+    """
+    OBJECTS_DIR.mkdir(parents=True, exist_ok=True)
+    fer = get_cipher()
+    sha256 = hashlib.sha256()
+    size = 0
+
+    fd, temp_path = tempfile.mkstemp(prefix='upload.', suffix='.tmp', dir=OBJECTS_DIR)
+    try:
+        with os.fdopen(fd, 'w+b') as f:
+            header = HEADER_MAGIC + f'{chunk_size} '.encode()
+            f.write(header + b'0' * _SIZE_DIGITS + b'\n')
+            for chunk in _read_chunks(stream, chunk_size):
+                size += len(chunk)
+                if size > max_size:
+                    raise MediaTooLargeError(f"The upload is larger than {max_size} bytes")
+                sha256.update(chunk)
+                f.write(fer.encrypt(chunk) + b'\n')
+
+            # Now that the size is known, fill it in
+            f.seek(len(header))
+            f.write(str(size).zfill(_SIZE_DIGITS).encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+        digest = sha256.hexdigest()
+        path = blob_path(digest)
+        # Published under the lock of the store, so that a key rotation
+        # either re-encrypts the blob or came first; in that case the blob
+        # is re-encrypted with the new primary key here
+        with write_lock(OBJECTS_DIR):
+            if path.exists():
+                # Already stored, e.g. the same photo attached to another entry
+                os.remove(temp_path)
+            else:
+                current = get_cipher()
+                if current is not fer:
+                    _rotate_blob(temp_path, current, old_cipher=fer)
+                path.parent.mkdir(exist_ok=True)
+                os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return digest, size
+
+
+def store_bytes(content:bytes):
+    """Stores `content`; returns (digest, size)"""
+    return store_stream(io.BytesIO(content))
+
+
+def _read_chunks(stream, chunk_size:int):
+    """Yields chunks of exactly `chunk_size` bytes (the last one may be shorter)"""
+    buffer = bytearray()
+    while True:
+        data = stream.read(chunk_size - len(buffer))
+        if not data:
+            break
+        buffer += data
+        if len(buffer) == chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+class MediaBlob:
+    """Random access to the content of a stored blob."""
+
+    def __init__(self, digest:str):
+        self.digest = digest
+        self.path = blob_path(digest)
+        with open(self.path, 'rb') as f:
+            header = f.readline()
+        if not header.startswith(HEADER_MAGIC):
+            raise ValueError(f"Not a media blob: {digest}")
+        chunk_size, size = header[len(HEADER_MAGIC):].split()
+        self.chunk_size = int(chunk_size)
+        self.size = int(size)
+        self._data_offset = len(header)
+        self._token_length = _token_length(self.chunk_size)
+
+    def iter_range(self, start:int=0, end:int=None, fer:MultiFernet=None):
+        """Yields the bytes start..end (inclusive; default: to the end) of the content"""
+        end = self.size - 1 if end is None else min(end, self.size - 1)
+        if start > end:
+            return
+
+        fer = fer or get_cipher()
+        first, last = start // self.chunk_size, end // self.chunk_size
+        with open(self.path, 'rb') as f:
+            f.seek(self._data_offset + first * (self._token_length + 1))
+            for index in range(first, last + 1):
+                chunk = fer.decrypt(f.readline().rstrip(b'\n'))
+                chunk_start = index * self.chunk_size
+                yield chunk[max(start - chunk_start, 0):end - chunk_start + 1]
+
+    def read(self):
+        """The whole content; only for small blobs such as images"""
+        return b''.join(self.iter_range())
+
+
+def reencrypt_media(cipher:MultiFernet):
+    """
+    Re-encrypts every blob with the primary key of `cipher`, under the lock
+    of the store so that no upload publishes a blob encrypted with an older
+    key meanwhile.
+    """
+    if not OBJECTS_DIR.exists():
+        return
+    with write_lock(OBJECTS_DIR):
+        for directory in list(OBJECTS_DIR.iterdir()):
+            if not directory.is_dir():
+                continue
+            for path in list(directory.iterdir()):
+                if not path.name.endswith('.tmp'):
+                    _rotate_blob(path, cipher)
+
+
+def _rotate_blob(path, cipher:MultiFernet, old_cipher:MultiFernet=None):
+    """
+    Re-encrypts the blob file at `path` with the primary key of `cipher`,
+    decrypting it with `old_cipher` if its key may be retired already.
+    """
+    # Rotating keeps the token lengths, so offsets stay valid
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+    with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+        dst.write(src.readline())
+        for line in src:
+            token = line.rstrip(b'\n')
+            token = cipher.rotate(token) if old_cipher is None else cipher.encrypt(old_cipher.decrypt(token))
+            dst.write(token + b'\n')
+    os.replace(temp_path, path)
+
+
+def media_item(digest:str, size:int, filename:str, content_type:str=None):
+    """The media_content item of an entry referring to a stored blob"""
+    return {
+        "hash": digest,
+        "filename": filename,
+        "content_type": content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        "size": size,
+        "thumbnail": None
+    }
+
+
+######################################################################
+#                        Attaching to entries
+######################################################################
+
+def find_media_item(entry:dict, digest:str):
+    """The media_content item of `entry` referring to `digest`, or None"""
+    for item in entry.get('media_content', []):
+        if isinstance(item, dict) and item.get('hash') == digest:
+            return item
+    return None
+
+
+def attach_media(entry_id:str, stream, filename:str, content_type:str=None, storage=None):
+    """
+    Stores the uploaded `stream` and appends it to the media_content of the
+    entry, then queues the creation of its thumbnail.
+
+    Returns:
+        dict: The media item, or None if the entry doesn't exist.
+    """
+    storage = storage or get_storage()
+    if storage.get_entry(entry_id) is None:
+        return None
+
+    digest, size = store_stream(stream)
+    with storage.write_lock():
+        entry = storage.get_entry(entry_id)
+        if entry is None:
+            return None
+        item = find_media_item(entry, digest)
+        if item is not None:
+            # Attached already
+            return item
+        item = media_item(digest, size, os.path.basename(filename), content_type)
+        entry['media_content'] = list(entry.get('media_content', [])) + [item]
+        storage.update(entry)
+
+    if thumbnails_supported(item['content_type']) and size <= THUMBNAIL_MAX_SOURCE_SIZE:
+        submit_job('thumbnail', {"entry_id": entry_id, "hash": digest}, key=f'thumbnail:{entry_id}:{digest}')
+    return item
+
+
+def detach_media(entry_id:str, digest:str, storage=None):
+    """
+    Removes the media `digest` from the entry. The blob itself stays, as
+    other entries or backups may refer to it.
+
+    Returns:
+        bool: Whether the entry referred to it.
+    """
+    storage = storage or get_storage()
+    with storage.write_lock():
+        entry = storage.get_entry(entry_id)
+        if entry is None or find_media_item(entry, digest) is None:
+            return False
+        entry['media_content'] = [
+            item for item in entry['media_content']
+            if not (isinstance(item, dict) and item.get('hash') == digest)
+        ]
+        storage.update(entry)
+    return True
+
+
+def set_thumbnail(entry_id:str, digest:str, thumbnail:str, storage=None):
+    """Records `thumbnail` as the thumbnail of the media `digest` of the entry"""
+    storage = storage or get_storage()
+    with storage.write_lock():
+        entry = storage.get_entry(entry_id)
+        item = None if entry is None else find_media_item(entry, digest)
+        if item is None or item.get('thumbnail') == thumbnail:
+            return
+        item['thumbnail'] = thumbnail
+        storage.update(entry)
+
+
+######################################################################
+#                            Thumbnails
+######################################################################
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def thumbnails_supported(content_type:str):
+    return PIL is not None and content_type.startswith('image/')
+
+
+def make_thumbnail(image:bytes, size:tuple=MEDIA_THUMBNAIL_SIZE):
+    """Returns a JPEG thumbnail of `image`; runs in the worker processes"""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(image)) as picture:
+        picture = ImageOps.exif_transpose(picture)
+        picture.thumbnail(size)
+        output = io.BytesIO()
+        picture.convert('RGB').save(output, format='JPEG', quality=85)
+        return output.getvalue()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned rather than forked: this process runs request and job
+            # threads, and a fork copies the locks they hold. The workers
+            # import the app package again, which only sets up the app in
+            # the main process (see app/__init__.py)
+            _pool = ProcessPoolExecutor(max_workers=MEDIA_THUMBNAIL_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def create_thumbnail(digest:str):
+    """
+    Makes the thumbnail of the image blob `digest` in the process pool and
+    stores it. Blocks the calling thread (a job worker) until it is done.
+
+    Returns:
+        str: The digest of the thumbnail.
+    """
+    image = MediaBlob(digest).read()
+    thumbnail = _get_pool().submit(make_thumbnail, image).result()
+    return store_bytes(thumbnail)[0]
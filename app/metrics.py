@@ -0,0 +1,268 @@
+# app/metrics.py
+#
+# Timing instrumentation, exposed in the Prometheus text format at /metrics.
+#
+# Three histograms are kept:
+#
+#     mindcanvas_request_duration_seconds{method, endpoint, status}
+#     mindcanvas_template_render_seconds{template}
+#     mindcanvas_span_seconds{span}
+#
+# Spans time the steps inside a request, e.g. reading the key file,
+# decrypting or writing the database; wrap any block in `with span(name):`
+# to add one. With METRICS_JSON_LOG set, every request is also logged as one
+# JSON line holding its duration and the total time spent in each span.
+#
+# The histograms live in the memory of each process. Under gunicorn, set
+# METRICS_DIR and every worker publishes its histograms there (at most once
+# per METRICS_PUBLISH_INTERVAL seconds), so that whichever worker answers
+# the scrape reports the sum over all of them.
+
+from config import METRICS_ENABLED, METRICS_JSON_LOG, METRICS_DIR, METRICS_PUBLISH_INTERVAL
+from contextlib import contextmanager
+from flask import g, request, has_app_context, before_render_template, template_rendered
+from pathlib import Path
+import bisect, json, logging, os, tempfile, threading, time
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Distribution of durations (in seconds), one series per combination of
+    label values. Thread-safe.
+    """
+
+    def __init__(self, name:str, help:str, labels:tuple, buckets:tuple=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}   # label values -> [count per bucket..., count above the last bucket, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value:float, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        """The series as a JSON-serializable list of [label values, counts..., sum]"""
+        with self._lock:
+            return [[list(label_values)] + series for label_values, series in self._series.items()]
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+REQUEST_SECONDS = Histogram(
+    'mindcanvas_request_duration_seconds',
+    'Time spent handling a request, until the response starts.',
+    ('method', 'endpoint', 'status')
+)
+TEMPLATE_SECONDS = Histogram(
+    'mindcanvas_template_render_seconds',
+    'Time spent rendering a template.',
+    ('template',)
+)
+SPAN_SECONDS = Histogram(
+    'mindcanvas_span_seconds',
+    'Time spent in a step of the request, e.g. decrypting the database.',
+    ('span',)
+)
+
+HISTOGRAMS = [REQUEST_SECONDS, TEMPLATE_SECONDS, SPAN_SECONDS]
+
+
+def _record_span(name:str, elapsed:float):
+    SPAN_SECONDS.observe(elapsed, name)
+    if has_app_context():
+        spans = g.setdefault('metrics_spans', {})
+        spans[name] = spans.get(name, 0.0) + elapsed
+
+
+@contextmanager
+def span(name:str):
+    """Times the enclosed block as the span `name`"""
+    if not METRICS_ENABLED:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_span(name, time.perf_counter() - start)
+
+
+######################################################################
+#                     Request and template timing
+######################################################################
+
+_request_logger = None
+
+
+def _get_request_logger():
+    """The logger writing one JSON line per request to METRICS_JSON_LOG"""
+    global _request_logger
+    if _request_logger is None:
+        logger = logging.getLogger(__name__ + '.requests')
+        handler = logging.FileHandler(METRICS_JSON_LOG, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False  # Keep the JSON lines out of app.log
+        _request_logger = logger
+    return _request_logger
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_spans = {}
+
+
+def _after_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+
+    # The endpoint rather than the path keeps entry ids out of the labels
+    endpoint = request.endpoint or 'unmatched'
+    REQUEST_SECONDS.observe(elapsed, request.method, endpoint, str(response.status_code))
+
+    if METRICS_JSON_LOG:
+        _get_request_logger().info(json.dumps({
+            "time": time.time(),
+            "pid": os.getpid(),
+            "method": request.method,
+            "endpoint": endpoint,
+            "path": request.path,
+            "status": response.status_code,
+            "duration_ms": round(elapsed * 1000, 3),
+            "spans_ms": {name: round(seconds * 1000, 3) for name, seconds in g.get('metrics_spans', {}).items()}
+        }))
+
+    if METRICS_DIR:
+        publish()
+    return response
+
+
+def _before_render_template(sender, template, context, **extra):
+    g.setdefault('metrics_render_starts', []).append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    starts = g.get('metrics_render_starts')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    TEMPLATE_SECONDS.observe(elapsed, template.name or 'string')
+    _record_span('render_template', elapsed)
+
+
+def instrument_app(app):
+    """Registers the request and template timing hooks on `app`"""
+    if not METRICS_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+
+
+######################################################################
+#                    Publishing and exposition
+######################################################################
+
+_last_publish = 0.0
+
+
+def _snapshot():
+    return {histogram.name: histogram.snapshot() for histogram in HISTOGRAMS}
+
+
+def publish(force:bool=False):
+    """Writes the histograms of this process to METRICS_DIR/<pid>.json"""
+    global _last_publish
+    now = time.monotonic()
+    if not force and now - _last_publish < METRICS_PUBLISH_INTERVAL:
+        return
+    _last_publish = now
+
+    metrics_dir = Path(METRICS_DIR)
+    metrics_dir.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=f'{os.getpid()}.', suffix='.tmp', dir=metrics_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(_snapshot(), f)
+    os.replace(temp_path, metrics_dir / f'{os.getpid()}.json')
+
+
+def collect():
+    """
+    Returns {histogram name: {label values: [counts..., sum]}} for this
+    process, plus the other processes that published to METRICS_DIR.
+    """
+    snapshots = [_snapshot()]
+    if METRICS_DIR and Path(METRICS_DIR).exists():
+        own_file = f'{os.getpid()}.json'
+        for path in Path(METRICS_DIR).glob('*.json'):
+            if path.name == own_file:
+                continue
+            try:
+                snapshots.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                # Being replaced right now; it will be there on the next scrape
+                continue
+
+    merged = {histogram.name: {} for histogram in HISTOGRAMS}
+    for snapshot in snapshots:
+        for name, series_list in snapshot.items():
+            if name not in merged:
+                continue
+            for series in series_list:
+                label_values, values = tuple(series[0]), series[1:]
+                total = merged[name].get(label_values)
+                if total is None:
+                    merged[name][label_values] = list(values)
+                else:
+                    merged[name][label_values] = [a + b for a, b in zip(total, values)]
+    return merged
+
+
+def _format_labels(names, values, le:str=None):
+    pairs = [(name, str(value)) for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(('le', le))
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + '}'
+
+
+def _escape_label_value(value:str):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def render_prometheus():
+    """The collected histograms in the Prometheus text exposition format"""
+    merged = collect()
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.append(f'# HELP {histogram.name} {histogram.help}')
+        lines.append(f'# TYPE {histogram.name} histogram')
+        for label_values, values in sorted(merged[histogram.name].items()):
+            counts, total = values[:-1], values[-1]
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, counts):
+                cumulative += count
+                lines.append(f'{histogram.name}_bucket{_format_labels(histogram.labels, label_values, repr(bound))} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{histogram.name}_bucket{_format_labels(histogram.labels, label_values, "+Inf")} {cumulative}')
+            lines.append(f'{histogram.name}_sum{_format_labels(histogram.labels, label_values)} {total}')
+            lines.append(f'{histogram.name}_count{_format_labels(histogram.labels, label_values)} {cumulative}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,51 @@
+# app/pagination.py
+#
+# Parsing of the paging query parameters shared by the listing routes and
+# the api blueprint.
+
+from datetime import datetime
+from config import ENTRIES_PER_PAGE, MAX_ENTRIES_PER_PAGE
+
+
+class PageArgs:
+    """
+    The paging options of a request:
+        ?page=<n>&per_page=<n>  offset based paging, 1-indexed
+        ?before=<iso datetime>  cursor based paging, entries older than it
+        &before_id=<entry id>   and the entries of that datetime whose id
+                                sorts before it (the cursor of the next page
+                                is the datetime and id of the last entry)
+    """
+
+    def __init__(self, page:int=1, per_page:int=ENTRIES_PER_PAGE, before:str=None, before_id:str=None):
+        self.page = page
+        self.per_page = per_page
+        self.before = before
+        self.before_id = before_id if before is not None else None
+
+    @property
+    def offset(self):
+        # A cursor already positions the page
+        return 0 if self.before is not None else (self.page - 1) * self.per_page
+
+    @classmethod
+    def from_request_args(cls, args):
+        """Builds the PageArgs from `request.args`, clamping invalid values"""
+        page = args.get('page', 1, type=int) or 1
+        per_page = args.get('per_page', ENTRIES_PER_PAGE, type=int) or ENTRIES_PER_PAGE
+
+        before = args.get('before')
+        if before is not None:
+            try:
+                # Normalise the cursor so that it compares with stored datetime_utc
+                # values; an unescaped '+' of the UTC offset arrives as a space
+                before = datetime.fromisoformat(before.replace(' ', '+')).isoformat()
+            except ValueError:
+                before = None
+
+        return cls(
+            page=max(page, 1),
+            per_page=min(max(per_page, 1), MAX_ENTRIES_PER_PAGE),
+            before=before,
+            before_id=args.get('before_id') or None
+        )
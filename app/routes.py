@@ -10,15 +10,23 @@ Attributes:
     app (Flask): The Flask web application instance.
 """
 
-from flask import render_template, request, redirect, url_for, flash, session
+from flask import render_template, request, redirect, url_for, flash, session, Response
 from app import app
 from datetime import datetime
-import pytz, logging
-from app.journal import JournalEntry
+import calendar, pytz, logging
+from app.journal import JournalEntry, LazyJournalEntry
 from app.database import *
+from app.backup import is_snapshot_id, list_backups, load_backup, delete_backups_before
+from app.pagination import PageArgs
+from app.search import get_search_index
+from app.archive import get_date_index, local_range
+from app.metrics import render_prometheus, PROMETHEUS_CONTENT_TYPE
+from app.caching import fragment_cache, conditional_on_database
+from app.timeformat import DEFAULT_FORMAT, display_timezone, format_datetime, format_datetimes, format_timestamp, is_valid_timezone
+from markupsafe import Markup
 from config import *
 from werkzeug.routing import UUIDConverter
-from app.authentication import user_login_successful, save_new_admin_credentials, generate_token, admin_login_required
+from app.authentication import user_login_successful, save_new_admin_credentials, save_admin_preferences, generate_token, admin_login_required, request_authorized
 
 # Create a logger for the routes module
 logger = logging.getLogger(__name__)
@@ -103,48 +111,145 @@ def upload_database():
     return render_template('upload_database.html')
     
 
-# Define a custom Jinja2 filter to format datetime to IST
+# Define a custom Jinja2 filter to format datetime in the display timezone
 @app.template_filter('datetimeformat')
-def datetimeformat(value:str, format='%b %d, %Y %I:%M:%S %p %Z'):
+def datetimeformat(value:str, format=DEFAULT_FORMAT):
     """
-    Custom Jinja2 filter to format a datetime object to a specified format.
-    Default format is '%Y-%m-%d %H:%M:%S %Z'.
+    Custom Jinja2 filter to format a datetime object to a specified format,
+    in the display timezone (see app/timeformat.py).
+    Default format is '%b %d, %Y %I:%M:%S %p %Z'.
 
     Args:
-        value (datetime): The datetime object to format.
+        value (datetime | str): The datetime object, or its ISO format, to format.
         format (str, optional): The desired format. Defaults to '%b %d, %Y %I:%M:%S %p %Z'.
 
     Returns:
         str: The formatted datetime as a string.
     """
-    # Convert the datetime to IST
-    ist_timezone = pytz.timezone('Asia/Kolkata')
-    dt_time_val = datetime.fromisoformat(value)
-    ist_datetime = dt_time_val.astimezone(ist_timezone)
+    return format_datetime(value, format)
+
+
+@app.template_global()
+def render_entry_card(entry:JournalEntry, local_datetime:str=None):
+    """
+    entry_card.html for `entry`, rendered once per revision of the entry and
+    display timezone. `local_datetime` is its datetime formatted already.
+    """
+    return Markup(fragment_cache.get_or_render(
+        ('entry_card', entry.id, entry.revision, display_timezone()),
+        lambda: render_template('entry_card.html', entry=entry, local_datetime=local_datetime)
+    ))
 
-    return ist_datetime.strftime(format)
 
 @app.route('/view_entries')
 @admin_login_required
+@conditional_on_database
 def view_entries():
-    # Load journal entries from the JSON database file
-    entries = load_database(JOURNAL_JSON_DB_PATH)['entries']
-
-    # Reverse the entries to get last added entries first.
-    entries = entries[::-1] # list of dicts
-    total_entries = len(entries)
+    storage = get_storage()
+    page_args = PageArgs.from_request_args(request.args)
+
+    # Load only the summaries of the requested page, last added entries first.
+    # The cards only show the snippet, so the entry texts are never loaded.
+    summaries = storage.list_summaries(
+        offset=page_args.offset,
+        limit=page_args.per_page,
+        before=page_args.before,
+        before_id=page_args.before_id
+    ) # list of dicts
+    entries = [LazyJournalEntry(summary, load=storage.get_entry) for summary in summaries]
+    total_entries = storage.count()
+
+    # Format the datetimes of the whole page in one go
+    local_datetimes = format_datetimes(entry.datetime_utc for entry in entries)
+
+    # Cursor of the next page, if there is one
+    next_cursor = summaries[-1] if len(summaries) == page_args.per_page else None
 
     logger.info('Visited the view_entries route.')
-    return render_template('view_entries.html', entries=entries, total_entries=total_entries)
+    return render_template(
+        'view_entries.html',
+        entries=zip(entries, local_datetimes),
+        total_entries=total_entries,
+        page_args=page_args,
+        next_cursor=next_cursor
+    )
+
+
+@app.route('/search')
+@admin_login_required
+@conditional_on_database
+def search():
+    query = request.args.get('q', '').strip()
+    page_args = PageArgs.from_request_args(request.args)
+
+    total, results = 0, []
+    if query:
+        total, results = get_search_index().search(
+            query,
+            offset=(page_args.page - 1) * page_args.per_page,
+            limit=page_args.per_page
+        )
+
+    logger.info('Searched the journal entries.')
+    return render_template('search.html', query=query, total=total, results=results, page_args=page_args)
+
+
+@app.route('/archive/')
+@admin_login_required
+@conditional_on_database
+def archive():
+    # The number of entries of every year and month, from the date index
+    index = get_date_index()
+    years = [(year, total, index.months(year)) for year, total in index.years().items()]
+
+    logger.info('Visited the archive.')
+    return render_template('archive.html', years=years, month_names=calendar.month_name)
+
+
+@app.route('/archive/<int:year>/<int:month>')
+@admin_login_required
+@conditional_on_database
+def archive_month(year, month):
+    try:
+        start, end = local_range(year, month)
+    except (ValueError, OverflowError):
+        return "Month not found", 404
+
+    storage = get_storage()
+    index = get_date_index()
+    page_args = PageArgs.from_request_args(request.args)
+    offset = (page_args.page - 1) * page_args.per_page
+
+    # The ids of the month come from the date index, newest first; only the
+    # summaries of the page are read from the storage
+    entry_ids = index.between(start, end)
+    total_entries = len(entry_ids)
+    summaries = storage.get_summaries(entry_ids[offset:offset + page_args.per_page])
+    entries = [LazyJournalEntry(summary, load=storage.get_entry) for summary in summaries]
+    local_datetimes = format_datetimes(entry.datetime_utc for entry in entries)
+
+    previous_month = (year, month - 1) if month > 1 else (year - 1, 12)
+    next_month = (year, month + 1) if month < 12 else (year + 1, 1)
+
+    logger.info('Visited the archive of a month.')
+    return render_template(
+        'archive_month.html',
+        year=year,
+        month=month,
+        month_name=calendar.month_name[month],
+        weeks=calendar.monthcalendar(year, month),
+        day_counts=index.days(year, month),
+        entries=zip(entries, local_datetimes),
+        total_entries=total_entries,
+        page_args=page_args,
+        previous_month=previous_month,
+        next_month=next_month
+    )
 
 
 @app.route('/add_entry', methods=['GET', 'POST'])
 @admin_login_required
 def add_entry():
-    # Create the JSON database file if it doesn't exist
-    if not JOURNAL_JSON_DB_PATH.exists():
-        create_blank_db(json_filepath=JOURNAL_JSON_DB_PATH)
-
     if request.method == 'POST':
         # Get data from the form
         title = request.form.get('title')
@@ -154,13 +259,8 @@ def add_entry():
         utc_datetime = datetime.utcnow().replace(tzinfo=pytz.utc)
         entry = JournalEntry(title=title, datetime_utc=utc_datetime, text=text)
         
-        entries = load_database(JOURNAL_JSON_DB_PATH)['entries']
-
-        # Append the new entry to the existing entries
-        entries.append(entry.to_dict())
-
-        # Save the updated entries back to the JSON database
-        save_database(data={"entries":entries}, outputFileName=JOURNAL_JSON_DB_PATH)
+        # Save the new entry to the storage
+        get_storage().add(entry.to_dict())
 
         # Log it
         logger.info('Added a new JournalEntry!')
@@ -178,53 +278,40 @@ def add_entry():
 
 
 @app.route('/view_entry/<uuid:entry_id>')
+@conditional_on_database
 def view_entry(entry_id):
-    # Retrieve the journal entry with the specified entry_id from your data source
-    # Create the JSON database file if it doesn't exist
-    if not JOURNAL_JSON_DB_PATH.exists():
-        create_blank_db(json_filepath=JOURNAL_JSON_DB_PATH)
-
-    # Load journal entries from the JSON database file
-    entries_data = load_database(JOURNAL_JSON_DB_PATH)
-    entries = entries_data['entries']
-
-    # Check if the entry_id is valid
-    entry = None
-    for journal_entry in entries:
-        if journal_entry.get('id') == str(entry_id):
-            entry = journal_entry
-            break
+    # Retrieve the journal entry with the specified entry_id from the storage
+    entry = get_storage().get_entry(str(entry_id))
 
     if entry is None:
         # Handle the case when the entry with the given ID does not exist
         return "Entry not found", 404
 
     logger.info('Viewed one JournalEntry!')
-    return render_template('view_entry.html', entry=entry, entry_id=entry_id)
+    # Only the part every viewer sees alike is cached; the media endpoints
+    # take the admin session, so their links are rendered for it only
+    entry_body = Markup(fragment_cache.get_or_render(
+        ('entry_body', entry['id'], entry.get('revision', 0), display_timezone()),
+        lambda: render_template('entry_body.html', entry=entry)
+    ))
+    return render_template('view_entry.html', entry=entry, entry_body=entry_body,
+                           show_media=bool(session.get('admin_logged_in')))
 
 
 @app.route('/update_entry/<uuid:entry_id>', methods=['GET', 'POST'])
 @admin_login_required
 def update_entry(entry_id):
-    # Create the JSON database file if it doesn't exist
-    if not JOURNAL_JSON_DB_PATH.exists():
-        create_blank_db(json_filepath=JOURNAL_JSON_DB_PATH)
-
-    # Load journal entries from the JSON database file
-    entries_data = load_database(JOURNAL_JSON_DB_PATH)
-    entries = entries_data['entries']
+    storage = get_storage()
 
-    # Check if the entry_id is valid
-    entry = None
-    for journal_entry in entries:
-        if journal_entry.get('id') == str(entry_id):
-            entry = JournalEntry.from_dict(journal_entry)
-            break
+    # Retrieve the journal entry with the specified entry_id from the storage
+    journal_entry = storage.get_entry(str(entry_id))
 
-    if entry is None:
+    if journal_entry is None:
         # Handle the case when the entry with the given ID does not exist
         return "Entry not found", 404
 
+    entry = JournalEntry.from_dict(journal_entry)
+
     if request.method == 'POST':
         # Get data from the form
         title = request.form.get('title')
@@ -234,15 +321,24 @@ def update_entry(entry_id):
         entry._title = title
         entry._text = text
 
-        # Update the entry in the entries list
-        for index, journal_entry in enumerate(entries):
-            if journal_entry.get('id') == str(entry_id):
-                entries[index] = entry.to_dict()
-                break
-
-        # Save the updated entries back to the JSON database
-        entries_data['entries'] = entries
-        save_database(data=entries_data, outputFileName=JOURNAL_JSON_DB_PATH)
+        # Save the updated entry back to the storage, unless somebody else
+        # changed or deleted it since the form was opened
+        current = None
+        with storage.write_lock():
+            try:
+                storage.update(entry.to_dict(), expected_version=request.form.get('version', type=int))
+            except EntryNotFoundError:
+                return "Entry not found", 404
+            except StaleEntryError:
+                # Read under the same lock, so it can't be deleted in between
+                current, version = JournalEntry.from_dict(storage.get_entry(str(entry_id))), storage.version()
+
+        if current is not None:
+            flash(
+                category="error",
+                message="This entry was changed in the meantime. Please review the current version and update again."
+            )
+            return render_template('update_entry.html', entry=current, version=version)
 
         # Log it
         logger.info('Updated one JournalEntry!')
@@ -254,39 +350,23 @@ def update_entry(entry_id):
         )
 
         # Render the template.
-        return render_template('entry_updated.html', entry=entry.to_dict())
+        return render_template('entry_updated.html', entry=entry)
 
-    return render_template('update_entry.html', entry=entry)
+    return render_template('update_entry.html', entry=entry, version=storage.version())
 
 
 @app.route('/delete_entry/<uuid:entry_id>')
 @admin_login_required
 def delete_entry(entry_id):
-    # Create the JSON database file if it doesn't exist
-    if not JOURNAL_JSON_DB_PATH.exists():
-        create_blank_db(json_filepath=JOURNAL_JSON_DB_PATH)
-
-    # Load journal entries from the JSON database file
-    entries_data = load_database(JOURNAL_JSON_DB_PATH)
-    entries = entries_data['entries']
+    storage = get_storage()
 
     # Check if the entry_id is valid
-    entry_index = None
-    for index, journal_entry in enumerate(entries):
-        if journal_entry.get('id') == str(entry_id):
-            entry_index = index
-            break
-
-    if entry_index is None:
+    if storage.get_entry(str(entry_id)) is None:
         # Handle the case when the entry with the given ID does not exist
         return "Entry not found", 404
 
     # Delete the entry with the specified entry_id
-    entries.pop(entry_index)
-
-    # Save the updated entries back to the JSON database
-    entries_data['entries'] = entries
-    save_database(data=entries_data, outputFileName=JOURNAL_JSON_DB_PATH)
+    storage.delete(str(entry_id))
 
     # Flash the messg
     flash(
@@ -302,10 +382,11 @@ def delete_entry(entry_id):
 
 
 @app.template_filter('dateformat')
-def dateformat(value, format='%b %d, %Y %I:%M:%S %p %Z'):
+def dateformat(value, format=DEFAULT_FORMAT):
     """
-    Custom Jinja2 filter to format a date string to a specified format.
-    Default format is '%Y-%m-%d %H:%M:%S %Z'.
+    Custom Jinja2 filter to format a Unix timestamp to a specified format,
+    in the display timezone.
+    Default format is '%b %d, %Y %I:%M:%S %p %Z'.
 
     Args:
         value (float): The timestamp as a float.
@@ -314,11 +395,29 @@ def dateformat(value, format='%b %d, %Y %I:%M:%S %p %Z'):
     Returns:
         str: The formatted date as a string.
     """
-    # Convert the Unix timestamp to a datetime object
-    dt_date_val = datetime.utcfromtimestamp(value)
+    return format_timestamp(value, format)
+
+
+@app.route('/preferences', methods=['GET', 'POST'])
+@admin_login_required
+def preferences():
+    if request.method == 'POST':
+        timezone = request.form.get('timezone', '')
+
+        if is_valid_timezone(timezone):
+            save_admin_preferences(timezone=timezone)
+            flash(
+                category="success",
+                message=f"Dates are now shown in {timezone}."
+            )
+            return redirect(url_for('preferences'))
+
+        flash(
+            category="error",
+            message=f"Unknown timezone: {timezone}"
+        )
 
-    # Format the date object
-    return dt_date_val.strftime(format)
+    return render_template('preferences.html', timezones=pytz.common_timezones, current=display_timezone())
 
 @app.route('/delete_past_backups', methods=['GET', 'POST'])
 def delete_past_backups():
@@ -330,17 +429,9 @@ def delete_past_backups():
             # Parse the date string
             delete_date = datetime.strptime(date_str, '%Y-%m-%d')
 
-            # List all backup files in the backup directory
-            backup_files = os.listdir(BACKUP_DIR)
-
-            # Iterate through backup files and delete those older than delete_date
-            for backup_file in backup_files:
-                file_date_str = backup_file.split('_')[1]
-                file_date = datetime.strptime(file_date_str, '%Y-%m-%d')
-
-                if file_date < delete_date:
-                    file_path = os.path.join(BACKUP_DIR, backup_file)
-                    os.remove(file_path)
+            # Delete the snapshots older than delete_date along with the
+            # entries only they refer to
+            delete_backups_before(delete_date)
 
             flash(
                 category="success",
@@ -352,12 +443,48 @@ def delete_past_backups():
                 message="Invalid date format. Please use YYYY-MM-DD."
             )
 
-    # List all backup file timing info
-    backup_files = os.listdir(BACKUP_DIR)
-    backup_info = [{'file': file, 'timestamp': os.path.getmtime(os.path.join(BACKUP_DIR, file))}
-                   for file in backup_files]
+    # One page of the backup catalog, newest first
+    page_args = PageArgs.from_request_args(request.args)
+    backups = list_backups()
+    backup_info = backups[page_args.offset:page_args.offset + page_args.per_page]
+
+    return render_template(
+        'delete_past_backups.html',
+        backup_info=backup_info,
+        total_backups=len(backups),
+        page_args=page_args
+    )
+
 
-    # Sort the backup_info list based on the 'timestamp' key in reverse order
-    backup_info = sorted(backup_info, key=lambda x: x['timestamp'], reverse=True)
+@app.route('/restore_backup/<snapshot_id>', methods=['POST'])
+@admin_login_required
+def restore_backup(snapshot_id):
+    if not is_snapshot_id(snapshot_id):
+        return "Backup not found", 404
+    try:
+        data = load_backup(snapshot_id)
+    except (FileNotFoundError, ValueError):
+        return "Backup not found", 404
+
+    # Replace the database with the content of the backup
+    get_storage().replace_all(data['entries'])
+
+    logger.info(f'Restored the backup {snapshot_id}!')
+    flash(
+        category="success",
+        message=f"Backup {snapshot_id} restored successfully!"
+    )
+    return redirect(url_for('view_entries'))
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Timing histograms in the Prometheus text format. Open to a logged in
+    admin, or to a scraper passing the admin token as ?token= or as a
+    bearer token.
+    """
+    if not request_authorized():
+        return "Unauthorized access: Invalid token", 401
 
-    return render_template('delete_past_backups.html', backup_info=backup_info)
\ No newline at end of file
+    return Response(render_prometheus(), content_type=PROMETHEUS_CONTENT_TYPE)
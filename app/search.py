@@ -0,0 +1,196 @@
+# app/search.py
+#
+# Full-text search over the title and text of the journal entries.
+#
+# The inverted index lives in memory only, so no plaintext ever reaches the
+# disk. It is built from the storage on the first query and afterwards kept
+# up to date incrementally through JournalStorage.subscribe(). If the data
+# is changed behind our back (another worker) the storage signature no
+# longer matches and the next query re-indexes the entries written since,
+# as found in the change log of the storage (JournalStorage.changes_since());
+# it is only rebuilt when the log can't tell, e.g. after an upload. A write
+# of this process is only applied to an index that was current right
+# before it.
+
+import heapq, math, re, threading
+from app.database import get_storage
+from app.jobs import submit_job
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# A term in the title counts as much as this many occurrences in the text
+TITLE_WEIGHT = 3
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+SNIPPET_LENGTH = 160
+
+
+def tokenize(text:str):
+    """Lowercased word tokens of `text`"""
+    return TOKEN_RE.findall(text.lower())
+
+
+class SearchIndex:
+    """BM25-ranked inverted index over the entries of a storage."""
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._lock = threading.RLock()
+        self._postings = {}     # term -> {entry_id: weighted term frequency}
+        self._doc_terms = {}    # entry_id -> {term: weighted term frequency}
+        self._doc_length = {}   # entry_id -> weighted number of tokens
+        self._total_length = 0
+        self._docs = {}         # entry_id -> (title, datetime_utc, text)
+        self._signature = None  # the storage signature the index reflects; None if not built
+        self._version = None    # the database version the index reflects
+        storage.subscribe(self._entries_changed)
+
+    def _entries_changed(self, storage, changes:list, old_signature):
+        with self._lock:
+            if self._signature is None:
+                # Not built yet; it will be built from scratch when needed
+                return
+            if self._signature != old_signature:
+                # The index missed writes of another process before this one;
+                # caught up with them, and this one, on the next query
+                return
+            for op, entry_id, entry in changes:
+                if op == 'reset':
+                    # Rebuild in the background rather than on the next query
+                    self._signature = None
+                    submit_job('rebuild_search_index', key='rebuild_search_index')
+                    return
+                self._remove(entry_id)
+                if entry is not None:
+                    self._add(entry)
+            self._signature, self._version = storage.signature(), storage.version()
+
+    def _ensure_current(self):
+        signature = self._storage.signature()
+        if self._signature is not None and self._signature != signature:
+            self._catch_up(signature)
+        if self._signature is not None and self._signature == signature:
+            return
+        # Read first: a write landing meanwhile is indexed again by the next
+        # catch-up, which is harmless
+        version = self._storage.version()
+        self._postings, self._doc_terms, self._doc_length, self._docs = {}, {}, {}, {}
+        self._total_length = 0
+        for entry in self._storage.iter_entries():
+            self._add(entry)
+        self._signature, self._version = signature, version
+
+    def _catch_up(self, signature):
+        """Re-indexes the entries written by other processes; unbuilds the index if the change log can't tell"""
+        changed = self._storage.changes_since(self._version)
+        if changed is None:
+            self._signature = None
+            return
+        version, entry_ids = changed
+        for entry_id in entry_ids:
+            self._remove(entry_id)
+            entry = self._storage.get_entry(entry_id)
+            if entry is not None:
+                self._add(entry)
+        self._signature, self._version = signature, version
+
+    def refresh(self):
+        """Rebuilds the index now if it doesn't reflect the storage"""
+        with self._lock:
+            self._ensure_current()
+
+    def _add(self, entry:dict):
+        entry_id = entry['id']
+        terms = {}
+        for term in tokenize(entry.get('title') or ''):
+            terms[term] = terms.get(term, 0) + TITLE_WEIGHT
+        for term in tokenize(entry.get('text') or ''):
+            terms[term] = terms.get(term, 0) + 1
+
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[entry_id] = frequency
+        self._doc_terms[entry_id] = terms
+        self._doc_length[entry_id] = length = sum(terms.values())
+        self._total_length += length
+        self._docs[entry_id] = (entry.get('title') or '', entry['datetime_utc'], entry.get('text') or '')
+
+    def _remove(self, entry_id:str):
+        terms = self._doc_terms.pop(entry_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            postings = self._postings[term]
+            del postings[entry_id]
+            if not postings:
+                del self._postings[term]
+        self._total_length -= self._doc_length.pop(entry_id)
+        del self._docs[entry_id]
+
+    def search(self, query:str, offset:int=0, limit:int=20):
+        """
+        Ranks the entries matching any term of `query`.
+
+        Returns:
+            tuple: (total number of matches, list of result dicts with id,
+                title, datetime_utc, snippet and score for the requested page)
+        """
+        query_terms = list(dict.fromkeys(tokenize(query)))
+        if not query_terms:
+            return 0, []
+
+        with self._lock:
+            self._ensure_current()
+
+            n_docs = len(self._doc_length)
+            avg_length = self._total_length / n_docs if n_docs else 0
+            scores = {}
+            for term in query_terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for entry_id, frequency in postings.items():
+                    norm = K1 * (1 - B + B * self._doc_length[entry_id] / avg_length)
+                    scores[entry_id] = scores.get(entry_id, 0) + idf * frequency * (K1 + 1) / (frequency + norm)
+
+            ranked = heapq.nlargest(offset + limit, scores.items(), key=lambda item: item[1])[offset:]
+            results = []
+            for entry_id, score in ranked:
+                title, datetime_utc, text = self._docs[entry_id]
+                results.append({
+                    "id": entry_id,
+                    "title": title,
+                    "datetime_utc": datetime_utc,
+                    "snippet": make_snippet(text, query_terms),
+                    "score": round(score, 4)
+                })
+            return len(scores), results
+
+
+def make_snippet(text:str, terms:list, length:int=SNIPPET_LENGTH):
+    """The part of `text` around the first occurrence of one of `terms`"""
+    pattern = re.compile(r'\b(?:' + '|'.join(re.escape(term) for term in terms) + r')\b', re.IGNORECASE)
+    match = pattern.search(text)
+    start = 0 if match is None else max(match.start() - length // 3, 0)
+    snippet = text[start:start + length].strip()
+    if start > 0:
+        snippet = '...' + snippet
+    if start + length < len(text):
+        snippet += '...'
+    return snippet
+
+
+_search_index = None
+_search_index_lock = threading.Lock()
+
+
+def get_search_index():
+    """Returns the search index of the configured storage"""
+    global _search_index
+    with _search_index_lock:
+        if _search_index is None:
+            _search_index = SearchIndex(get_storage())
+        return _search_index
@@ -0,0 +1,124 @@
+# app/serialization.py
+#
+# Serialization formats of the encrypted database file.
+#
+# An encrypted database file looks like
+#
+#     ENCRYPTED\n
+#     MCDB/<version> <format>\n       (the format header, see below)
+#     <Fernet token of the serialized database>
+#
+# where <format> is a serializer optionally followed by a compressor, e.g.
+# 'json', 'json+zlib' or 'msgpack+zstd'. Files written before the header
+# existed have the token right after the ENCRYPTED marker and hold indented
+# JSON; they are still read as such. The header is plaintext: it only tells
+# how to decode the encrypted payload.
+
+import json, zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+HEADER_MAGIC = b'MCDB/'
+HEADER_VERSION = 1
+LEGACY_FORMAT = 'json'
+
+
+def _json_dumps(data:dict):
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def _json_loads(payload:bytes):
+    return json.loads(payload.decode())
+
+
+def _msgpack_dumps(data:dict):
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def _msgpack_loads(payload:bytes):
+    return msgpack.unpackb(payload, raw=False)
+
+
+def _zstd_compress(payload:bytes):
+    return zstandard.ZstdCompressor(level=3).compress(payload)
+
+
+def _zstd_decompress(payload:bytes):
+    return zstandard.ZstdDecompressor().decompress(payload)
+
+
+# name: (dumps, loads, module it needs or None)
+SERIALIZERS = {
+    'json': (_json_dumps, _json_loads, None),
+    'msgpack': (_msgpack_dumps, _msgpack_loads, 'msgpack'),
+}
+
+# name: (compress, decompress, module it needs or None)
+COMPRESSORS = {
+    'zlib': (lambda payload: zlib.compress(payload, 6), zlib.decompress, None),
+    'zstd': (_zstd_compress, _zstd_decompress, 'zstandard'),
+}
+
+_MODULES = {'msgpack': msgpack, 'zstandard': zstandard}
+
+
+def parse_format(format_name:str):
+    """
+    Splits a format name like 'msgpack+zstd' into its serializer and
+    compressor (None if uncompressed).
+
+    Raises:
+        ValueError: If the format is unknown or needs a package that is not installed.
+    """
+    serializer, _, compressor = format_name.partition('+')
+    if serializer not in SERIALIZERS or (compressor and compressor not in COMPRESSORS):
+        raise ValueError(f"Unknown database format: {format_name}")
+
+    for module_name in (SERIALIZERS[serializer][2], compressor and COMPRESSORS[compressor][2]):
+        if module_name and _MODULES[module_name] is None:
+            raise ValueError(f"The database format {format_name} needs the '{module_name}' package")
+
+    return serializer, compressor or None
+
+
+def serialize(data:dict, format_name:str):
+    """
+    Returns (header, payload): the format header line and the serialized
+    `data`, to be encrypted.
+    """
+    serializer, compressor = parse_format(format_name)
+    payload = SERIALIZERS[serializer][0](data)
+    if compressor:
+        payload = COMPRESSORS[compressor][0](payload)
+    return HEADER_MAGIC + f'{HEADER_VERSION} {format_name}\n'.encode(), payload
+
+
+def split_header(content:bytes):
+    """
+    Splits what follows the ENCRYPTED marker into (format name, encrypted
+    token). Files without a format header are in LEGACY_FORMAT.
+    """
+    if not content.startswith(HEADER_MAGIC):
+        return LEGACY_FORMAT, content
+
+    header, _, token = content.partition(b'\n')
+    version, _, format_name = header[len(HEADER_MAGIC):].decode().partition(' ')
+    if int(version) > HEADER_VERSION:
+        raise ValueError(f"Unsupported database file version: {version}")
+    return format_name, token
+
+
+def deserialize(payload:bytes, format_name:str):
+    """Decodes the decrypted `payload` written in `format_name`"""
+    serializer, compressor = parse_format(format_name)
+    if compressor:
+        payload = COMPRESSORS[compressor][1](payload)
+    return SERIALIZERS[serializer][1](payload)
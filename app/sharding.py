@@ -0,0 +1,346 @@
+# app/sharding.py
+#
+# Sharded journals (STORAGE_BACKEND = 'sharded').
+#
+# Every journal has its own directory under SHARDS_DIR, and its entries are
+# split by the year of their datetime_utc into encrypted JSON files:
+#
+#     SHARDS_DIR/<journal>/manifest      a Fernet token of
+#                                        {"version": <n>,
+#                                         "shards": {<year>: {"count": <n>,
+#                                                             "signature": [...]}},
+#                                         "entries": {<id>: <year>, ...}}
+#                                        entries in insertion order
+#     SHARDS_DIR/<journal>/<year>.json   the entries of that year, a JsonStorage
+#                                        file (with its journal log if
+#                                        SHARD_APPEND_ONLY)
+#
+# A write goes to the shard of the entry's year and to the small manifest,
+# so adding today's entry never reads, decrypts or rewrites the entries of
+# previous years. Reading an entry looks up its shard in the manifest, and
+# listings walk the shards newest year first, skipping whole shards by
+# their counts.
+#
+# The manifest is written after the shard and records the signature of every
+# shard file. A shard whose signature doesn't match, e.g. because a process
+# crashed between the two writes, is read again to repair the manifest.
+#
+# The journals are independent of each other; JOURNAL_NAME is the one served
+# by the app, the others are reached through journal_storage().
+
+import json, os, re, threading
+from collections import Counter
+from pathlib import Path
+from cryptography.fernet import MultiFernet
+from app.database import JournalStorage, JsonStorage, durable_replace, file_signature, discard_journal_log
+from app.keys import get_cipher
+from config import SHARDS_DIR, SHARD_APPEND_ONLY
+
+_JOURNAL_NAME_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def shard_key(entry:dict):
+    """The shard holding `entry`: the year of its datetime_utc"""
+    return entry['datetime_utc'][:4]
+
+
+def _shard_signature(shard:JsonStorage):
+    # As stored in the JSON manifest
+    return json.loads(json.dumps(shard.signature()))
+
+
+class ShardedStorage(JournalStorage):
+    """The entries of one journal, in one encrypted JSON file per year."""
+
+    def __init__(self, journal_dir, append_only:bool=False):
+        super().__init__()
+        self.directory = Path(journal_dir)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / 'manifest'
+        self.append_only = append_only
+        self._lock = threading.Lock()
+        self._manifest = None     # (signature, decoded manifest)
+        self._shards = {}
+
+    def signature(self):
+        return file_signature(self.path)
+
+    def shard(self, key:str):
+        """The JsonStorage of the shard `key`"""
+        with self._lock:
+            shard = self._shards.get(key)
+            if shard is None:
+                shard = self._shards[key] = JsonStorage(self.directory / f'{key}.json', append_only=self.append_only)
+            return shard
+
+    ##################################################################
+    #                           Manifest
+    ##################################################################
+
+    def _read_manifest(self):
+        """Returns the manifest, cached per process; read-only"""
+        cached = self._manifest
+        if cached is not None and cached[0] == self.signature():
+            return cached[1]
+
+        with self.write_lock():
+            if self.path.exists():
+                with open(self.path, 'rb') as f:
+                    manifest = json.loads(get_cipher().decrypt(f.read()).decode())
+            else:
+                # A new journal, or one whose manifest is rebuilt from the shards
+                manifest = {"version": 0, "shards": {}, "entries": {}}
+            manifest = self._repair(manifest)
+            self._manifest = (self.signature(), manifest)
+            return manifest
+
+    def _write_manifest(self, manifest:dict):
+        durable_replace(self.path, get_cipher().encrypt(json.dumps(manifest, separators=(',', ':')).encode()))
+        self._manifest = (self.signature(), manifest)
+
+    def _repair(self, manifest:dict):
+        """Reads again the shards written after the manifest; returns the repaired manifest"""
+        keys = set(manifest['shards']) | {path.stem for path in self.directory.glob('*.json')}
+        stale = [key for key in sorted(keys) if not self._is_current(manifest, key)]
+        if not stale:
+            return manifest
+
+        manifest = self._copy(manifest)
+        for key in stale:
+            self._rescan_shard(manifest, key)
+        self._write_manifest(manifest)
+        return manifest
+
+    def _is_current(self, manifest:dict, key:str):
+        recorded = manifest['shards'].get(key, {}).get('signature')
+        return recorded == _shard_signature(self.shard(key))
+
+    def _rescan_shard(self, manifest:dict, key:str):
+        """Makes the manifest agree with the content of the shard `key`"""
+        shard = self.shard(key)
+        ids = [entry['id'] for entry in shard.iter_entries()] if shard.path.exists() else []
+
+        # Keep the insertion order of the entries known already
+        present = set(ids)
+        entries = {
+            entry_id: entry_key for entry_id, entry_key in manifest['entries'].items()
+            if entry_key != key or entry_id in present
+        }
+        for entry_id in ids:
+            entries[entry_id] = key
+        manifest['entries'] = entries
+
+        if shard.path.exists():
+            manifest['version'] = max(manifest['version'], shard.version())
+        self._record_shards(manifest, [key])
+
+    def _record_shards(self, manifest:dict, keys):
+        """Records the count and signature of the shards `keys`, removing empty ones"""
+        counts = Counter(manifest['entries'].values())
+        for key in keys:
+            shard = self.shard(key)
+            if counts[key] == 0:
+                if shard.path.exists():
+                    os.remove(shard.path)
+                discard_journal_log(shard.path)
+                manifest['shards'].pop(key, None)
+            else:
+                manifest['shards'][key] = {"count": counts[key], "signature": _shard_signature(shard)}
+
+    @staticmethod
+    def _copy(manifest:dict):
+        return {
+            "version": manifest['version'],
+            "shards": {key: dict(info) for key, info in manifest['shards'].items()},
+            "entries": dict(manifest['entries'])
+        }
+
+    ##################################################################
+    #                            Reading
+    ##################################################################
+
+    def version(self):
+        return self._read_manifest()['version']
+
+    def count(self):
+        return len(self._read_manifest()['entries'])
+
+    def get_entry(self, entry_id:str):
+        key = self._read_manifest()['entries'].get(str(entry_id))
+        return None if key is None else self.shard(key).get_entry(entry_id)
+
+    def load(self):
+        manifest = self._read_manifest()
+        return {"version": manifest['version'], "entries": list(self.iter_entries())}
+
+    def iter_entries(self):
+        # In insertion order across the shards; each shard is read once
+        shards = {}
+        for entry_id, key in self._read_manifest()['entries'].items():
+            if key not in shards:
+                shards[key] = {entry['id']: entry for entry in self.shard(key).iter_entries()}
+            entry = shards[key].get(entry_id)
+            if entry is not None:
+                yield entry
+
+    def list_entries(self, offset:int=0, limit:int=None, before:str=None, before_id:str=None):
+        manifest = self._read_manifest()
+        before_key = None if before is None else before[:4]
+
+        page = []
+        for key in sorted(manifest['shards'], reverse=True):
+            remaining = None if limit is None else limit - len(page)
+            if remaining == 0:
+                break
+            if before_key is not None and key > before_key:
+                # Every entry of a later year is newer than the cursor
+                continue
+
+            if key == before_key:
+                matching = self.shard(key).list_entries(before=before, before_id=before_id)
+                page += matching[offset:][:remaining]
+                offset = max(offset - len(matching), 0)
+            elif offset >= manifest['shards'][key]['count']:
+                # Skip the whole shard without reading it
+                offset -= manifest['shards'][key]['count']
+            else:
+                page += self.shard(key).list_entries(offset, remaining)
+                offset = 0
+        return page
+
+    ##################################################################
+    #                            Writing
+    ##################################################################
+
+    def _mutate(self, func, version:int):
+        """
+        Applies `func(manifest)` to a copy of the manifest; `func` writes the
+        shards and returns the keys of the ones it wrote. Then writes the
+        manifest.
+        """
+        manifest = self._copy(self._read_manifest())
+        keys = func(manifest)
+        self._record_shards(manifest, keys)
+        manifest['version'] = version
+        self._write_manifest(manifest)
+
+    def _checked_shard(self, manifest:dict, key:str):
+        """The shard `key`, after repairing the manifest if the shard changed behind it"""
+        if not self._is_current(manifest, key):
+            self._rescan_shard(manifest, key)
+        return self.shard(key)
+
+    def _put(self, entry:dict, version:int):
+        def put(manifest):
+            key, old_key = shard_key(entry), manifest['entries'].get(entry['id'])
+            shard = self._checked_shard(manifest, key)
+            if old_key == key:
+                shard._update(entry, version)
+            else:
+                shard._add(entry, version)
+            manifest['entries'][entry['id']] = key
+            if old_key is None or old_key == key:
+                return [key]
+
+            # The datetime moved the entry to another year
+            self._checked_shard(manifest, old_key)._delete(entry['id'], version)
+            return [key, old_key]
+        self._mutate(put, version)
+
+    def _add(self, entry:dict, version:int):
+        self._put(entry, version)
+
+    def _update(self, entry:dict, version:int):
+        self._put(entry, version)
+
+    def _delete(self, entry_id:str, version:int):
+        def delete(manifest):
+            key = manifest['entries'].pop(entry_id, None)
+            if key is None:
+                return []
+            self._checked_shard(manifest, key)._delete(entry_id, version)
+            return [key]
+        self._mutate(delete, version)
+
+    def _import_entries(self, entries, replace:bool, version:int):
+        def import_entries(manifest):
+            old_keys = set(manifest['shards'])
+            if replace:
+                manifest['entries'] = {}
+
+            groups, moved = {}, {}     # key -> {id: entry}, key -> ids leaving it
+            for entry in entries:
+                key, old_key = shard_key(entry), manifest['entries'].get(entry['id'])
+                if old_key is not None and old_key != key:
+                    moved.setdefault(old_key, set()).add(entry['id'])
+                groups.setdefault(key, {})[entry['id']] = entry
+                manifest['entries'][entry['id']] = key
+
+            keys = set(groups) | set(moved) | (old_keys if replace else set())
+            for key in sorted(keys):
+                if replace:
+                    shard = self.shard(key)
+                    content = groups.get(key, {}).values()
+                else:
+                    shard = self._checked_shard(manifest, key)
+                    merged = {
+                        entry['id']: entry for entry in shard.iter_entries()
+                        if entry['id'] not in moved.get(key, ())
+                    } if shard.path.exists() else {}
+                    merged.update(groups.get(key, {}))
+                    content = merged.values()
+                shard._import_entries(content, replace=True, version=version)
+            return keys
+        self._mutate(import_entries, version)
+
+    def _write_batch(self, changes:list, version:int):
+        def write_batch(manifest):
+            # Repair the shards involved first, as that resets their part of the manifest
+            keys = {shard_key(entry) for _, _, entry in changes if entry is not None}
+            keys |= {manifest['entries'][entry_id] for _, entry_id, _ in changes if entry_id in manifest['entries']}
+            for key in sorted(keys):
+                self._checked_shard(manifest, key)
+
+            shard_changes = {}     # key -> the changes of that shard
+            for op, entry_id, entry in changes:
+                old_key = manifest['entries'].get(entry_id)
+                key = None if entry is None else shard_key(entry)
+                if old_key is not None and old_key != key:
+                    # Deleted, or moved to another year
+                    shard_changes.setdefault(old_key, []).append(('delete', entry_id, None))
+                if entry is None:
+                    manifest['entries'].pop(entry_id, None)
+                else:
+                    shard_changes.setdefault(key, []).append(('update' if old_key == key else 'add', entry_id, entry))
+                    manifest['entries'][entry_id] = key
+
+            for key, changes_of_shard in shard_changes.items():
+                self.shard(key)._write_batch(changes_of_shard, version)
+            return list(shard_changes)
+        self._mutate(write_batch, version)
+
+    def reencrypt(self, cipher:MultiFernet):
+        with self.write_lock():
+            manifest = self._read_manifest()
+            for key in manifest['shards']:
+                self.shard(key).reencrypt(cipher)
+            # Records the new signatures and writes the manifest with the primary key
+            self._mutate(lambda manifest: list(manifest['shards']), manifest['version'])
+
+
+######################################################################
+#                            Journals
+######################################################################
+
+def journal_storage(name:str):
+    """Returns the storage of the journal `name` in SHARDS_DIR"""
+    if not _JOURNAL_NAME_RE.match(name):
+        raise ValueError(f"Invalid journal name: {name}")
+    return ShardedStorage(SHARDS_DIR / name, append_only=SHARD_APPEND_ONLY)
+
+
+def list_journals():
+    """Returns the names of the journals in SHARDS_DIR"""
+    if not SHARDS_DIR.exists():
+        return []
+    return sorted(path.parent.name for path in SHARDS_DIR.glob('*/manifest'))
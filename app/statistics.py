@@ -0,0 +1,303 @@
+# app/statistics.py
+#
+# Running statistics of the journal: entries, words per entry, entries per
+# week, writing streaks and the longest entries.
+#
+# Every entry is counted as [words, datetime_utc, title] and the aggregates
+# (total words, entries per day and per ISO week, entries ordered by length)
+# are updated incrementally through JournalStorage.subscribe(), so a write
+# costs a few dict and bisect operations and the statistics are answered
+# without reading the journal. Only the streaks walk the days having entries,
+# once per database version.
+#
+# They are persisted next to the storage, like the journal log of 'log':
+#
+#     <storage path>.stats       a Fernet token of
+#                                {"version": <database version reflected>,
+#                                 "entries": {<id>: [<words>, <datetime_utc>, <title>]}}
+#     <storage path>.stats.log   one Fernet token per line of
+#                                {"id": <id>, "entry": [...] or null, "version": <n>}
+#
+# Every write appends its records to the log under the write lock of the
+# storage, and the snapshot is rewritten once the log grows past
+# LOG_COMPACTION_THRESHOLD. Statistics that don't reflect the current
+# database version (e.g. it was written by a process not tracking them) are
+# rebuilt from the entries, which `flask rebuild-statistics` also does.
+#
+# Days and weeks are those of the display timezone; they are recounted from
+# the entries in memory when it changes.
+
+from config import LOG_COMPACTION_THRESHOLD, STATISTICS_WEEKS, STATISTICS_LONGEST_ENTRIES
+from bisect import bisect_left, insort
+from cryptography.fernet import InvalidToken, MultiFernet
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from app.database import get_storage, durable_replace, file_signature
+from app.keys import get_cipher
+from app.timeformat import display_timezone, format_datetime, get_timezone
+import json, os, threading
+
+
+def entry_statistics(entry:dict):
+    """What the statistics keep of `entry`: [words, datetime_utc, title]"""
+    return [len((entry.get('text') or '').split()), entry['datetime_utc'], entry.get('title') or '']
+
+
+class JournalStatistics:
+    """Aggregates over the entries of a storage, persisted next to it."""
+
+    def __init__(self, storage):
+        self._storage = storage
+        self.path = Path(str(storage.path) + '.stats')
+        self.log_path = Path(str(self.path) + '.log')
+        self._lock = threading.RLock()
+        self._signature = None  # the signatures of the files loaded
+        self._version = None    # the database version reflected; None if not loaded
+        self._entries = {}      # entry_id -> [words, datetime_utc, title]
+        self._total_words = 0
+        self._by_words = []     # sorted (words, entry_id)
+        self._timezone = None   # the timezone of the days and weeks; None if not counted
+        self._days = {}         # local date -> number of entries
+        self._sorted_days = []  # the local dates having entries
+        self._weeks = {}        # (ISO year, ISO week) -> number of entries
+        self._streaks = None    # (version, timezone, today, streaks)
+        storage.subscribe(self._entries_changed)
+
+    ##################################################################
+    #                          Aggregates
+    ##################################################################
+
+    def _reset(self, items, version:int):
+        """Recounts everything from the (entry_id, statistics) pairs `items`"""
+        self._entries, self._total_words, self._by_words = {}, 0, []
+        self._timezone, self._days, self._sorted_days, self._weeks = None, {}, [], {}
+        for entry_id, stat in items:
+            self._entries[entry_id] = stat
+            self._total_words += stat[0]
+            self._by_words.append((stat[0], entry_id))
+        self._by_words.sort()
+        self._version = version
+
+    def _apply(self, entry_id:str, stat:list):
+        """Replaces the statistics of the entry; `stat` None deletes it"""
+        old = self._entries.pop(entry_id, None)
+        if old is not None:
+            self._total_words -= old[0]
+            del self._by_words[bisect_left(self._by_words, (old[0], entry_id))]
+            if self._timezone is not None:
+                self._count(old[1], -1)
+
+        if stat is not None:
+            self._entries[entry_id] = stat
+            self._total_words += stat[0]
+            insort(self._by_words, (stat[0], entry_id))
+            if self._timezone is not None:
+                self._count(stat[1], 1)
+
+    def _count(self, datetime_utc:str, delta:int):
+        day = date.fromisoformat(format_datetime(datetime_utc, '%Y-%m-%d', self._timezone))
+        week = day.isocalendar()[:2]
+        self._weeks[week] = self._weeks.get(week, 0) + delta
+        if self._weeks[week] == 0:
+            del self._weeks[week]
+
+        count = self._days.get(day, 0)
+        if count == 0:
+            insort(self._sorted_days, day)
+        if count + delta == 0:
+            del self._days[day]
+            del self._sorted_days[bisect_left(self._sorted_days, day)]
+        else:
+            self._days[day] = count + delta
+
+    def _count_days(self, timezone:str):
+        if self._timezone != timezone:
+            self._timezone, self._days, self._sorted_days, self._weeks = timezone, {}, [], {}
+            for stat in self._entries.values():
+                self._count(stat[1], 1)
+
+    ##################################################################
+    #                          Persistence
+    ##################################################################
+
+    def _files_signature(self):
+        return (file_signature(self.path), file_signature(self.log_path))
+
+    def _load(self):
+        """Reads the statistics again if another process wrote them; returns whether there are any"""
+        signature = self._files_signature()
+        if signature == self._signature:
+            return self._version is not None
+
+        fer = get_cipher()
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot = json.loads(fer.decrypt(f.read()).decode())
+            records = []
+            if self.log_path.exists():
+                with open(self.log_path, 'rb') as f:
+                    records = [json.loads(fer.decrypt(line.strip()).decode()) for line in f if line.strip()]
+        except (FileNotFoundError, InvalidToken, ValueError):
+            # Missing or unreadable (e.g. a half-written log line); rebuilt by the caller
+            self._signature, self._version = None, None
+            return False
+
+        self._reset(snapshot['entries'].items(), snapshot['version'])
+        for record in records:
+            # Records older than the snapshot are already in it
+            if record['version'] > self._version:
+                self._apply(record['id'], record['entry'])
+                self._version = record['version']
+        self._signature = signature
+        return True
+
+    def _write_snapshot(self, fer:MultiFernet=None):
+        snapshot = {"version": self._version, "entries": self._entries}
+        fer = fer or get_cipher()
+        durable_replace(self.path, fer.encrypt(json.dumps(snapshot, separators=(',', ':')).encode()))
+        if self.log_path.exists():
+            os.remove(self.log_path)
+        self._signature = self._files_signature()
+
+    def _append(self, records:list):
+        fer = get_cipher()
+        lines = b''.join(fer.encrypt(json.dumps(record, separators=(',', ':')).encode()) + b'\n' for record in records)
+        # Not fsynced: records lost in a crash leave the statistics behind the
+        # database version, so they are rebuilt
+        with open(self.log_path, 'ab') as f:
+            f.write(lines)
+
+        if self.log_path.stat().st_size >= LOG_COMPACTION_THRESHOLD:
+            self._write_snapshot()
+        else:
+            self._signature = self._files_signature()
+
+    def _entries_changed(self, storage, changes:list, old_signature):
+        # Called with the write lock of the storage held; the statistics
+        # follow the database version rather than the storage signature
+        with self._lock:
+            version = storage.version()
+            if changes[0][0] == 'reset' or not self._load() or self._version != version - 1:
+                self.rebuild()
+                return
+
+            records = []
+            for op, entry_id, entry in changes:
+                stat = None if entry is None else entry_statistics(entry)
+                self._apply(entry_id, stat)
+                records.append({"id": entry_id, "entry": stat, "version": version})
+            self._version = version
+            self._append(records)
+
+    def rebuild(self):
+        """Counts every entry of the storage again and rewrites the statistics"""
+        with self._storage.write_lock(), self._lock:
+            self._reset(
+                ((entry['id'], entry_statistics(entry)) for entry in self._storage.iter_entries()),
+                self._storage.version()
+            )
+            self._write_snapshot()
+
+    def reencrypt(self, cipher:MultiFernet):
+        """Rewrites the statistics with the primary key of `cipher`"""
+        with self._storage.write_lock(), self._lock:
+            if self._load():
+                self._write_snapshot(cipher)
+            else:
+                self.rebuild()
+
+    ##################################################################
+    #                           Reading
+    ##################################################################
+
+    def _ensure_current(self):
+        with self._lock:
+            if self._load() and self._version == self._storage.version():
+                return
+        # Outside of our lock, which is always taken after the storage one
+        self.rebuild()
+
+    def summary(self, timezone:str=None):
+        """
+        Returns the statistics of the journal.
+
+        Args:
+            timezone (str): The timezone of the days and weeks (default:
+                the display timezone).
+
+        Returns:
+            dict: total_entries, total_words, words_per_entry,
+                entries_per_week (over the weeks since the first entry),
+                weeks (the entries of the last STATISTICS_WEEKS weeks),
+                streaks (current and longest, in days) and longest_entries.
+        """
+        timezone = timezone or display_timezone()
+        self._ensure_current()
+
+        with self._lock:
+            self._count_days(timezone)
+            today = datetime.now(get_timezone(timezone)).date()
+            total = len(self._entries)
+
+            this_monday = today - timedelta(days=today.weekday())
+            weeks = []
+            for i in range(STATISTICS_WEEKS - 1, -1, -1):
+                monday = this_monday - timedelta(weeks=i)
+                year, week = monday.isocalendar()[:2]
+                weeks.append({"week": f'{year}-W{week:02d}', "entries": self._weeks.get((year, week), 0)})
+
+            n_weeks = 0
+            if self._sorted_days:
+                first = self._sorted_days[0]
+                n_weeks = max((this_monday - (first - timedelta(days=first.weekday()))).days // 7 + 1, 1)
+
+            longest_entries = []
+            for words, entry_id in self._by_words[:-STATISTICS_LONGEST_ENTRIES - 1:-1]:
+                _, datetime_utc, title = self._entries[entry_id]
+                longest_entries.append({"id": entry_id, "title": title, "datetime_utc": datetime_utc, "words": words})
+
+            return {
+                "version": self._version,
+                "timezone": timezone,
+                "total_entries": total,
+                "total_words": self._total_words,
+                "words_per_entry": round(self._total_words / total, 1) if total else 0,
+                "entries_per_week": round(total / n_weeks, 2) if n_weeks else 0,
+                "weeks": weeks,
+                "streaks": self._get_streaks(today),
+                "longest_entries": longest_entries
+            }
+
+    def _get_streaks(self, today:date):
+        key = (self._version, self._timezone, today)
+        if self._streaks is not None and self._streaks[0] == key:
+            return self._streaks[1]
+
+        longest, previous, run = None, None, 0
+        for day in self._sorted_days:
+            run = run + 1 if previous is not None and (day - previous).days == 1 else 1
+            if longest is None or run > longest["days"]:
+                longest = {"days": run, "start": (day - timedelta(days=run - 1)).isoformat(), "end": day.isoformat()}
+            previous = day
+
+        # The current streak may still be continued today
+        current = 0
+        if previous is not None and (today - previous).days <= 1:
+            current = run
+
+        streaks = {"current": current, "longest": longest or {"days": 0, "start": None, "end": None}}
+        self._streaks = (key, streaks)
+        return streaks
+
+
+_statistics = None
+_statistics_lock = threading.Lock()
+
+
+def get_statistics():
+    """Returns the statistics of the configured storage"""
+    global _statistics
+    with _statistics_lock:
+        if _statistics is None:
+            _statistics = JournalStatistics(get_storage())
+        return _statistics
@@ -0,0 +1,96 @@
+# app/timeformat.py
+#
+# Display of datetimes in the timezone of the reader.
+#
+# Datetimes are shown in DISPLAY_TIMEZONE, or in the timezone the admin
+# picked on /preferences (kept as "timezone" in ADMIN_JSON_FILE), which is
+# resolved once per request. Timezone objects are created once per process
+# and formatted strings are cached per (value, format, timezone), so a page
+# of cards costs one timezone lookup and no datetime is converted twice.
+
+from config import DISPLAY_TIMEZONE, ADMIN_JSON_FILE
+from datetime import datetime
+from functools import lru_cache
+from flask import g, has_request_context
+from app.journal import parse_datetime
+import json, os, pytz
+
+DEFAULT_FORMAT = '%b %d, %Y %I:%M:%S %p %Z'
+
+
+@lru_cache(maxsize=None)
+def get_timezone(name:str):
+    """The tzinfo of the timezone `name`, created once per process"""
+    return pytz.timezone(name)
+
+
+def is_valid_timezone(name:str):
+    return name in pytz.all_timezones_set
+
+
+# (signature of ADMIN_JSON_FILE, the timezone saved in it)
+_admin_timezone = (None, None)
+
+
+def admin_timezone():
+    """The timezone saved by the admin, or None. Reads ADMIN_JSON_FILE only after it changed."""
+    global _admin_timezone
+    try:
+        st = os.stat(ADMIN_JSON_FILE)
+    except FileNotFoundError:
+        return None
+
+    signature = (st.st_mtime_ns, st.st_size)
+    if _admin_timezone[0] != signature:
+        with open(ADMIN_JSON_FILE, 'r', encoding='utf-8') as json_file:
+            _admin_timezone = (signature, json.load(json_file).get('timezone'))
+    return _admin_timezone[1]
+
+
+def display_timezone():
+    """The name of the timezone datetimes are displayed in, resolved once per request"""
+    if has_request_context():
+        if 'display_timezone' not in g:
+            g.display_timezone = _resolve_timezone()
+        return g.display_timezone
+    return _resolve_timezone()
+
+
+def _resolve_timezone():
+    name = admin_timezone()
+    return name if name and is_valid_timezone(name) else DISPLAY_TIMEZONE
+
+
+def _as_utc(value):
+    """`value` (a datetime or its ISO format) as an aware datetime"""
+    value = value if isinstance(value, datetime) else parse_datetime(value)
+    # Naive datetimes are in UTC by definition of the datetime_utc field
+    return value if value.tzinfo is not None else value.replace(tzinfo=pytz.utc)
+
+
+@lru_cache(maxsize=16384)
+def _format(value, format:str, timezone:str):
+    return _as_utc(value).astimezone(get_timezone(timezone)).strftime(format)
+
+
+def format_datetime(value, format:str=DEFAULT_FORMAT, timezone:str=None):
+    """
+    Formats a datetime in the display timezone.
+
+    Args:
+        value (datetime | str): The datetime, or its ISO format.
+        format (str): The strftime format.
+        timezone (str): The timezone name (default: display_timezone()).
+    """
+    return _format(value, format, timezone or display_timezone())
+
+
+def format_datetimes(values, format:str=DEFAULT_FORMAT, timezone:str=None):
+    """format_datetime() of every value of a page, resolving the timezone once"""
+    timezone = timezone or display_timezone()
+    return [_format(value, format, timezone) for value in values]
+
+
+def format_timestamp(timestamp:float, format:str=DEFAULT_FORMAT, timezone:str=None):
+    """Formats a unix timestamp in the display timezone"""
+    return format_datetime(datetime.fromtimestamp(timestamp, pytz.utc), format, timezone)
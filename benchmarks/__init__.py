@@ -0,0 +1,13 @@
+# benchmarks/__init__.py
+#
+# Latency and memory benchmarks of the storage layer, the routes and the
+# export api, run against synthetic journals of a given size.
+#
+# Usage:
+#     python -m benchmarks [--sizes 1000 10000 100000] [--backend blob|log|sqlite|container|sharded]
+#                          [--repeat 7] [--output results.json]
+#                          [--baseline baseline.json] [--tolerance 0.25]
+#
+# The results are written as JSON. With --baseline the run is compared
+# against an earlier results file and exits with status 1 if any scenario's
+# p50 got slower by more than the tolerance.
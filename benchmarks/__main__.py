@@ -0,0 +1,116 @@
+# benchmarks/__main__.py
+#
+# Command line entry point, see benchmarks/__init__.py.
+
+import argparse, json, platform, sys, tempfile, time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+BACKENDS = ['blob', 'log', 'sqlite', 'container', 'sharded']
+
+
+def configure(data_dir:Path, backend:str):
+    """Points the config at `data_dir`; must run before `app` is imported."""
+    sys.path.insert(0, str(ROOT_DIR))
+    import config
+
+    config.JOURNAL_JSON_DB_PATH = data_dir / 'journal_entries.json'
+    config.SQLITE_DB_PATH = data_dir / 'journal_entries.sqlite3'
+    config.CONTAINER_PATH = data_dir / 'journal_entries.mcc'
+    config.SHARDS_DIR = data_dir / 'journals'
+    config.BACKUP_DIR = data_dir / '.backups'
+    config.FERNET_FILE = data_dir / '.fernetkey'
+    config.ADMIN_JSON_FILE = data_dir / 'admin.json'
+    config.LOG_FILE = data_dir / 'app.log'
+    config.JOBS_FILE = data_dir / '.jobs.json'
+    config.BATCH_IDEMPOTENCY_FILE = data_dir / '.batches.json'
+    config.EXPORTS_DIR = data_dir / '.exports'
+    config.MEDIA_DIR = data_dir / '.media'
+    config.STORAGE_BACKEND = backend
+
+
+def run_benchmarks(sizes:list, backend:str, repeat:int, only:str=None):
+    """Returns {size: {scenario name: stats}}"""
+    from benchmarks.generator import generate_entries
+    from benchmarks.scenarios import SCENARIOS, make_context, measure
+    from app.jobs import get_job_queue
+
+    results = {}
+    for size in sizes:
+        print(f"== {size} entries ({backend})", file=sys.stderr)
+        start = time.perf_counter()
+        context = make_context(list(generate_entries(size)))
+        print(f"   generated and stored in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+        results[str(size)] = {}
+        for scenario in SCENARIOS:
+            if backend not in scenario.backends or (only and only not in scenario.name):
+                continue
+            stats = measure(scenario, context, repeat=repeat)
+            results[str(size)][scenario.name] = stats
+            print(f"   {scenario.name:42s} p50 {stats['p50_ms']:10.2f} ms  p95 {stats['p95_ms']:10.2f} ms  "
+                  f"peak {stats['peak_memory_mb']:8.2f} MB", file=sys.stderr)
+
+        # Let the backups queued by the writes finish before the data
+        # directory is reused or removed
+        get_job_queue().join()
+    return results
+
+
+def compare(results:dict, baseline:dict, tolerance:float):
+    """Returns the regressions of `results` against `baseline` as strings"""
+    regressions = []
+    for size, scenarios in results['results'].items():
+        for name, stats in scenarios.items():
+            reference = baseline.get('results', {}).get(size, {}).get(name)
+            if reference is None:
+                continue
+            if stats['p50_ms'] > reference['p50_ms'] * (1 + tolerance):
+                regressions.append(
+                    f"{name} @ {size}: p50 {stats['p50_ms']:.2f} ms vs {reference['p50_ms']:.2f} ms in the baseline"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description="MindCanvas latency benchmarks")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--backend', default='blob', choices=BACKENDS)
+    parser.add_argument('--repeat', type=int, default=7, help="timed runs per scenario")
+    parser.add_argument('--only', help="run the scenarios whose name contains this")
+    parser.add_argument('--output', type=Path, help="write the results to this JSON file (default: stdout)")
+    parser.add_argument('--baseline', type=Path, help="results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed p50 slowdown against the baseline (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        configure(Path(data_dir), args.backend)
+        results = {
+            "meta": {
+                "backend": args.backend,
+                "repeat": args.repeat,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "created": time.strftime('%Y-%m-%dT%H:%M:%S')
+            },
+            "results": run_benchmarks(args.sizes, args.backend, args.repeat, args.only)
+        }
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        args.output.write_text(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# benchmarks/generator.py
+#
+# Synthetic journal entries with realistic sizes: short titles, texts of a
+# few hundred to a few thousand characters, and datetimes spread over the
+# past years in chronological order.
+
+import random, uuid
+from datetime import datetime, timedelta
+import pytz
+
+WORDS = (
+    "the a to and of in it was that day i my we with for on at this had but "
+    "morning evening night walk coffee work meeting friend family book read "
+    "wrote thought felt tired happy calm rain sun city train home garden "
+    "music dinner lunch idea plan project weekend travel mountain river sea "
+    "remember tomorrow yesterday today week month year slowly finally again "
+    "conversation letter dream quiet noise window light dark cold warm long"
+).split()
+
+
+def generate_entry(rng:random.Random, datetime_utc:datetime):
+    """Returns a random entry dict, as produced by JournalEntry.to_dict()"""
+    title = ' '.join(rng.choices(WORDS, k=rng.randint(2, 7))).capitalize()
+
+    # Log-normal text length: most entries are a few paragraphs, a few are long
+    n_words = min(int(rng.lognormvariate(5, 0.7)), 3000)
+    sentences = []
+    while n_words > 0:
+        k = min(n_words, rng.randint(6, 20))
+        sentences.append(' '.join(rng.choices(WORDS, k=k)).capitalize() + '.')
+        n_words -= k
+
+    return {
+        "title": title,
+        "datetime_utc": datetime_utc.isoformat(),
+        "text": ' '.join(sentences),
+        "media_content": [],
+        "id": str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    }
+
+
+def generate_entries(n:int, seed:int=0, years:int=3):
+    """
+    Yields `n` random entries in chronological order, spread over the last
+    `years` years. The same `seed` always gives the same journal.
+    """
+    rng = random.Random(seed)
+    end = datetime(2024, 1, 1, tzinfo=pytz.utc)
+    start = end - timedelta(days=365 * years)
+    step = (end - start) / max(n, 1)
+
+    for i in range(n):
+        jitter = timedelta(seconds=rng.uniform(0, step.total_seconds()))
+        yield generate_entry(rng, start + step * i + jitter)
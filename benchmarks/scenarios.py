@@ -0,0 +1,244 @@
+# benchmarks/scenarios.py
+#
+# The timed scenarios. Each scenario is a `run(context, prepared)` callable,
+# optionally preceded by an untimed `setup(context)` whose return value is
+# passed as `prepared`. The context is created once per journal size by
+# make_context().
+
+import math, time, tracemalloc
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+
+@dataclass
+class Scenario:
+    name: str
+    run: Callable
+    setup: Optional[Callable] = None
+    backends: tuple = ('blob', 'log', 'sqlite', 'container', 'sharded')
+
+
+@dataclass
+class Context:
+    client: object
+    storage: object
+    database_path: object
+    entry_ids: list
+    token: str
+
+
+def make_context(entries:list):
+    """Fills the storage with `entries` and logs a test client in as admin"""
+    from app import app
+    from app.authentication import generate_token
+    from app.database import get_storage
+    import config
+
+    storage = get_storage()
+    storage.replace_all(entries)
+
+    client = app.test_client()
+    token = generate_token(config.DEFAULT_ADMIN['admin_username'])
+    with client.session_transaction() as session:
+        session['admin_logged_in'] = True
+        session['token'] = token
+
+    return Context(
+        client=client,
+        storage=storage,
+        database_path=config.JOURNAL_JSON_DB_PATH,
+        entry_ids=[entry['id'] for entry in entries],
+        token=token
+    )
+
+
+def percentile(samples:list, p:float):
+    """Nearest-rank percentile of `samples` (0 < p <= 100)"""
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def measure(scenario:Scenario, context:Context, repeat:int, warmup:int=1):
+    """
+    Runs `scenario` warmup + repeat times and returns its latency
+    percentiles (in ms) and the peak memory allocated by one run (in MB).
+    """
+    def run_once():
+        prepared = scenario.setup(context) if scenario.setup else None
+        start = time.perf_counter()
+        scenario.run(context, prepared)
+        return time.perf_counter() - start
+
+    for _ in range(warmup):
+        run_once()
+
+    samples = [run_once() * 1000 for _ in range(repeat)]
+
+    # tracemalloc slows everything down, so the peak is measured on an
+    # extra run that is not part of the timings
+    prepared = scenario.setup(context) if scenario.setup else None
+    tracemalloc.start()
+    try:
+        scenario.run(context, prepared)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "p50_ms": round(percentile(samples, 50), 3),
+        "p95_ms": round(percentile(samples, 95), 3),
+        "min_ms": round(min(samples), 3),
+        "max_ms": round(max(samples), 3),
+        "peak_memory_mb": round(peak / 1024 / 1024, 3),
+        "samples": len(samples)
+    }
+
+
+######################################################################
+#                        Storage scenarios
+######################################################################
+
+def _invalidate_cache(context):
+    from app.database import db_cache
+    db_cache.invalidate()
+
+
+def _load_database(context, prepared):
+    from app.database import load_database
+    load_database(context.database_path)
+
+
+def _loaded_database(context):
+    from app.database import load_database
+    return load_database(context.database_path)
+
+
+def _save_database(context, database):
+    from app.database import save_database
+    save_database(data=database, outputFileName=context.database_path)
+
+
+######################################################################
+#                         Route scenarios
+######################################################################
+
+def _get(url_for_context):
+    """A run() requesting the url returned by `url_for_context(context)`"""
+    def run(context, prepared):
+        response = context.client.get(url_for_context(context))
+        # Consume streamed bodies too
+        response.get_data()
+        if response.status_code >= 400:
+            raise RuntimeError(f"GET {response.request.path} failed with {response.status_code}")
+    return run
+
+
+def _post(url_for_context, form_for_context):
+    def run(context, prepared):
+        response = context.client.post(url_for_context(context, prepared), data=form_for_context(context, prepared))
+        if response.status_code >= 400:
+            raise RuntimeError(f"POST {response.request.path} failed with {response.status_code}")
+    return run
+
+
+def _middle_id(context):
+    return context.entry_ids[len(context.entry_ids) // 2]
+
+
+def _middle_month(context):
+    year, month = context.storage.get_entry(_middle_id(context))['datetime_utc'][:7].split('-')
+    return f'{int(year)}/{int(month)}'
+
+
+def _last_page(context):
+    import config
+    return max(math.ceil(context.storage.count() / config.ENTRIES_PER_PAGE), 1)
+
+
+def _added_entry(context):
+    """Adds a throwaway entry for the delete scenario and returns its id"""
+    from datetime import datetime
+    from app.journal import JournalEntry
+    import pytz
+
+    entry = JournalEntry(title='benchmark', datetime_utc=datetime.now(pytz.utc), text='to be deleted')
+    context.storage.add(entry.to_dict())
+    return entry.id
+
+
+def _snapshot(context):
+    """Takes the backup to restore; the retention rules prune earlier ones"""
+    from app.backup import create_backup
+    return create_backup(context.storage.load())
+
+
+def _delete_added_entry(context, entry_id):
+    response = context.client.get(f'/delete_entry/{entry_id}')
+    if response.status_code >= 400:
+        raise RuntimeError(f"delete_entry failed with {response.status_code}")
+
+
+def _batch_update(context, prepared):
+    """Updates the text of 50 entries in one batch"""
+    operations = [
+        {"op": "update", "entry": {"id": entry_id, "text": f"batch update of {entry_id}"}}
+        for entry_id in context.entry_ids[:50]
+    ]
+    response = context.client.post(f'/api/entries/batch/?token={context.token}', json={"operations": operations})
+    if response.status_code >= 400:
+        raise RuntimeError(f"POST /api/entries/batch/ failed with {response.status_code}")
+
+
+def _undo_adds(context):
+    """Keeps the journal size constant across the add_entry runs"""
+    for entry in context.storage.list_entries(limit=10):
+        if entry['title'] == 'benchmark':
+            context.storage.delete(entry['id'])
+
+
+SCENARIOS = [
+    Scenario('load_database (cold)', _load_database, setup=_invalidate_cache, backends=('blob', 'log')),
+    Scenario('load_database (cached)', _load_database, backends=('blob', 'log')),
+    Scenario('save_database', _save_database, setup=_loaded_database, backends=('blob', 'log')),
+
+    Scenario('GET /', _get(lambda c: '/')),
+    Scenario('GET /admin_login', _get(lambda c: '/admin_login')),
+    Scenario('POST /admin_login', _post(
+        lambda c, p: '/admin_login',
+        lambda c, p: {'username': 'admin', 'password': 'password'}
+    )),
+    Scenario('GET /update_credentials', _get(lambda c: '/update_credentials')),
+    Scenario('GET /upload_database', _get(lambda c: '/upload_database')),
+    Scenario('GET /view_entries', _get(lambda c: '/view_entries')),
+    Scenario('GET /view_entries (last page)', _get(lambda c: f'/view_entries?page={_last_page(c)}')),
+    Scenario('GET /search', _get(lambda c: '/search?q=coffee+morning')),
+    Scenario('GET /archive', _get(lambda c: f'/archive/{_middle_month(c)}')),
+    Scenario('GET /add_entry', _get(lambda c: '/add_entry')),
+    Scenario('POST /add_entry', _post(
+        lambda c, p: '/add_entry',
+        lambda c, p: {'title': 'benchmark', 'text': 'A benchmark entry. ' * 20}
+    ), setup=_undo_adds),
+    Scenario('GET /view_entry', _get(lambda c: f'/view_entry/{_middle_id(c)}')),
+    Scenario('GET /update_entry', _get(lambda c: f'/update_entry/{_middle_id(c)}')),
+    Scenario('POST /update_entry', _post(
+        lambda c, p: f'/update_entry/{_middle_id(c)}',
+        lambda c, p: {'title': 'Updated by the benchmark', 'text': 'Updated text. ' * 20,
+                      'version': c.storage.version()}
+    )),
+    Scenario('GET /delete_entry', _delete_added_entry, setup=_added_entry),
+    Scenario('GET /delete_past_backups', _get(lambda c: '/delete_past_backups')),
+    Scenario('POST /delete_past_backups', _post(
+        lambda c, p: '/delete_past_backups',
+        lambda c, p: {'delete_date': '1970-01-01'}
+    )),
+    Scenario('POST /restore_backup', _post(
+        lambda c, p: f'/restore_backup/{p}',
+        lambda c, p: {}
+    ), setup=_snapshot),
+
+    Scenario('GET /api/export/json/', _get(lambda c: f'/api/export/json/?token={c.token}')),
+    Scenario('GET /api/export/json/ (ndjson, gzip)', _get(lambda c: f'/api/export/json/?token={c.token}&format=ndjson&gzip=1')),
+    Scenario('POST /api/entries/batch/ (50 updates)', _batch_update),
+    Scenario('GET /api/statistics/', _get(lambda c: f'/api/statistics/?token={c.token}')),
+    Scenario('GET /api/calendar/', _get(lambda c: f'/api/calendar/?token={c.token}&year={_middle_month(c)[:4]}')),
+]
@@ -22,8 +22,120 @@ FERNET_FILE = BASE_DIR / '.fernetkey'
 
 ADMIN_JSON_FILE = BASE_DIR / 'admin.json'
 
+# The log of the app, written by the main process of each worker
+LOG_FILE = BASE_DIR / 'app.log'
+
 DEFAULT_ADMIN = {
     "admin_username": "admin",
     "admin_password_hash": "5e884898da28047151d0e56f8dc6292773603d0d6aabbdd62a11ef721d1542d8", # SHA256('password')
     "salt": ''
 }
+
+# Where and how journal entries are stored:
+#   'blob'   - JOURNAL_JSON_DB_PATH; every change re-encrypts and rewrites
+#              the whole file
+#   'log'    - JOURNAL_JSON_DB_PATH; every change is appended as an encrypted
+#              record to a log next to the file, which is folded back into it
+#              once it grows past LOG_COMPACTION_THRESHOLD bytes
+#   'sqlite' - SQLITE_DB_PATH; one row per entry with title and text
+#              encrypted per entry. Import an existing journal_entries.json
+#              with `flask --app run import-json journal_entries.json`
+#   'container' - CONTAINER_PATH; every entry is encrypted on its own in an
+#              append-only data file next to a small encrypted index, so one
+#              entry can be read without decrypting the others. Writes append
+#              their changes of the index to a log, folded into the index once
+#              it grows past LOG_COMPACTION_THRESHOLD bytes. The data file
+#              is compacted once less than CONTAINER_COMPACTION_RATIO of it
+#              is still in use
+#   'sharded' - SHARDS_DIR/<JOURNAL_NAME>/; the entries of each year in their
+#              own encrypted JSON file next to a small encrypted manifest, so
+#              a write only rewrites the file of its year (or appends to its
+#              log, like 'log', with SHARD_APPEND_ONLY). SHARDS_DIR can hold
+#              several independent journals; JOURNAL_NAME is the one served
+STORAGE_BACKEND = 'blob'
+LOG_COMPACTION_THRESHOLD = 1024 * 1024
+SQLITE_DB_PATH = BASE_DIR / 'journal_entries.sqlite3'
+CONTAINER_PATH = BASE_DIR / 'journal_entries.mcc'
+CONTAINER_COMPACTION_RATIO = 0.5
+SHARDS_DIR = BASE_DIR / 'journals'
+JOURNAL_NAME = 'default'
+SHARD_APPEND_ONLY = False
+
+# Serialization of the encrypted JOURNAL_JSON_DB_PATH: 'json', 'msgpack',
+# optionally compressed with '+zlib' or '+zstd' (e.g. 'msgpack+zstd').
+# 'msgpack' and 'zstd' need the msgpack and zstandard packages. Files are
+# read in whatever format they were written, so this can be changed at any
+# time; the next save uses the new format.
+DATABASE_FORMAT = 'json+zlib'
+
+# Timezone dates are displayed in, unless the admin picks another one on
+# /preferences (see app/timeformat.py)
+DISPLAY_TIMEZONE = 'Asia/Kolkata'
+
+# Paging of the entry listings (/view_entries and /api/entries/)
+ENTRIES_PER_PAGE = 20
+MAX_ENTRIES_PER_PAGE = 100
+
+# Journal statistics (app/statistics.py, /api/statistics/): the number of
+# recent weeks whose entry counts are listed and of longest entries shown
+STATISTICS_WEEKS = 12
+STATISTICS_LONGEST_ENTRIES = 5
+
+# Number of rendered entry cards and view_entry pages kept in memory, per
+# process (see app/caching.py)
+FRAGMENT_CACHE_SIZE = 1024
+
+# Timing instrumentation of requests, template rendering and the database
+# steps, exposed at /metrics (admin session or ?token=) for Prometheus.
+#   METRICS_JSON_LOG - also log every request as one JSON line to this file
+#                      (e.g. BASE_DIR / 'metrics.log'); None to disable
+#   METRICS_DIR      - directory where every worker process publishes its
+#                      histograms, so that /metrics reports all gunicorn
+#                      workers together; None to report only the worker
+#                      answering the scrape
+METRICS_ENABLED = True
+METRICS_JSON_LOG = None
+METRICS_DIR = None
+METRICS_PUBLISH_INTERVAL = 1.0
+
+# Background jobs (app/jobs.py): backups, compaction, search index rebuilds
+# and exports started with POST /api/jobs/export/. JOB_WORKERS threads per
+# process run at most JOB_QUEUE_SIZE queued jobs; JOBS_FILE remembers them
+# across restarts, along with the last JOB_HISTORY finished ones. Exports
+# are kept, encrypted, in EXPORTS_DIR for EXPORT_TTL seconds.
+JOBS_FILE = BASE_DIR / '.jobs.json'
+JOB_WORKERS = 2
+JOB_QUEUE_SIZE = 100
+JOB_HISTORY = 100
+EXPORTS_DIR = BASE_DIR / '.exports'
+EXPORT_TTL = 24 * 3600
+
+# Batched writes (POST /api/entries/batch/, see app/batch.py): at most
+# MAX_BATCH_OPERATIONS per request. The responses of applied batches are kept
+# by idempotency key in BATCH_IDEMPOTENCY_FILE for BATCH_IDEMPOTENCY_TTL
+# seconds, so a retried batch is answered without being applied again.
+MAX_BATCH_OPERATIONS = 1000
+BATCH_IDEMPOTENCY_FILE = BASE_DIR / '.batches.json'
+BATCH_IDEMPOTENCY_TTL = 24 * 3600
+
+# Media attached to entries (app/media.py): deduplicated blobs encrypted in
+# chunks of MEDIA_CHUNK_SIZE bytes, so they can be served by byte range.
+# Thumbnails of images are made by MEDIA_THUMBNAIL_WORKERS processes and
+# need the Pillow package.
+MEDIA_DIR = BASE_DIR / '.media'
+MEDIA_CHUNK_SIZE = 256 * 1024
+MAX_MEDIA_SIZE = 2 * 1024 * 1024 * 1024
+MEDIA_THUMBNAIL_SIZE = (320, 320)
+MEDIA_THUMBNAIL_WORKERS = 2
+
+# Retention of the backups, applied after every backup: the BACKUP_KEEP_LAST
+# newest ones are kept, plus the newest one of each of the last
+# BACKUP_KEEP_DAILY days and BACKUP_KEEP_WEEKLY weeks that have backups.
+# Set all three to None to keep every backup.
+BACKUP_KEEP_LAST = 10
+BACKUP_KEEP_DAILY = 7
+BACKUP_KEEP_WEEKLY = 4
+# The entry objects no snapshot refers to any more after a backup pruned
+# others are deleted by a job of their own, at most once per this many
+# seconds, as it reads every manifest
+BACKUP_GC_INTERVAL = 3600
@@ -0,0 +1,103 @@
+# scripts/stress_writes.py
+#
+# Multi-process stress test of the write path.
+#
+# Several worker processes hammer the add_entry route concurrently (through
+# the Flask test client) against a scratch copy of the data files, then the
+# script checks that every single entry made it into the database.
+#
+# Usage:
+#     python scripts/stress_writes.py [--backend blob|log|sqlite|container|sharded] [--processes 8] [--entries 25]
+
+import argparse, multiprocessing, sys, tempfile, time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+
+def configure(data_dir:Path, backend:str):
+    """Points the config at `data_dir`; must run before `app` is imported."""
+    sys.path.insert(0, str(ROOT_DIR))
+    import config
+
+    config.JOURNAL_JSON_DB_PATH = data_dir / 'journal_entries.json'
+    config.SQLITE_DB_PATH = data_dir / 'journal_entries.sqlite3'
+    config.CONTAINER_PATH = data_dir / 'journal_entries.mcc'
+    config.SHARDS_DIR = data_dir / 'journals'
+    config.BACKUP_DIR = data_dir / '.backups'
+    config.FERNET_FILE = data_dir / '.fernetkey'
+    config.ADMIN_JSON_FILE = data_dir / 'admin.json'
+    config.LOG_FILE = data_dir / 'app.log'
+    config.JOBS_FILE = data_dir / '.jobs.json'
+    config.BATCH_IDEMPOTENCY_FILE = data_dir / '.batches.json'
+    config.EXPORTS_DIR = data_dir / '.exports'
+    config.MEDIA_DIR = data_dir / '.media'
+    config.STORAGE_BACKEND = backend
+    # Make the log mode and the container index log compact while the
+    # workers are writing
+    config.LOG_COMPACTION_THRESHOLD = 16 * 1024
+
+
+def worker(data_dir:str, backend:str, worker_id:int, n_entries:int):
+    configure(Path(data_dir), backend)
+    from app import app
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['admin_logged_in'] = True
+
+    for i in range(n_entries):
+        response = client.post('/add_entry', data={'title': f'worker {worker_id} entry {i}', 'text': 'stress'})
+        if response.status_code != 302:
+            raise RuntimeError(f"add_entry failed with {response.status_code}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent add_entry stress test")
+    parser.add_argument('--backend', default='blob', choices=['blob', 'log', 'sqlite', 'container', 'sharded'])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--entries', type=int, default=25, help="entries added by each process")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        # Create the key and the blank database once, before the workers race for it
+        configure(Path(data_dir), args.backend)
+        import app  # noqa: F401
+
+        ctx = multiprocessing.get_context('spawn')
+        start = time.perf_counter()
+        processes = [
+            ctx.Process(target=worker, args=(data_dir, args.backend, i, args.entries))
+            for i in range(args.processes)
+        ]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        elapsed = time.perf_counter() - start
+
+        from app.database import get_storage, compact_journal
+        from app.jobs import get_job_queue
+        import config
+        if args.backend == 'log':
+            compact_journal(config.JOURNAL_JSON_DB_PATH)
+            # The compaction queues a backup, which must finish before the
+            # data directory is removed
+            get_job_queue().join()
+
+        storage = get_storage()
+        titles = {entry['title'] for entry in storage.iter_entries()}
+        expected = {f'worker {w} entry {i}' for w in range(args.processes) for i in range(args.entries)}
+
+        failed = [p.exitcode for p in processes if p.exitcode != 0]
+        missing = expected - titles
+        print(f"{len(expected)} writes by {args.processes} processes in {elapsed:.2f}s "
+              f"({args.backend}); stored {len(titles)}, missing {len(missing)}, "
+              f"version {storage.version()}")
+
+        if failed or missing:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ setup(
     author='Indrajit Ghosh',
     author_email='rs_math1902@isibang.ac.in',
     url='https://github.com/indrajit912/MindCanvas',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     install_requires=[
         "Flask",
         "gunicorn",
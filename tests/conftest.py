@@ -0,0 +1,90 @@
+# tests/conftest.py
+#
+# The config is pointed at a temporary directory before `app` is imported,
+# as done by the benchmarks, so the tests never touch the data or the log
+# next to config.py. Every test gets its own storage files in `tmp_path`,
+# opened through `open_storage()` as often as needed: two instances on the
+# same files stand for two worker processes. Processes spawned by the tests
+# inherit the directory through MINDCANVAS_TEST_DIR, and with it the key.
+
+import os, tempfile, uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import pytest
+
+from benchmarks.__main__ import BACKENDS, configure
+
+os.environ.setdefault('MINDCANVAS_TEST_DIR', tempfile.mkdtemp(prefix='mindcanvas-tests-'))
+configure(Path(os.environ['MINDCANVAS_TEST_DIR']), 'blob')
+
+from app import app
+from app.authentication import generate_token
+from app.database import JsonStorage, SQLiteStorage
+from app.container import ContainerStorage
+from app.sharding import ShardedStorage
+
+
+def make_entry(datetime_utc:datetime, title:str='', text:str='', entry_id:str=None):
+    """A new entry dict as stored"""
+    return {
+        "id": entry_id or str(uuid.uuid4()),
+        "title": title,
+        "text": text,
+        "datetime_utc": datetime_utc.isoformat(),
+        "media_content": []
+    }
+
+
+def sorted_ids(entries):
+    """The ids of `entries` in the order of the listings: descending (datetime_utc, id)"""
+    return [entry['id'] for entry in sorted(entries, key=lambda e: (e['datetime_utc'], e['id']), reverse=True)]
+
+
+@pytest.fixture
+def entries():
+    """Entries spread over two years, stored out of order, some sharing a datetime"""
+    base = datetime(2023, 12, 30, 12, tzinfo=timezone.utc)
+    offsets = [5, -3, 0, 48, 0, -30, 5, 400, -400, 0, 24, 5]
+    return [make_entry(base + timedelta(hours=hours), title=f'entry {i}', text=' '.join(['word'] * (i + 1)))
+            for i, hours in enumerate(offsets)]
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'slow: starts several processes (deselect with -m "not slow")')
+
+
+def open_backend(backend:str, directory:Path):
+    """A new instance of the storage `backend` on its files in `directory`"""
+    if backend == 'sqlite':
+        return SQLiteStorage(directory / 'journal.sqlite3')
+    if backend == 'container':
+        return ContainerStorage(directory / 'journal.mcc')
+    if backend == 'sharded':
+        return ShardedStorage(directory / 'journal')
+    return JsonStorage(directory / 'journal.json', append_only=backend == 'log')
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def open_storage(backend, tmp_path):
+    """Returns a function opening a new storage instance on the files of the test"""
+    return lambda: open_backend(backend, tmp_path)
+
+
+@pytest.fixture
+def storage(open_storage):
+    return open_storage()
+
+
+@pytest.fixture
+def client():
+    """A test client of the app, logged in as the admin; it serves the configured 'blob' storage"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['admin_logged_in'] = True
+        session['token'] = generate_token('admin')
+    return client
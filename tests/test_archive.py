@@ -0,0 +1,114 @@
+# tests/test_archive.py
+#
+# The date index behind the calendar archive.
+
+import re
+from datetime import datetime, timedelta, timezone
+from app.archive import DateIndex, local_range
+from app.timeformat import get_timezone
+from conftest import make_entry, sorted_ids
+
+TIMEZONE = 'Asia/Kolkata'
+
+
+def day_counts(storage):
+    """The entries per local day, counted from the stored entries"""
+    tz = get_timezone(TIMEZONE)
+    counts = {}
+    for entry in storage.iter_entries():
+        day = datetime.fromisoformat(entry['datetime_utc']).astimezone(tz).strftime('%Y-%m-%d')
+        counts[day] = counts.get(day, 0) + 1
+    return counts
+
+
+def indexed_day_counts(index):
+    counts = {}
+    for year in index.years(TIMEZONE):
+        counts.update(index.days(year, timezone=TIMEZONE))
+    return counts
+
+
+def test_counts(storage, entries):
+    for entry in entries:
+        storage.add(entry)
+    index = DateIndex(storage)
+    assert indexed_day_counts(index) == day_counts(storage)
+    assert sum(index.years(TIMEZONE).values()) == len(entries)
+    assert index.count(2024, timezone=TIMEZONE) == sum(
+        count for day, count in day_counts(storage).items() if day.startswith('2024'))
+
+
+def test_follows_the_writes(storage, entries):
+    for entry in entries:
+        storage.add(entry)
+    index = DateIndex(storage)
+    index.years(TIMEZONE)
+
+    storage.update(dict(entries[0], datetime_utc=datetime(2022, 6, 1, tzinfo=timezone.utc).isoformat()))
+    storage.delete(entries[1]['id'])
+    storage.add(make_entry(datetime(2021, 1, 1, tzinfo=timezone.utc)))
+    assert indexed_day_counts(index) == day_counts(storage)
+    assert set(index.years(TIMEZONE)) == {2021, 2022, 2023, 2024}
+
+
+def test_between_is_in_listing_order(storage, entries):
+    for entry in entries:
+        storage.add(entry)
+    index = DateIndex(storage)
+    start, end = local_range(2024, 1, timezone=TIMEZONE)
+    expected = [entry_id for entry_id in sorted_ids(entries)
+                if start <= datetime.fromisoformat(storage.get_entry(entry_id)['datetime_utc']) < end]
+    assert expected
+    assert index.between(start, end) == expected
+    assert index.between() == sorted_ids(entries)
+
+
+def test_write_of_a_second_instance(open_storage):
+    first, second = open_storage(), open_storage()
+    index = DateIndex(first)
+    first.add(make_entry(datetime(2022, 5, 5, tzinfo=timezone.utc)))
+    assert set(index.years(TIMEZONE)) == {2022}
+
+    # Missed by the index of the first instance, then a write of its own
+    second.add(make_entry(datetime(2020, 5, 5, tzinfo=timezone.utc)))
+    first.add(make_entry(datetime(2021, 5, 5, tzinfo=timezone.utc)))
+    assert set(index.years(TIMEZONE)) == {2020, 2021, 2022}
+
+
+def test_month_pages(client):
+    from app.archive import get_date_index
+    from app.database import get_storage
+
+    storage = get_storage()
+    base = datetime(2023, 12, 25, tzinfo=timezone.utc)
+    # Every other day and hour, ties included, around January
+    entries = [make_entry(base + timedelta(hours=13 * (i // 2)), title=f'entry {i}') for i in range(120)]
+    storage.import_entries(entries, replace=True)
+
+    index = get_date_index()
+    ids = []
+    for page in range(1, 20):
+        response = client.get(f'/archive/2024/1?per_page=7&page={page}')
+        assert response.status_code == 200
+        ids += re.findall(r'/view_entry/([0-9a-f-]+)', response.data.decode())
+    assert ids == index.between(*local_range(2024, 1))
+    assert len(ids) == index.count(2024, 1)
+
+    assert client.get('/archive/2024/13').status_code == 404
+
+
+def test_catches_up_without_rebuilding(open_storage, monkeypatch):
+    first, second = open_storage(), open_storage()
+    index = DateIndex(first)
+    moved = make_entry(datetime(2022, 5, 5, tzinfo=timezone.utc))
+    first.add(moved)
+    assert index.years(TIMEZONE) == {2022: 1}
+
+    def rebuild():
+        raise AssertionError('rebuilt')
+    monkeypatch.setattr(first, 'list_datetimes', rebuild)
+    added = make_entry(datetime(2020, 5, 5, tzinfo=timezone.utc))
+    second.add(added)
+    second.update(dict(moved, datetime_utc=datetime(2021, 5, 5, tzinfo=timezone.utc).isoformat()))
+    assert index.years(TIMEZONE) == {2021: 1, 2020: 1}
+    assert index.between() == [moved['id'], added['id']]
@@ -0,0 +1,151 @@
+# tests/test_backup.py
+#
+# The deduplicated backups: snapshots, the catalog, retention, garbage
+# collection and restoring.
+
+import os, time
+from datetime import datetime, timezone
+import pytest
+import app.backup
+from app.backup import collect_garbage, create_backup, delete_backups_before, list_backups, load_backup, select_retained
+from conftest import make_entry
+
+NOW = datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def backup_dir(tmp_path, monkeypatch):
+    """Points the backups at `tmp_path`; returns the jobs they queued"""
+    directory = tmp_path / 'backups'
+    for name, path in (('BACKUP_DIR', directory), ('OBJECTS_DIR', directory / 'objects'),
+                       ('SNAPSHOTS_DIR', directory / 'snapshots'), ('CATALOG_PATH', directory / 'catalog'),
+                       ('GC_MARKER_PATH', directory / 'gc')):
+        monkeypatch.setattr(app.backup, name, path)
+    jobs = []
+    monkeypatch.setattr(app.backup, 'submit_job', lambda kind, args=None, key=None: jobs.append(kind))
+    return jobs
+
+
+def journal(*titles):
+    return {"entries": [make_entry(NOW, title=title, entry_id=f'00000000-0000-0000-0000-{i:012d}')
+                        for i, title in enumerate(titles)]}
+
+
+def test_garbage_is_collected_by_a_job_after_pruning(backup_dir, monkeypatch):
+    monkeypatch.setattr(app.backup, 'BACKUP_KEEP_LAST', 2)
+    monkeypatch.setattr(app.backup, 'BACKUP_KEEP_DAILY', 0)
+    monkeypatch.setattr(app.backup, 'BACKUP_KEEP_WEEKLY', 0)
+    create_backup(journal('a'))
+    create_backup(journal('b'))
+    # Nothing pruned, nothing to collect
+    assert backup_dir == []
+
+    create_backup(journal('c'))
+    assert backup_dir == ['collect_backup_garbage']
+    assert len(os.listdir(app.backup.OBJECTS_DIR)) == 3
+
+    collect_garbage()
+    assert len(os.listdir(app.backup.OBJECTS_DIR)) == 2
+    assert [load_backup(backup['file'])['entries'][0]['title'] for backup in list_backups()] == ['c', 'b']
+
+    # Not queued again before BACKUP_GC_INTERVAL
+    create_backup(journal('d'))
+    assert backup_dir == ['collect_backup_garbage']
+    past = time.time() - app.backup.BACKUP_GC_INTERVAL - 1
+    os.utime(app.backup.GC_MARKER_PATH, (past, past))
+    create_backup(journal('e'))
+    assert backup_dir == ['collect_backup_garbage'] * 2
+
+
+def backups_at(*days_and_hours):
+    """Catalog items of backups taken at (day of March 2024, hour), as given"""
+    return [{"file": f'backup_{day}_{hour}', "timestamp": datetime(2024, 3, day, hour).timestamp()}
+            for day, hour in days_and_hours]
+
+
+def test_retention_keeps_the_last_ones():
+    backups = backups_at((9, 12), (9, 11), (9, 10), (8, 12))
+    assert select_retained(backups, keep_last=2, keep_daily=0, keep_weekly=0) == {'backup_9_12', 'backup_9_11'}
+    assert select_retained(backups, keep_last=None, keep_daily=None, keep_weekly=None) == set()
+
+
+def test_retention_keeps_the_newest_of_each_day():
+    # Saturday 9 to Monday 4 March 2024
+    backups = backups_at((9, 12), (9, 11), (8, 20), (8, 9), (6, 1), (4, 23), (4, 8))
+    assert select_retained(backups, keep_last=1, keep_daily=3, keep_weekly=0) == {
+        'backup_9_12', 'backup_8_20', 'backup_6_1'}
+    assert select_retained(backups, keep_last=0, keep_daily=10, keep_weekly=0) == {
+        'backup_9_12', 'backup_8_20', 'backup_6_1', 'backup_4_23'}
+
+
+def test_retention_keeps_the_newest_of_each_week():
+    # Weeks 10 (4 to 10 March), 9 and 8 of 2024
+    backups = backups_at((9, 12), (4, 8), (3, 20), (1, 9)) + [
+        {"file": 'backup_feb_20', "timestamp": datetime(2024, 2, 20, 12).timestamp()},
+        {"file": 'backup_feb_19', "timestamp": datetime(2024, 2, 19, 12).timestamp()}]
+    assert select_retained(backups, keep_last=0, keep_daily=0, keep_weekly=2) == {'backup_9_12', 'backup_3_20'}
+    assert select_retained(backups, keep_last=0, keep_daily=1, keep_weekly=3) == {
+        'backup_9_12', 'backup_3_20', 'backup_feb_20'}
+
+
+def test_unchanged_content_is_not_backed_up_again(backup_dir):
+    first = create_backup(journal('a', 'b'))
+    assert create_backup(journal('a', 'b')) == first
+    second = create_backup(journal('a', 'changed'))
+    assert second != first
+    # 'a' is stored once
+    assert len(os.listdir(app.backup.OBJECTS_DIR)) == 3
+    assert [backup['file'] for backup in list_backups()] == [second, first]
+
+
+def test_catalog(backup_dir):
+    snapshot_id = create_backup(journal('a', 'b'))
+    backup = list_backups()[0]
+    assert backup['file'] == snapshot_id and backup['entries'] == 2 and not backup['legacy']
+    assert backup['size'] == sum(os.path.getsize(app.backup.OBJECTS_DIR / name)
+                                 for name in os.listdir(app.backup.OBJECTS_DIR))
+
+    # A plaintext backup of an older release
+    (app.backup.BACKUP_DIR / 'backup_2020-01-01_10-00-00.json').write_text('{"entries": []}')
+    # Rebuilt from the files when missing
+    os.remove(app.backup.CATALOG_PATH)
+    backups = list_backups()
+    assert [(backup['file'], backup['legacy']) for backup in backups] == [
+        (snapshot_id, False), ('backup_2020-01-01_10-00-00.json', True)]
+    assert backups[0]['checksum'] == backup['checksum'] and backups[0]['size'] == backup['size']
+
+    assert delete_backups_before(datetime(2021, 1, 1)) == 1
+    assert [backup['file'] for backup in list_backups()] == [snapshot_id]
+
+
+def test_load_backup(backup_dir):
+    content = journal('a', 'b')
+    snapshot_id = create_backup(content)
+    create_backup(journal('c'))
+    assert load_backup(snapshot_id) == content
+
+    with pytest.raises(FileNotFoundError):
+        load_backup('backup_2020-01-01_10-00-00-000000')
+    with pytest.raises(ValueError):
+        load_backup('../catalog')
+
+
+def test_restore_route(client, backup_dir):
+    from app.database import get_storage
+    storage = get_storage()
+    content = journal('a', 'b')
+    storage.replace_all(content['entries'])
+    snapshot_id = create_backup(storage.load())
+    storage.replace_all(journal('changed')['entries'])
+
+    assert client.post(f'/restore_backup/{snapshot_id}').status_code == 302
+    assert sorted(entry['title'] for entry in storage.iter_entries()) == ['a', 'b']
+    assert client.post('/restore_backup/backup_2020-01-01_10-00-00-000000').status_code == 404
+
+
+@pytest.mark.parametrize('snapshot_id', ['..', '.', 'catalog', 'backup_x', 'backup_2020-01-01_10-00-00.json',
+                                         '%2E%2E', 'backup_2020-01-01_10-00-00-000000.tmp'])
+def test_restore_route_refuses_other_ids(client, backup_dir, snapshot_id):
+    app.backup.SNAPSHOTS_DIR.mkdir(parents=True)
+    (app.backup.SNAPSHOTS_DIR / 'backup_2020-01-01_10-00-00-000000.tmp').write_bytes(b'')
+    assert client.post(f'/restore_backup/{snapshot_id}').status_code == 404
@@ -0,0 +1,95 @@
+# tests/test_batch.py
+#
+# Batched writes.
+
+import uuid
+from datetime import datetime, timezone
+import pytest
+from app.batch import IdempotencyKeyReused, apply_batch, apply_idempotent_batch
+from conftest import make_entry
+
+NOW = datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+
+def test_applied_in_one_write(storage):
+    kept, removed = make_entry(NOW, title='kept'), make_entry(NOW, title='removed')
+    storage.add(kept)
+    storage.add(removed)
+    version = storage.version()
+
+    new_id = str(uuid.uuid4())
+    response = apply_batch([
+        {"op": "create", "entry": {"id": new_id, "title": "new", "text": "hello", "datetime_utc": NOW.isoformat()}},
+        {"op": "update", "entry": {"id": kept['id'], "title": "changed"}},
+        {"op": "delete", "id": removed['id']}
+    ], storage)
+
+    assert response['applied']
+    assert response['version'] == storage.version() == version + 1
+    assert [result['status'] for result in response['results']] == ['created', 'updated', 'deleted']
+    assert storage.get_entry(new_id)['text'] == 'hello'
+    assert storage.get_entry(kept['id'])['title'] == 'changed'
+    assert storage.get_entry(removed['id']) is None
+
+
+def test_nothing_written_when_an_operation_fails(storage):
+    entry = make_entry(NOW, title='entry')
+    storage.add(entry)
+    version = storage.version()
+
+    response = apply_batch([
+        {"op": "update", "entry": {"id": entry['id'], "title": "changed"}},
+        {"op": "delete", "id": str(uuid.uuid4())},
+        {"op": "update", "entry": {"id": entry['id'], "title": "again"}, "expected_version": -1}
+    ], storage)
+
+    assert not response['applied']
+    assert [result['status'] for result in response['results']] == ['skipped', 'not_found', 'stale']
+    assert storage.version() == version
+    assert storage.get_entry(entry['id'])['title'] == 'entry'
+
+
+def test_operations_see_the_earlier_ones(storage):
+    new_id = str(uuid.uuid4())
+    response = apply_batch([
+        {"op": "create", "entry": {"id": new_id, "title": "new", "datetime_utc": NOW.isoformat()}},
+        {"op": "update", "entry": {"id": new_id, "text": "written"}},
+        {"op": "delete", "id": new_id},
+        {"op": "delete", "id": new_id}
+    ], storage)
+    assert [result['status'] for result in response['results']] == ['skipped', 'skipped', 'skipped', 'not_found']
+
+    response = apply_batch([
+        {"op": "create", "entry": {"id": new_id, "title": "new", "datetime_utc": NOW.isoformat()}},
+        {"op": "update", "entry": {"id": new_id, "text": "written"}}
+    ], storage)
+    assert response['applied']
+    assert storage.get_entry(new_id)['text'] == 'written'
+
+
+def test_idempotency_key(storage):
+    key = uuid.uuid4().hex
+    payload = {"operations": [{"op": "create", "entry": {"title": "once", "datetime_utc": NOW.isoformat()}}]}
+
+    response, replayed = apply_idempotent_batch(payload, key, storage)
+    assert response['applied'] and not replayed
+    version = storage.version()
+
+    again, replayed = apply_idempotent_batch(payload, key, storage)
+    assert replayed and again == response
+    assert storage.version() == version
+    assert storage.count() == 1
+
+    with pytest.raises(IdempotencyKeyReused):
+        apply_idempotent_batch({"operations": [{"op": "delete", "id": response['results'][0]['id']}]}, key, storage)
+
+
+def test_batch_of_a_second_instance(open_storage):
+    first, second = open_storage(), open_storage()
+    entry = make_entry(NOW, title='entry')
+    first.add(entry)
+
+    response = apply_batch([{"op": "update", "entry": {"id": entry['id'], "title": "changed"}}], second)
+    assert response['applied']
+    assert first.get_entry(entry['id'])['title'] == 'changed'
+    assert first.version() == response['version']
@@ -0,0 +1,90 @@
+# tests/test_caching.py
+#
+# The caching of rendered pages: fragments and conditional requests.
+
+import io
+from datetime import datetime, timezone
+import pytest
+from app import app
+from app.authentication import generate_token
+from app.caching import FragmentCache, fragment_cache
+from app.database import get_storage
+from app.media import attach_media
+from conftest import make_entry
+
+NOW = datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def anonymous():
+    return app.test_client()
+
+
+def test_entry_page_renders_the_media_for_the_admin_only(client, anonymous):
+    entry = make_entry(NOW, title='with media', text='some text')
+    get_storage().add(entry)
+    item = attach_media(entry['id'], io.BytesIO(b'content'), 'notes.txt', 'text/plain')
+    media_url = f"/api/entries/{entry['id']}/media/{item['hash']}/"
+
+    # Rendered for the visitor first, so its cached part is reused for the admin
+    page = anonymous.get(f"/view_entry/{entry['id']}").get_data(as_text=True)
+    assert 'some text' in page and media_url not in page and '1 attached media' in page
+    assert anonymous.get(media_url).status_code == 401
+
+    hits = fragment_cache.hits
+    page = client.get(f"/view_entry/{entry['id']}").get_data(as_text=True)
+    assert fragment_cache.hits == hits + 1
+    assert 'some text' in page and media_url in page
+    assert client.get(media_url).status_code == 200
+
+
+def test_fragment_cache_evicts_the_least_recently_used():
+    cache = FragmentCache(maxsize=2)
+    cache.get_or_render('a', lambda: 'A')
+    cache.get_or_render('b', lambda: 'B')
+    assert cache.get_or_render('a', lambda: 'other') == 'A'
+    cache.get_or_render('c', lambda: 'C')
+    assert cache.get_or_render('b', lambda: 'B again') == 'B again'
+    assert cache.get_or_render('a', lambda: 'A again') == 'A again'
+    assert cache.stats() == {"hits": 1, "misses": 5, "size": 2}
+
+
+def test_unchanged_page_is_not_modified(client):
+    get_storage().add(make_entry(NOW, title='first'))
+    response = client.get('/view_entries')
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    assert response.status_code == 200 and response.headers['Cache-Control'] == 'private, no-cache'
+
+    response = client.get('/view_entries', headers={'If-None-Match': etag})
+    assert response.status_code == 304 and response.data == b'' and response.headers['ETag'] == etag
+    assert client.get('/view_entries', headers={'If-Modified-Since': last_modified}).status_code == 304
+
+    # Another page, or a write, changes the ETag
+    assert client.get('/view_entries?per_page=5', headers={'If-None-Match': etag}).status_code == 200
+    get_storage().add(make_entry(NOW, title='second'))
+    response = client.get('/view_entries', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag and 'second' in response.get_data(as_text=True)
+
+
+def test_etag_depends_on_the_viewer(client, anonymous):
+    entry = make_entry(NOW, title='viewed')
+    get_storage().add(entry)
+    etag = client.get(f"/view_entry/{entry['id']}").headers['ETag']
+    assert anonymous.get(f"/view_entry/{entry['id']}", headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_pending_flash_messages_are_rendered(client):
+    etag = client.get('/view_entries').headers['ETag']
+    with client.session_transaction() as session:
+        session['_flashes'] = [('message', 'Flashed!')]
+    response = client.get('/view_entries', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and 'Flashed!' in response.get_data(as_text=True)
+    assert 'ETag' not in response.headers
+
+
+def test_api_listing_is_not_modified(client):
+    query = {"token": generate_token('admin')}
+    etag = client.get('/api/entries/', query_string=query).headers['ETag']
+    assert client.get('/api/entries/', query_string=query, headers={'If-None-Match': etag}).status_code == 304
+    get_storage().add(make_entry(NOW))
+    assert client.get('/api/entries/', query_string=query, headers={'If-None-Match': etag}).status_code == 200
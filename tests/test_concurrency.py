@@ -0,0 +1,47 @@
+# tests/test_concurrency.py
+#
+# Several processes writing through JournalStorage at once.
+
+import multiprocessing
+from datetime import datetime, timedelta, timezone
+import pytest
+from conftest import make_entry, open_backend
+
+NOW = datetime(2024, 3, 1, tzinfo=timezone.utc)
+PROCESSES = 4
+ENTRIES = 10
+
+
+def write_concurrently(backend:str, directory, worker_id:int, counter_id:str):
+    """Adds ENTRIES entries, and increments the counter entry after each one"""
+    storage = open_backend(backend, directory)
+    for i in range(ENTRIES):
+        storage.add(make_entry(NOW + timedelta(minutes=i), title=f'worker {worker_id} entry {i}'))
+        # A read-modify-write cycle, serialized by the write lock
+        with storage.write_lock():
+            counter = storage.get_entry(counter_id)
+            storage.update(dict(counter, text=str(int(counter['text']) + 1)))
+
+
+@pytest.mark.slow
+def test_no_write_is_lost(open_storage, backend, tmp_path):
+    storage = open_storage()
+    counter = make_entry(NOW - timedelta(days=1), title='counter', text='0')
+    storage.add(counter)
+
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=write_concurrently, args=(backend, tmp_path, i, counter['id']))
+                 for i in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=120)
+    assert [process.exitcode for process in processes] == [0] * PROCESSES
+
+    storage = open_storage()
+    titles = {entry['title'] for entry in storage.iter_entries()}
+    assert titles == {'counter'} | {f'worker {w} entry {i}' for w in range(PROCESSES) for i in range(ENTRIES)}
+    assert storage.get_entry(counter['id'])['text'] == str(PROCESSES * ENTRIES)
+    # Every write got a version of its own
+    assert storage.version() == 1 + 2 * PROCESSES * ENTRIES
+    assert storage.changes_since(1) == (storage.version(), {entry['id'] for entry in storage.iter_entries()})
@@ -0,0 +1,142 @@
+# tests/test_container.py
+#
+# What is specific to the random-access encrypted container.
+
+import json
+from datetime import datetime, timezone
+from app.container import ContainerStorage
+from app.database import summarize_entry
+from app.keys import get_cipher
+from conftest import make_entry, sorted_ids
+
+NOW = datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+
+def test_compaction_keeps_the_live_records(tmp_path, entries):
+    storage = ContainerStorage(tmp_path / 'journal.mcc')
+    for entry in entries:
+        storage.add(entry)
+    for entry in entries[:6]:
+        storage.update(dict(entry, text='replaced ' * 50))
+    storage.delete(entries[6]['id'])
+    version = storage.version()
+    data_file = tmp_path / storage._read_index()[0]['data_file']
+    size = data_file.stat().st_size
+
+    storage.compact()
+    index = storage._read_index()[0]
+    assert not data_file.exists()
+    assert (tmp_path / index['data_file']).stat().st_size < size
+    assert index['live_bytes'] == (tmp_path / index['data_file']).stat().st_size
+    assert storage.version() == version
+    assert [entry['id'] for entry in storage.list_entries()] == sorted_ids(entries[:6] + entries[7:])
+    assert storage.get_entry(entries[0]['id'])['text'] == 'replaced ' * 50
+
+
+def test_unsorted_index_is_sorted_on_read(tmp_path, entries):
+    storage = ContainerStorage(tmp_path / 'journal.mcc')
+    for entry in entries:
+        storage.add(entry)
+    # As written before the index was kept sorted
+    index = storage._read_index()[0]
+    storage._write_index(dict(index, entries=list(reversed(index['entries']))))
+
+    other = ContainerStorage(tmp_path / 'journal.mcc')
+    assert [summary['id'] for summary in other.list_summaries()] == sorted_ids(entries)
+    added = make_entry(NOW)
+    other.add(added)
+    assert [entry['id'] for entry in storage.list_entries()] == sorted_ids(entries + [added])
+
+
+def test_writes_append_to_the_index_log(tmp_path, entries):
+    storage = ContainerStorage(tmp_path / 'journal.mcc')
+    storage.add(entries[0])
+    signature = storage.signature()[0]
+
+    other = ContainerStorage(tmp_path / 'journal.mcc')
+    assert other.count() == 1
+    for entry in entries[1:]:
+        storage.add(entry)
+    storage.update(dict(entries[0], title='changed'))
+    storage.delete(entries[1]['id'])
+
+    # The index itself isn't rewritten, and the other instance reads the end of the log
+    assert storage.signature()[0] == signature
+    assert len(storage.log_path.read_bytes().splitlines()) == len(entries) + 2
+    expected = sorted_ids(entries[:1] + entries[2:])
+    assert [summary['id'] for summary in other.list_summaries()] == expected
+    assert other.get_summaries([entries[0]['id']])[0]['title'] == 'changed'
+    assert other.list_datetimes() == [(entry_id, storage.get_entry(entry_id)['datetime_utc']) for entry_id in expected]
+
+
+def test_the_log_is_folded_into_the_index(tmp_path, entries, monkeypatch):
+    import app.container
+    monkeypatch.setattr(app.container, 'LOG_COMPACTION_THRESHOLD', 2000)
+    storage = ContainerStorage(tmp_path / 'journal.mcc')
+    other = ContainerStorage(tmp_path / 'journal.mcc')
+    for i, entry in enumerate(entries):
+        (storage if i % 2 else other).add(entry)
+        assert not storage.log_path.exists() or storage.log_path.stat().st_size < 2000
+    assert [summary['id'] for summary in storage.list_summaries()] == sorted_ids(entries)
+    assert [summary['id'] for summary in other.list_summaries()] == sorted_ids(entries)
+    assert storage.version() == other.version() == len(entries)
+
+
+def test_skips_a_log_line_cut_short(tmp_path, entries):
+    storage = ContainerStorage(tmp_path / 'journal.mcc')
+    storage.add(entries[0])
+    with open(storage.log_path, 'ab') as f:
+        f.write(b'gAAAAAcut')
+    storage.add(entries[1])
+    other = ContainerStorage(tmp_path / 'journal.mcc')
+    assert [summary['id'] for summary in other.list_summaries()] == sorted_ids(entries[:2])
+
+
+def test_the_log_of_a_replaced_index_is_ignored(tmp_path, entries):
+    storage = ContainerStorage(tmp_path / 'journal.mcc')
+    for entry in entries[:3]:
+        storage.add(entry)
+    stale_log = storage.log_path.read_bytes()
+    storage.compact()
+    # As left by a crash between writing the new index and removing the log
+    storage.log_path.write_bytes(stale_log)
+
+    other = ContainerStorage(tmp_path / 'journal.mcc')
+    assert [summary['id'] for summary in other.list_summaries()] == sorted_ids(entries[:3])
+    other.add(entries[3])
+    assert [summary['id'] for summary in storage.list_summaries()] == sorted_ids(entries[:4])
+
+
+def test_index_with_summaries_is_read(tmp_path, entries):
+    # As written when the summaries were kept in the index, one token per record
+    storage = ContainerStorage(tmp_path / 'journal.mcc')
+    fer, items, offset = get_cipher(), [], 0
+    with open(tmp_path / 'journal.mcc.0.data', 'wb') as f:
+        for entry in entries[:4]:
+            token = fer.encrypt(json.dumps(entry).encode())
+            summary = summarize_entry(entry)
+            items.append([entry['id'], offset, len(token), entry['datetime_utc'],
+                          {key: summary[key] for key in ('title', 'snippet', 'length', 'revision')}])
+            f.write(token + b'\n')
+            offset += len(token) + 1
+    storage._write_index({"version": 4, "data_file": 'journal.mcc.0.data', "live_bytes": offset, "entries": items})
+
+    storage.add(entries[4])
+    titles = {entry['id']: entry['title'] for entry in entries}
+    assert [summary['title'] for summary in storage.list_summaries()] == [titles[entry_id] for entry_id in sorted_ids(entries[:5])]
+    assert storage.get_entry(entries[0]['id']) == entries[0]
+    storage.compact()
+    assert [entry['id'] for entry in storage.list_entries()] == sorted_ids(entries[:5])
+
+
+def test_rewrite_keeps_the_last_duplicate(tmp_path, entries):
+    storage = ContainerStorage(tmp_path / 'journal.mcc')
+    storage.import_entries(entries + [dict(entry, title='again') for entry in entries[:3]])
+    assert storage.count() == len(entries)
+    assert storage.get_entry(entries[0]['id'])['title'] == 'again'
+    # The earlier records are garbage
+    index = storage._read_index()[0]
+    assert index['live_bytes'] < (tmp_path / index['data_file']).stat().st_size
+    storage.compact()
+    index = storage._read_index()[0]
+    assert index['live_bytes'] == (tmp_path / index['data_file']).stat().st_size
@@ -0,0 +1,136 @@
+# tests/test_database.py
+#
+# The encrypted database file: the in-process cache of its decrypted content
+# and the journal log of the 'log' backend.
+
+import os
+from datetime import datetime, timezone
+import app.database, app.jobs
+from app.database import JsonStorage, compact_journal, db_cache, journal_log_path, load_database, save_database
+from conftest import make_entry, sorted_ids
+
+
+def journal(*titles):
+    return {"version": 1, "entries": [make_entry(datetime(2024, 1, 1, tzinfo=timezone.utc), title=title)
+                                      for title in titles]}
+
+
+def test_loads_are_served_from_the_cache(tmp_path):
+    path = tmp_path / 'journal.json'
+    content = journal('a', 'b')
+    save_database(content, path)
+    stats = db_cache.stats()
+    assert load_database(path) == content
+    assert load_database(path) == content
+    assert db_cache.stats()['hits'] == stats['hits'] + 2
+
+
+def test_a_change_on_disk_invalidates_the_cache(tmp_path):
+    path = tmp_path / 'journal.json'
+    save_database(journal('a'), path)
+    written_elsewhere = path.read_bytes()
+    save_database(journal('b'), path)
+    assert load_database(path)['entries'][0]['title'] == 'b'
+
+    # Another process writes the file
+    stats = db_cache.stats()
+    path.write_bytes(written_elsewhere)
+    assert load_database(path)['entries'][0]['title'] == 'a'
+    assert db_cache.stats()['misses'] == stats['misses'] + 1
+
+    path.unlink()
+    assert db_cache.get(path) is None
+
+
+def test_loads_are_copies(tmp_path):
+    path = tmp_path / 'journal.json'
+    save_database(journal('a'), path)
+    content = load_database(path)
+    content['entries'][0]['title'] = 'changed'
+    content['entries'].append(make_entry(datetime(2024, 1, 2, tzinfo=timezone.utc)))
+    assert [entry['title'] for entry in load_database(path)['entries']] == ['a']
+
+    # Unless asked not to copy
+    assert load_database(path, copy=False) is load_database(path, copy=False)
+
+
+def test_saved_content_is_copied(tmp_path):
+    path = tmp_path / 'journal.json'
+    content = journal('a')
+    save_database(content, path)
+    content['entries'][0]['title'] = 'changed'
+    assert load_database(path)['entries'][0]['title'] == 'a'
+
+
+def write_all(storage, entries):
+    """Adds `entries`, changes the first one and deletes the last one; returns the expected entries"""
+    for entry in entries:
+        storage.add(entry)
+    storage.update(dict(entries[0], title='changed'))
+    storage.delete(entries[-1]['id'])
+    return [dict(entries[0], title='changed')] + entries[1:-1]
+
+
+def reloaded(path):
+    """The entries as read from the files by another process"""
+    db_cache.invalidate(path)
+    return JsonStorage(path, append_only=True).list_entries()
+
+
+def test_writes_are_appended_to_the_log(tmp_path, entries):
+    path = tmp_path / 'journal.json'
+    storage = JsonStorage(path, append_only=True)
+    storage.add(entries[0])
+    snapshot = path.read_bytes()
+    expected = write_all(storage, entries[1:])
+
+    assert path.read_bytes() == snapshot
+    assert len(journal_log_path(path).read_bytes().splitlines()) == len(entries) + 2
+    assert [entry['id'] for entry in reloaded(path)] == sorted_ids([entries[0]] + expected)
+    assert {entry['title'] for entry in reloaded(path)} == {entry['title'] for entry in [entries[0]] + expected}
+
+
+def test_compact_journal(tmp_path, entries):
+    path = tmp_path / 'journal.json'
+    expected = write_all(JsonStorage(path, append_only=True), entries)
+    version = load_database(path)['version']
+
+    compact_journal(path)
+    assert not journal_log_path(path).exists()
+    db_cache.invalidate(path)
+    content = load_database(path)
+    assert content['version'] == version
+    assert [entry['id'] for entry in reloaded(path)] == sorted_ids(expected)
+
+
+def test_interrupted_compaction_loses_nothing(tmp_path, entries):
+    path = tmp_path / 'journal.json'
+    storage = JsonStorage(path, append_only=True)
+    expected = write_all(storage, entries[:6])
+    # A compaction set the log aside and stopped
+    log_path = journal_log_path(path)
+    compacting_path = log_path.with_name(log_path.name + '.compacting')
+    os.replace(log_path, compacting_path)
+    expected += write_all(storage, entries[6:])
+
+    assert [entry['id'] for entry in reloaded(path)] == sorted_ids(expected)
+    # Both logs are folded in, but only the one set aside is removed; replaying
+    # the newer one again is harmless until the next compaction
+    compact_journal(path)
+    assert not compacting_path.exists()
+    assert [entry['id'] for entry in reloaded(path)] == sorted_ids(expected)
+    compact_journal(path)
+    assert not log_path.exists()
+    assert [entry['id'] for entry in reloaded(path)] == sorted_ids(expected)
+
+
+def test_compaction_is_queued_past_the_threshold(tmp_path, entries, monkeypatch):
+    jobs = []
+    monkeypatch.setattr(app.jobs, 'submit_job', lambda kind, args=None, key=None: jobs.append(kind))
+    storage = JsonStorage(tmp_path / 'journal.json', append_only=True)
+    storage.add(entries[0])
+    assert jobs == []
+
+    monkeypatch.setattr(app.database, 'LOG_COMPACTION_THRESHOLD', 1)
+    storage.add(entries[1])
+    assert jobs == ['compact_journal']
@@ -0,0 +1,103 @@
+# tests/test_export.py
+#
+# The exports of the journal: streamed by /api/export/json/ or written
+# encrypted by an export job and downloaded afterwards.
+
+import gzip, json, os, time
+import pytest
+import app.export
+from app.authentication import generate_token
+from app.database import get_storage
+from app.export import gzip_stream, iter_export_file, iter_json_export, iter_ndjson_export, write_export_file
+from app.jobs import get_job_queue
+
+
+@pytest.fixture
+def exports_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app.export, 'EXPORTS_DIR', tmp_path / 'exports')
+    # Several encrypted chunks even for a small journal
+    monkeypatch.setattr(app.export, 'EXPORT_CHUNK_SIZE', 256)
+    return tmp_path / 'exports'
+
+
+def test_formats(entries):
+    assert json.loads(''.join(iter_json_export(entries))) == {"entries": entries}
+    assert json.loads(''.join(iter_json_export([]))) == {"entries": []}
+    assert [json.loads(line) for line in ''.join(iter_ndjson_export(entries)).splitlines()] == entries
+    assert gzip.decompress(b''.join(gzip_stream(iter_json_export(entries)))).decode() == ''.join(iter_json_export(entries))
+
+
+def test_entries_are_serialized_one_by_one(entries):
+    consumed = []
+
+    def iter_entries():
+        for entry in entries:
+            consumed.append(entry['id'])
+            yield entry
+
+    chunks = iter_json_export(iter_entries())
+    next(chunks), next(chunks)
+    assert len(consumed) == 1
+
+
+def test_export_file(exports_dir, entries):
+    export = write_export_file('one', iter(entries), 'ndjson')
+    content = ''.join(iter_ndjson_export(entries)).encode()
+    assert export == {"file": 'one.export', "bytes": len(content)}
+
+    data = (exports_dir / 'one.export').read_bytes()
+    assert 1 < len(data.splitlines()) <= len(entries)
+    assert entries[0]['title'].encode() not in data
+    assert b''.join(iter_export_file('one.export')) == content
+
+    export = write_export_file('two', iter(entries), 'json', gzip=True)
+    assert json.loads(gzip.decompress(b''.join(iter_export_file(export['file'])))) == {"entries": entries}
+
+    with pytest.raises(ValueError):
+        next(iter_export_file('../one.export'))
+
+
+def test_expired_exports_are_removed(exports_dir, entries):
+    write_export_file('old', iter(entries))
+    past = time.time() - app.export.EXPORT_TTL - 1
+    os.utime(exports_dir / 'old.export', (past, past))
+    write_export_file('new', iter(entries))
+    assert os.listdir(exports_dir) == ['new.export']
+
+
+def test_export_route_streams(client, entries):
+    get_storage().replace_all(entries)
+    token = generate_token('admin')
+
+    response = client.get('/api/export/json/', query_string={"token": token})
+    assert response.is_streamed and response.mimetype == 'application/json'
+    exported = json.loads(response.data)['entries']
+    assert sorted((e['id'], e['text']) for e in exported) == sorted((e['id'], e['text']) for e in entries)
+
+    response = client.get('/api/export/json/', query_string={"token": token, "format": 'ndjson', "gzip": 1, "download": 1})
+    assert response.mimetype == 'application/gzip' and 'Content-Encoding' not in response.headers
+    assert response.headers['Content-Disposition'] == 'attachment; filename="mindcanvas_data.ndjson.gz"'
+    assert len(gzip.decompress(response.data).splitlines()) == len(entries)
+
+    assert client.get('/api/export/json/', query_string={"token": token, "format": 'xml'}).status_code == 400
+    assert client.get('/api/export/json/', query_string={"token": 'x'}).status_code == 401
+
+
+def test_export_job(client, exports_dir, entries):
+    get_storage().replace_all(entries)
+    token = generate_token('admin')
+
+    response = client.post('/api/jobs/export/', query_string={"token": token, "format": 'ndjson'})
+    assert response.status_code == 202
+    job_id = response.get_json()['id']
+    get_job_queue().join()
+    assert client.get(response.headers['Location']).get_json()['status'] == 'done'
+
+    response = client.get(f'/api/jobs/{job_id}/download/', query_string={"token": token})
+    assert response.headers['Content-Disposition'] == 'attachment; filename="mindcanvas_data.ndjson"'
+    assert int(response.headers['Content-Length']) == len(response.data)
+    assert sorted(json.loads(line)['id'] for line in response.data.splitlines()) == sorted(e['id'] for e in entries)
+
+    # Gone once expired
+    os.remove(exports_dir / f'{job_id}.export')
+    assert client.get(f'/api/jobs/{job_id}/download/', query_string={"token": token}).status_code == 410
@@ -0,0 +1,128 @@
+# tests/test_importer.py
+#
+# The streaming import of uploaded journal data.
+
+import io, json, uuid
+from datetime import datetime, timezone
+import pytest
+from app.importer import ImportFormatError, import_upload, iter_upload_records
+from conftest import make_entry, sorted_ids
+
+
+def upload(content):
+    return io.BytesIO(content if isinstance(content, bytes) else json.dumps(content).encode())
+
+
+@pytest.mark.parametrize('layout', ['database', 'array', 'ndjson'])
+def test_replace(storage, entries, layout):
+    storage.add(make_entry(datetime(2020, 1, 1, tzinfo=timezone.utc)))
+    if layout == 'database':
+        content = {"version": 3, "entries": entries}
+    elif layout == 'array':
+        content = entries
+    else:
+        content = b''.join(json.dumps(entry).encode() + b'\n' for entry in entries)
+
+    report = import_upload(upload(content), 'replace', storage)
+    assert report.imported == len(entries) and report.invalid == 0
+    assert [entry['id'] for entry in storage.list_entries()] == sorted_ids(entries)
+
+
+def test_merge(storage, entries):
+    storage.import_entries(entries[:4])
+    changed = dict(entries[0], title='changed')
+    report = import_upload(upload([changed] + entries[4:]), 'merge', storage)
+    assert report.imported == len(entries) - 3
+    assert storage.count() == len(entries)
+    assert storage.get_entry(entries[0]['id'])['title'] == 'changed'
+
+
+def test_invalid_records_are_skipped(storage, entries):
+    records = [entries[0], {"title": 1}, "text", dict(entries[1], id='not a uuid'),
+               dict(entries[2], media_content='x'), entries[3]]
+    report = import_upload(upload(records), 'replace', storage)
+    assert (report.imported, report.invalid) == (2, 4)
+    assert [error.split(':')[0] for error in report.errors] == ['record 2', 'record 3', 'record 4', 'record 5']
+    assert sorted(entry['id'] for entry in storage.iter_entries()) == sorted([entries[0]['id'], entries[3]['id']])
+
+
+def test_datetimes_are_stored_in_utc(storage):
+    records = [{"title": 'india', "datetime_utc": '2024-01-01T02:00:00+05:30'},
+               {"title": 'naive', "datetime_utc": '2023-12-31T21:00:00'}]
+    import_upload(upload(records), 'replace', storage)
+    assert [(entry['title'], entry['datetime_utc']) for entry in storage.list_entries()] == [
+        ('naive', '2023-12-31T21:00:00+00:00'), ('india', '2023-12-31T20:30:00+00:00')]
+
+
+@pytest.mark.parametrize('content', [b'', b'[]', b'{"entries": []}', b' \n'])
+def test_empty_upload_does_not_wipe_the_journal(storage, entries, content):
+    storage.import_entries(entries)
+    with pytest.raises(ImportFormatError):
+        import_upload(upload(content), 'replace', storage)
+    assert storage.count() == len(entries)
+
+    # Unless asked for, and merging nothing is harmless
+    import_upload(upload(content), 'merge', storage)
+    assert storage.count() == len(entries)
+    import_upload(upload(content), 'replace', storage, allow_empty=True)
+    assert storage.count() == 0
+
+
+def test_upload_without_valid_entry_does_not_wipe_the_journal(storage, entries):
+    storage.import_entries(entries)
+    with pytest.raises(ImportFormatError):
+        import_upload(upload([{"title": 'no datetime'}]), 'replace', storage)
+    assert storage.count() == len(entries)
+
+
+@pytest.mark.parametrize('content', [
+    b'{"title": "a" "datetime_utc": "2020-01-01"}',
+    b'{"title": "a", "datetime_utc": "2020-01-01",}',
+    b'{1: "a"}',
+    b'[{"title": "a", "datetime_utc": "2020-01-01"} {"title": "b"}]',
+    b'[{"title": "a", "datetime_utc": "2020-01-01"}',
+    b'{"entries": [{"title": "a", "datetime_utc": "2020-01-01"}]',
+    b'"text"',
+])
+def test_malformed_json_is_refused(storage, entries, content):
+    storage.import_entries(entries)
+    with pytest.raises(ImportFormatError):
+        import_upload(upload(content), 'replace', storage)
+    assert storage.count() == len(entries)
+
+
+def test_records_are_streamed():
+    records = [{"title": f'entry {i}', "text": 'x' * 1000} for i in range(500)]
+    content = json.dumps({"entries": records, "version": 1}).encode()
+
+    class Reads(io.BytesIO):
+        reads = 0
+
+        def read(self, size=-1):
+            Reads.reads += 1
+            return super().read(size)
+
+    stream = iter_upload_records(Reads(content))
+    assert next(stream) == records[0]
+    # Only the first chunks were read
+    assert Reads.reads < 5
+    assert list(stream) == records[1:]
+
+
+def test_upload_route(client):
+    from app.database import get_storage
+    storage = get_storage()
+    entry_id = str(uuid.uuid4())
+    storage.import_entries([make_entry(datetime(2024, 1, 1, tzinfo=timezone.utc), entry_id=entry_id)])
+
+    def post(content, **form):
+        return client.post('/api/upload/json/', content_type='multipart/form-data',
+                           data=dict(form, json_file=(io.BytesIO(content), 'journal.json')))
+
+    response = post(b'[]', mode='replace')
+    assert response.status_code == 400 and b'empty' in response.data
+    assert storage.get_entry(entry_id) is not None
+    assert post(b'{"title": "a" "datetime_utc": "2020-01-01"}', mode='merge').status_code == 400
+
+    assert post(b'[]', mode='replace', allow_empty='on').status_code == 302
+    assert storage.count() == 0
@@ -0,0 +1,144 @@
+# tests/test_jobs.py
+#
+# The background job queue: recording, coalescing and recovery.
+
+import json, os
+import pytest
+from app.database import file_signature
+from app.jobs import JobQueue, JobQueueFull, _owner, _start_time, job_handler
+
+
+@job_handler('test_echo')
+def _echo(job):
+    return job['args'].get('value')
+
+
+def stored_job(owner, status='queued', key=None, job_id='0' * 32):
+    """A job record as left in the jobs file by the process `owner`"""
+    return {"id": job_id, "kind": 'test_echo', "args": {"value": job_id}, "key": key, "status": status,
+            "owner": owner, "created": 0, "started": None, "finished": None, "result": None, "error": None}
+
+
+def write_jobs(path, jobs):
+    with open(path, 'w') as f:
+        json.dump(jobs, f)
+
+
+# The owner token of an earlier process that had the pid of this one
+EARLIER_OWNER = f'{os.getpid()}:1'
+
+
+def test_runs_a_job(tmp_path):
+    job_queue = JobQueue(tmp_path / 'jobs.json', workers=1)
+    job = job_queue.submit('test_echo', {"value": 42})
+    job_queue.join()
+    job = job_queue.get(job['id'])
+    assert job['status'] == 'done' and job['result'] == 42
+    assert job['owner'] == _owner()
+
+
+def test_coalesces_with_a_queued_job_without_writing(tmp_path):
+    job_queue = JobQueue(tmp_path / 'jobs.json', workers=0)
+    job = job_queue.submit('test_echo', key='key')
+    signature = file_signature(job_queue.path)
+
+    assert job_queue.submit('test_echo', key='key')['id'] == job['id']
+    assert file_signature(job_queue.path) == signature
+    assert job_queue.submit('test_echo', key='other')['id'] != job['id']
+    assert len(job_queue.list()) == 2
+
+
+def test_does_not_coalesce_with_a_job_of_another_process(tmp_path):
+    write_jobs(tmp_path / 'jobs.json', [stored_job(EARLIER_OWNER, key='key')])
+    job_queue = JobQueue(tmp_path / 'jobs.json', workers=0)
+    assert job_queue.submit('test_echo', key='key')['id'] != '0' * 32
+
+
+def test_full_queue_records_nothing(tmp_path):
+    job_queue = JobQueue(tmp_path / 'jobs.json', workers=0, maxsize=1)
+    job_queue.submit('test_echo')
+    with pytest.raises(JobQueueFull):
+        job_queue.submit('test_echo')
+    assert len(job_queue.list()) == 1
+
+
+def test_run_now_records_the_job(tmp_path):
+    job_queue = JobQueue(tmp_path / 'jobs.json', workers=0)
+    job = job_queue.run_now('test_echo', {"value": 'inline'}, key='key')
+    assert job['id'] is not None and job['status'] == 'done' and job['result'] == 'inline'
+    assert job_queue.get(job['id'])['result'] == 'inline'
+
+
+@pytest.mark.parametrize('owner', [EARLIER_OWNER, os.getpid()])
+def test_recovers_the_jobs_of_an_earlier_process_with_the_same_pid(tmp_path, owner):
+    write_jobs(tmp_path / 'jobs.json', [stored_job(owner, status='running', key='key')])
+    job_queue = JobQueue(tmp_path / 'jobs.json', workers=1)
+    assert job_queue.recover() == 1
+    job_queue.join()
+    job = job_queue.get('0' * 32)
+    assert job['status'] == 'done' and job['owner'] == _owner()
+
+
+def test_does_not_recover_the_jobs_of_running_processes(tmp_path):
+    write_jobs(tmp_path / 'jobs.json', [stored_job(_owner()), stored_job(f'{os.getppid()}:{_start_time(os.getppid())}', job_id='1' * 32)])
+    assert JobQueue(tmp_path / 'jobs.json', workers=0).recover() == 0
+
+
+def test_recovers_what_fits_in_the_queue(tmp_path):
+    write_jobs(tmp_path / 'jobs.json', [stored_job(EARLIER_OWNER, key=f'key{i}', job_id=str(i) * 32) for i in range(3)])
+    job_queue = JobQueue(tmp_path / 'jobs.json', workers=0, maxsize=2)
+    assert job_queue.recover() == 2
+    # The last one is left to its owner, not stamped with this process
+    assert job_queue.get('2' * 32)['owner'] == EARLIER_OWNER
+    # The recovered ones wait in the queue, so they are coalesced with
+    assert job_queue.submit('test_echo', key='key0')['id'] == '0' * 32
+
+    job_queue.workers = 1
+    job_queue._start_workers()
+    job_queue.join()
+    assert job_queue.recover() == 1
+    job_queue.join()
+    assert [job['status'] for job in job_queue.list()] == ['done'] * 3
+
+
+def test_changes_are_appended(tmp_path):
+    job_queue = JobQueue(tmp_path / 'jobs.json', workers=0)
+    job = job_queue.submit('test_echo', {"value": 1})
+    with open(job_queue.path, 'rb') as f:
+        before = f.read()
+
+    job_queue.run(job['id'], job_queue._release(job['id']))
+    with open(job_queue.path, 'rb') as f:
+        after = f.read()
+    assert after.startswith(before)
+    assert len(after.splitlines()) == 3
+    assert job_queue.get(job['id'])['status'] == 'done'
+
+
+def test_reads_the_jobs_file_written_before_the_log(tmp_path):
+    write_jobs(tmp_path / 'jobs.json', [stored_job(_owner(), status='done')])
+    job_queue = JobQueue(tmp_path / 'jobs.json', workers=0)
+    job = job_queue.submit('test_echo')
+    assert [stored['id'] for stored in job_queue.list()] == ['0' * 32, job['id']]
+
+
+def test_skips_a_line_cut_short(tmp_path):
+    job_queue = JobQueue(tmp_path / 'jobs.json', workers=0)
+    first = job_queue.submit('test_echo')
+    with open(job_queue.path, 'ab') as f:
+        f.write(b'{"id": "cut')
+    second = job_queue.submit('test_echo')
+    assert [job['id'] for job in job_queue.list()] == [first['id'], second['id']]
+
+
+def test_compaction_keeps_the_history(tmp_path, monkeypatch):
+    import app.jobs
+    monkeypatch.setattr(app.jobs, 'LOG_COMPACTION_THRESHOLD', 2000)
+    monkeypatch.setattr(app.jobs, 'JOB_HISTORY', 3)
+    job_queue = JobQueue(tmp_path / 'jobs.json', workers=0, maxsize=0)
+    jobs = [job_queue.run_now('test_echo', {"value": i}) for i in range(10)]
+    pending = job_queue.submit('test_echo')
+
+    assert [job['id'] for job in job_queue.list()] == [job['id'] for job in jobs[-3:]] + [pending['id']]
+    with open(job_queue.path, 'rb') as f:
+        assert len(f.read().splitlines()) < 15
@@ -0,0 +1,72 @@
+# tests/test_journal.py
+#
+# The entry classes, the JournalCollection index and the cached parsing of
+# the stored datetimes.
+
+from datetime import datetime, timedelta, timezone
+import pytest
+from app.journal import JournalCollection, JournalEntry, LazyJournalEntry, parse_datetime
+from conftest import make_entry, sorted_ids
+
+
+def test_datetimes_are_parsed_once():
+    value = '2024-03-01T10:00:00+00:00'
+    first = parse_datetime(value)
+    hits = parse_datetime.cache_info().hits
+    assert parse_datetime(value) is first
+    assert parse_datetime.cache_info().hits == hits + 1
+    assert first == datetime(2024, 3, 1, 10, tzinfo=timezone.utc)
+
+
+def test_entry_round_trip():
+    data = dict(make_entry(datetime(2024, 3, 1, 10, tzinfo=timezone.utc), title='a', text='some text'), revision=4)
+    entry = JournalEntry.from_dict(data)
+    assert entry.to_dict() == data
+    assert (entry.snippet, entry.length) == ('some text', 9)
+    # Entries have slots, not a __dict__ each
+    with pytest.raises(AttributeError):
+        entry.other = 1
+
+
+def test_lazy_entry_loads_the_body_when_needed():
+    data = make_entry(datetime(2024, 3, 1, tzinfo=timezone.utc), title='a', text='the whole text')
+    summary = {"id": data['id'], "title": 'a', "datetime_utc": data['datetime_utc'], "snippet": 'the whole',
+               "length": 14, "revision": 2}
+    loads = []
+    entry = LazyJournalEntry(summary, load=lambda entry_id: loads.append(entry_id) or data)
+    assert (entry.title, entry.snippet, entry.length, entry.revision) == ('a', 'the whole', 14, 2)
+    assert loads == []
+    assert entry.text == 'the whole text' and entry.media_content == []
+    assert loads == [data['id']]
+
+
+def test_collection_order_and_lookup(entries):
+    collection = JournalCollection.from_dicts(entries)
+    assert [entry.id for entry in reversed(collection)] == sorted_ids(entries)
+    assert [entry.id for entry in collection.page(offset=2, limit=3)] == sorted_ids(entries)[2:5]
+    assert collection.get(entries[3]['id']).title == 'entry 3' and entries[3]['id'] in collection
+    assert collection.get('unknown') is None
+
+
+def test_collection_between(entries):
+    collection = JournalCollection.from_dicts(entries)
+    start = datetime(2023, 12, 30, 12, tzinfo=timezone.utc)
+    expected = [entry for entry in entries if start <= parse_datetime(entry['datetime_utc']) < start + timedelta(days=1)]
+    assert [entry.id for entry in collection.between(start, start + timedelta(days=1))] == sorted_ids(expected)[::-1]
+    assert len(collection.between()) == len(entries)
+
+
+def test_collection_add_and_remove(entries):
+    collection = JournalCollection.from_dicts(entries[:6])
+    copy = collection.copy()
+    copy.add(JournalEntry.from_dict(dict(entries[0], datetime_utc='2030-01-01T00:00:00+00:00')))
+    for entry in entries[6:]:
+        copy.add(JournalEntry.from_dict(entry))
+    copy.remove(entries[1]['id'])
+    copy.remove('unknown')
+
+    moved = dict(entries[0], datetime_utc='2030-01-01T00:00:00+00:00')
+    assert [entry.id for entry in reversed(copy)] == sorted_ids([moved] + entries[2:])
+    assert copy.get(entries[5]['id']).id == entries[5]['id']
+    # The original is untouched
+    assert [entry.id for entry in reversed(collection)] == sorted_ids(entries[:6])
@@ -0,0 +1,92 @@
+# tests/test_keys.py
+#
+# Key rotation: re-encrypting the stored tokens and retiring the old keys.
+# The key file is copied to `tmp_path` so the rest of the session keeps its key.
+
+import shutil
+from datetime import datetime, timezone
+import pytest
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+import app.backup, app.database, app.export, app.keys, app.media, app.statistics
+from app.keys import get_cipher, read_keys, rotate_key
+from app.statistics import JournalStatistics
+from conftest import make_entry, sorted_ids
+
+
+@pytest.fixture
+def key_file(tmp_path, monkeypatch):
+    path = tmp_path / 'fernet.key'
+    shutil.copy(app.keys.FERNET_FILE, path)
+    monkeypatch.setattr(app.keys, 'FERNET_FILE', path)
+    return path
+
+
+def test_cipher_follows_the_key_file(key_file):
+    old_key = read_keys()[0]
+    token = get_cipher().encrypt(b'secret')
+    new_key = Fernet.generate_key()
+    app.keys._write_keys([new_key, old_key])
+    # The old key still decrypts, the new one encrypts
+    assert get_cipher().decrypt(token) == b'secret'
+    assert Fernet(new_key).decrypt(get_cipher().encrypt(b'x')) == b'x'
+
+    app.keys._write_keys([new_key])
+    with pytest.raises(InvalidToken):
+        get_cipher().decrypt(token)
+
+
+def test_storage_is_readable_with_the_new_key_only(key_file, open_storage, entries):
+    storage = open_storage()
+    storage.import_entries(entries)
+    storage.update(dict(entries[0], title='changed'))
+    old_keys = read_keys()
+    new_key = Fernet.generate_key()
+    app.keys._write_keys([new_key] + old_keys)
+
+    storage.reencrypt(get_cipher())
+    app.keys._write_keys([new_key])
+    storage = open_storage()
+    assert [entry['id'] for entry in storage.list_entries()] == sorted_ids(entries)
+    assert storage.get_entry(entries[0]['id'])['title'] == 'changed'
+    assert sorted(entry['text'] for entry in storage.iter_entries()) == sorted(entry['text'] for entry in entries)
+    # Writes go on after the rotation
+    storage.add(make_entry(datetime(2025, 1, 1, tzinfo=timezone.utc)))
+    assert open_storage().count() == len(entries) + 1
+
+
+def test_rotate_key(key_file, tmp_path, monkeypatch, entries):
+    storage = app.database.JsonStorage(tmp_path / 'journal.json')
+    statistics = JournalStatistics(storage)
+    monkeypatch.setattr(app.database, 'get_storage', lambda: storage)
+    monkeypatch.setattr(app.statistics, 'get_statistics', lambda: statistics)
+    for module, name, path in ((app.backup, 'BACKUP_DIR', tmp_path / 'backups'),
+                               (app.backup, 'OBJECTS_DIR', tmp_path / 'backups' / 'objects'),
+                               (app.backup, 'SNAPSHOTS_DIR', tmp_path / 'backups' / 'snapshots'),
+                               (app.backup, 'CATALOG_PATH', tmp_path / 'backups' / 'catalog'),
+                               (app.export, 'EXPORTS_DIR', tmp_path / 'exports'),
+                               (app.media, 'OBJECTS_DIR', tmp_path / 'media')):
+        monkeypatch.setattr(module, name, path)
+
+    storage.import_entries(entries)
+    summary = statistics.summary('UTC')
+    snapshot_id = app.backup.create_backup(storage.load())
+    export = app.export.write_export_file('rotation', storage.iter_entries(), 'ndjson')
+    content = b'media content' * 1000
+    digest, _ = app.media.store_bytes(content)
+    old_keys = read_keys()
+
+    assert rotate_key(background=False) is None
+    keys = read_keys()
+    assert len(keys) == 1 and keys[0] not in old_keys
+
+    assert [entry['id'] for entry in storage.list_entries()] == sorted_ids(entries)
+    assert app.backup.load_backup(snapshot_id)['entries'] == storage.load()['entries']
+    assert b''.join(app.export.iter_export_file(export['file'])).count(b'\n') == len(entries)
+    assert app.media.MediaBlob(digest).read() == content
+    assert JournalStatistics(storage).summary('UTC')['total_words'] == summary['total_words']
+    # The old keys are no use any more
+    with open(app.media.blob_path(digest), 'rb') as f:
+        f.readline()
+        token = f.readline().rstrip(b'\n')
+    with pytest.raises(InvalidToken):
+        MultiFernet([Fernet(key) for key in old_keys]).decrypt(token)
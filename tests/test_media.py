@@ -0,0 +1,85 @@
+# tests/test_media.py
+#
+# The encrypted media store, its thumbnails and the byte ranges it serves.
+
+import io
+from datetime import datetime, timezone
+import pytest
+from app.media import MediaBlob, attach_media, create_thumbnail, store_bytes
+from conftest import make_entry
+
+def test_thumbnail_is_made_by_the_pool():
+    Image = pytest.importorskip('PIL.Image')
+    image = io.BytesIO()
+    Image.new('RGB', (1200, 800), 'teal').save(image, format='PNG')
+    digest, _ = store_bytes(image.getvalue())
+
+    thumbnail = create_thumbnail(digest)
+    with Image.open(io.BytesIO(MediaBlob(thumbnail).read())) as picture:
+        assert picture.format == 'JPEG' and picture.size == (320, 213)
+
+
+# Spans two chunks of the store
+CONTENT = bytes(range(256)) * 1200
+
+
+@pytest.fixture
+def media(client):
+    """(url, Last-Modified, ETag) of a media attached to an entry of the app's storage"""
+    from app.database import get_storage
+    entry = make_entry(datetime(2024, 3, 1, tzinfo=timezone.utc))
+    get_storage().add(entry)
+    item = attach_media(entry['id'], io.BytesIO(CONTENT), 'data.bin', 'application/x-data')
+    url = f"/api/entries/{entry['id']}/media/{item['hash']}/"
+    response = client.get(url)
+    return url, response.headers['Last-Modified'], response.headers['ETag']
+
+
+def test_whole_media(client, media):
+    url, _, etag = media
+    response = client.get(url)
+    assert response.status_code == 200 and response.data == CONTENT
+    assert response.headers['Accept-Ranges'] == 'bytes' and response.mimetype == 'application/x-data'
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+
+@pytest.mark.parametrize('header, start, end', [
+    ('bytes=0-99', 0, 99),
+    ('bytes=262100-262200', 262100, 262200),
+    ('bytes=300000-', 300000, len(CONTENT) - 1),
+    ('bytes=-10', len(CONTENT) - 10, len(CONTENT) - 1),
+    ('bytes=300000-999999', 300000, len(CONTENT) - 1),
+])
+def test_range(client, media, header, start, end):
+    response = client.get(media[0], headers={'Range': header})
+    assert response.status_code == 206
+    assert response.data == CONTENT[start:end + 1]
+    assert response.headers['Content-Range'] == f'bytes {start}-{end}/{len(CONTENT)}'
+    assert response.headers['Content-Length'] == str(end - start + 1)
+
+
+def test_unsatisfiable_range(client, media):
+    response = client.get(media[0], headers={'Range': f'bytes={len(CONTENT)}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(CONTENT)}'
+
+
+def test_several_ranges_get_the_whole_media(client, media):
+    response = client.get(media[0], headers={'Range': 'bytes=0-9,20-29'})
+    assert response.status_code == 200 and response.data == CONTENT
+
+
+@pytest.mark.parametrize('if_range, applies', [
+    ('etag', True),
+    ('"0000"', False),
+    ('last_modified', True),
+    ('Sat, 01 Jan 2000 00:00:00 GMT', False),
+])
+def test_if_range(client, media, if_range, applies):
+    url, last_modified, etag = media
+    if_range = {'etag': etag, 'last_modified': last_modified}.get(if_range, if_range)
+    response = client.get(url, headers={'Range': 'bytes=10-19', 'If-Range': if_range})
+    if applies:
+        assert response.status_code == 206 and response.data == CONTENT[10:20]
+    else:
+        assert response.status_code == 200 and response.data == CONTENT
@@ -0,0 +1,75 @@
+# tests/test_metrics.py
+#
+# The timing histograms and their exposition at /metrics.
+
+import json, os
+import pytest
+import app.metrics
+from app import app as flask_app
+from app.authentication import generate_token
+from app.metrics import SPAN_SECONDS, Histogram, collect, publish, render_prometheus, span
+
+
+def test_histogram():
+    histogram = Histogram('test_seconds', 'Test.', ('kind',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value, 'a')
+    histogram.observe(0.5, 'b')
+    assert sorted(histogram.snapshot()) == [[['a'], 2, 1, 1, 2.65], [['b'], 0, 1, 0, 0.5]]
+
+
+def test_span():
+    before = collect()[SPAN_SECONDS.name].get(('test_span',), [0] * (len(SPAN_SECONDS.buckets) + 2))
+    with span('test_span'):
+        pass
+    after = collect()[SPAN_SECONDS.name][('test_span',)]
+    assert sum(after[:-1]) == sum(before[:-1]) + 1
+
+
+def test_metrics_route(client):
+    client.get('/view_entries')
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.content_type == app.metrics.PROMETHEUS_CONTENT_TYPE
+    text = response.get_data(as_text=True)
+    assert '# TYPE mindcanvas_request_duration_seconds histogram' in text
+    assert 'mindcanvas_request_duration_seconds_count{method="GET",endpoint="view_entries",status="200"}' in text
+    assert 'mindcanvas_template_render_seconds_bucket{template="view_entries.html",le="+Inf"}' in text
+
+    anonymous = flask_app.test_client()
+    assert anonymous.get('/metrics').status_code == 401
+    token = generate_token('admin')
+    assert anonymous.get('/metrics', query_string={"token": token}).status_code == 200
+    assert anonymous.get('/metrics', headers={'Authorization': f'Bearer {token}'}).status_code == 200
+
+
+def test_histograms_of_the_other_workers_are_added(tmp_path, monkeypatch):
+    monkeypatch.setattr(app.metrics, 'METRICS_DIR', str(tmp_path))
+    with span('test_workers'):
+        pass
+    own = collect()[SPAN_SECONDS.name][('test_workers',)]
+    publish(force=True)
+    assert os.listdir(tmp_path) == [f'{os.getpid()}.json']
+
+    # The file of another worker, and one being replaced
+    other = [[['test_workers']] + [0] * len(SPAN_SECONDS.buckets) + [3, 30.0]]
+    (tmp_path / '1.json').write_text(json.dumps({SPAN_SECONDS.name: other}))
+    (tmp_path / '2.json').write_text('{"mindcanvas_span')
+    merged = collect()[SPAN_SECONDS.name][('test_workers',)]
+    assert merged[-2:] == [own[-2] + 3, own[-1] + 30.0]
+    assert 'mindcanvas_span_seconds_count{span="test_workers"} ' + str(sum(merged[:-1])) in render_prometheus()
+
+
+def test_requests_are_logged_as_json(client, tmp_path, monkeypatch):
+    log_path = tmp_path / 'requests.log'
+    monkeypatch.setattr(app.metrics, 'METRICS_JSON_LOG', str(log_path))
+    monkeypatch.setattr(app.metrics, '_request_logger', None)
+    try:
+        client.get('/view_entries')
+    finally:
+        logger = app.metrics._request_logger
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+            handler.close()
+    record = json.loads(log_path.read_text().splitlines()[-1])
+    assert (record['endpoint'], record['status'], record['pid']) == ('view_entries', 200, os.getpid())
+    assert record['spans_ms']['render_template'] <= record['duration_ms']
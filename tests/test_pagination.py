@@ -0,0 +1,57 @@
+# tests/test_pagination.py
+#
+# The paging options of the listings and the (datetime_utc, id) cursor of
+# view_entries and the entries api.
+
+import html, re
+from werkzeug.datastructures import MultiDict
+from app.authentication import generate_token
+from app.database import get_storage
+from app.pagination import PageArgs
+from config import ENTRIES_PER_PAGE, MAX_ENTRIES_PER_PAGE
+from conftest import sorted_ids
+
+
+def page_args(**args):
+    return PageArgs.from_request_args(MultiDict(args))
+
+
+def test_page_args():
+    args = page_args(page='3', per_page='5')
+    assert (args.page, args.per_page, args.offset, args.before) == (3, 5, 10, None)
+    args = page_args(page='-1', per_page='100000')
+    assert (args.page, args.per_page) == (1, MAX_ENTRIES_PER_PAGE)
+    assert page_args(page='x', per_page='0').per_page == ENTRIES_PER_PAGE
+
+
+def test_cursor_args():
+    # An unescaped '+' of the UTC offset arrives as a space
+    args = page_args(page='3', before='2024-01-01T10:00:00 00:00', before_id='b')
+    assert (args.before, args.before_id, args.offset) == ('2024-01-01T10:00:00+00:00', 'b', 0)
+    args = page_args(before='yesterday', before_id='b')
+    assert (args.before, args.before_id) == (None, None)
+
+
+def test_api_cursor_visits_every_entry_once(client, entries):
+    get_storage().replace_all(entries)
+    token = generate_token('admin')
+    ids, query = [], {}
+    while True:
+        page = client.get('/api/entries/', query_string=dict(query, token=token, per_page=5)).get_json()
+        assert page['total'] == len(entries)
+        ids += [summary['id'] for summary in page['entries']]
+        if page['next_cursor'] is None:
+            break
+        query = {"before": page['next_cursor'], "before_id": page['next_cursor_id']}
+    assert ids == sorted_ids(entries)
+
+
+def test_view_entries_cursor_visits_every_entry_once(client, entries):
+    get_storage().replace_all(entries)
+    ids, url = [], '/view_entries?before=9999-01-01T00:00:00%2B00:00&per_page=5'
+    while url:
+        page = client.get(url).get_data(as_text=True)
+        ids += re.findall(r'/view_entry/([0-9a-f-]{36})', page)
+        older = re.search(r'<a href="([^"]*)" class="btn btn-secondary">Older</a>', page)
+        url = older and html.unescape(older.group(1))
+    assert ids == sorted_ids(entries)
@@ -0,0 +1,87 @@
+# tests/test_search.py
+#
+# The full-text search index, kept up to date by the writes of its storage.
+
+from datetime import datetime, timezone
+from app.search import SearchIndex
+from conftest import make_entry
+
+NOW = datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+
+def found(index, query):
+    return {result['id'] for result in index.search(query, limit=100)[1]}
+
+
+def test_follows_the_writes(storage):
+    index = SearchIndex(storage)
+    alpha = make_entry(NOW, title='Alpha', text='a walk by the river')
+    beta = make_entry(NOW, title='Beta', text='rain all day')
+    storage.add(alpha)
+    storage.add(beta)
+    assert found(index, 'river') == {alpha['id']}
+    assert found(index, 'alpha rain') == {alpha['id'], beta['id']}
+
+    storage.update(dict(beta, text='sunny, then a river swim'))
+    assert found(index, 'river') == {alpha['id'], beta['id']}
+    assert found(index, 'rain') == set()
+
+    storage.delete(alpha['id'])
+    assert found(index, 'river') == {beta['id']}
+
+
+def test_ranking(storage):
+    index = SearchIndex(storage)
+    once = make_entry(NOW, text='garden and some other words here')
+    twice = make_entry(NOW, text='garden garden')
+    storage.add(once)
+    storage.add(twice)
+    total, results = index.search('garden')
+    assert total == 2
+    assert [result['id'] for result in results] == [twice['id'], once['id']]
+    assert results[0]['snippet'] == 'garden garden'
+
+
+def test_write_of_a_second_instance(open_storage):
+    first, second = open_storage(), open_storage()
+    index = SearchIndex(first)
+    alpha = make_entry(NOW, text='alpha')
+    first.add(alpha)
+    assert found(index, 'alpha') == {alpha['id']}
+
+    # Missed by the index of the first instance, then a write of its own
+    beta = make_entry(NOW, text='beta')
+    gamma = make_entry(NOW, text='gamma')
+    second.add(beta)
+    first.add(gamma)
+    assert found(index, 'beta') == {beta['id']}
+    assert found(index, 'gamma') == {gamma['id']}
+
+    second.delete(alpha['id'])
+    assert found(index, 'alpha') == set()
+
+
+def test_catches_up_without_rebuilding(open_storage, monkeypatch):
+    first, second = open_storage(), open_storage()
+    index = SearchIndex(first)
+    alpha, beta = make_entry(NOW, text='alpha'), make_entry(NOW, text='beta')
+    first.add(alpha)
+    first.add(beta)
+    assert found(index, 'alpha') == {alpha['id']}
+
+    def rebuild():
+        raise AssertionError('rebuilt')
+    monkeypatch.setattr(first, 'iter_entries', rebuild)
+    gamma = make_entry(NOW, text='gamma')
+    second.add(gamma)
+    second.update(dict(alpha, text='delta'))
+    second.delete(beta['id'])
+    assert found(index, 'gamma') == {gamma['id']}
+    assert found(index, 'delta') == {alpha['id']}
+    assert found(index, 'alpha') == found(index, 'beta') == set()
+
+    # Unless the change log can't tell
+    monkeypatch.undo()
+    second.import_entries([beta], replace=True)
+    assert found(index, 'beta') == {beta['id']}
+    assert found(index, 'gamma') == set()
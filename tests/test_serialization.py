@@ -0,0 +1,85 @@
+# tests/test_serialization.py
+#
+# The MCDB/1 formats of the encrypted database file.
+
+import json
+from datetime import datetime, timezone
+import pytest
+import app.database
+import app.serialization
+from app.database import read_database_file, save_database
+from app.keys import get_cipher
+from app.serialization import deserialize, parse_format, serialize, split_header
+from conftest import make_entry
+
+FORMATS = ['json', 'json+zlib', 'json+zstd', 'msgpack', 'msgpack+zlib', 'msgpack+zstd']
+
+
+def requires(format_name):
+    """Skips the test if the packages `format_name` needs are missing"""
+    if 'msgpack' in format_name:
+        pytest.importorskip('msgpack')
+    if 'zstd' in format_name:
+        pytest.importorskip('zstandard')
+
+
+@pytest.fixture
+def database():
+    entry = make_entry(datetime(2024, 3, 1, tzinfo=timezone.utc), title='Ünïcode ✓', text='line\nline')
+    return {"version": 7, "entries": [entry]}
+
+
+@pytest.mark.parametrize('format_name', FORMATS)
+def test_round_trip(database, format_name):
+    requires(format_name)
+    header, payload = serialize(database, format_name)
+    assert header == f'MCDB/1 {format_name}\n'.encode()
+    assert split_header(header + b'token') == (format_name, b'token')
+    assert deserialize(payload, format_name) == database
+
+
+@pytest.mark.parametrize('format_name', FORMATS)
+def test_files_are_read_in_the_format_they_were_written_in(tmp_path, monkeypatch, database, format_name):
+    requires(format_name)
+    path = tmp_path / 'journal.json'
+    monkeypatch.setattr(app.database, 'DATABASE_FORMAT', format_name)
+    save_database(database, path, backup=False)
+    with open(path, 'rb') as f:
+        assert f.read().startswith(b'ENCRYPTED\nMCDB/1 ' + format_name.encode() + b'\n')
+
+    # After the format was changed
+    monkeypatch.setattr(app.database, 'DATABASE_FORMAT', 'json')
+    assert read_database_file(path) == database
+
+
+def test_compression_shrinks_the_payload(database):
+    database['entries'] *= 50
+    assert len(serialize(database, 'json+zlib')[1]) < len(serialize(database, 'json')[1]) / 5
+
+
+def test_file_without_header(tmp_path, database):
+    # As written before the format header existed: indented JSON
+    path = tmp_path / 'journal.json'
+    path.write_bytes(b'ENCRYPTED\n' + get_cipher().encrypt(json.dumps(database, indent=4).encode()))
+    assert read_database_file(path) == database
+
+    # And the plaintext export
+    path.write_text(json.dumps(database))
+    assert read_database_file(path) == database
+
+
+@pytest.mark.parametrize('format_name', ['xml', 'json+lzma', 'zlib', ''])
+def test_unknown_format(format_name):
+    with pytest.raises(ValueError):
+        parse_format(format_name)
+
+
+def test_format_needing_a_missing_package(monkeypatch):
+    monkeypatch.setitem(app.serialization._MODULES, 'zstandard', None)
+    with pytest.raises(ValueError, match='zstandard'):
+        parse_format('json+zstd')
+
+
+def test_newer_file_version_is_refused():
+    with pytest.raises(ValueError):
+        split_header(b'MCDB/2 json\ntoken')
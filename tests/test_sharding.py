@@ -0,0 +1,38 @@
+# tests/test_sharding.py
+#
+# What is specific to the sharded storage.
+
+from datetime import datetime, timezone
+from app.sharding import ShardedStorage
+from conftest import make_entry, sorted_ids
+
+
+def test_one_shard_per_year(tmp_path, entries):
+    storage = ShardedStorage(tmp_path / 'journal')
+    for entry in entries:
+        storage.add(entry)
+    assert {path.name for path in (tmp_path / 'journal').glob('*.json')} == {'2023.json', '2024.json'}
+    assert storage.shard('2023').count() + storage.shard('2024').count() == len(entries)
+
+
+def test_entry_moves_between_shards(tmp_path, entries):
+    storage = ShardedStorage(tmp_path / 'journal')
+    for entry in entries:
+        storage.add(entry)
+    moved = dict(entries[0], datetime_utc=datetime(2021, 6, 1, tzinfo=timezone.utc).isoformat())
+    storage.update(moved)
+
+    assert storage.shard('2021').get_entry(moved['id'])['datetime_utc'] == moved['datetime_utc']
+    assert storage.shard(entries[0]['datetime_utc'][:4]).get_entry(moved['id']) is None
+    assert storage.count() == len(entries)
+    assert [entry['id'] for entry in storage.list_entries()] == sorted_ids([moved] + entries[1:])
+
+
+def test_offset_skips_whole_shards(tmp_path, entries):
+    storage = ShardedStorage(tmp_path / 'journal')
+    for entry in entries:
+        storage.add(entry)
+    storage.add(make_entry(datetime(2019, 1, 1, tzinfo=timezone.utc)))
+    expected = [entry['id'] for entry in storage.list_entries()]
+    for offset in range(len(expected) + 1):
+        assert [entry['id'] for entry in storage.list_entries(offset=offset, limit=3)] == expected[offset:offset + 3]
@@ -0,0 +1,77 @@
+# tests/test_statistics.py
+#
+# The journal statistics, kept up to date by the writes of their storage.
+
+from datetime import datetime, timedelta, timezone
+from app.statistics import JournalStatistics
+from conftest import make_entry
+
+TIMEZONE = 'UTC'
+
+
+def expected_totals(storage):
+    entries = list(storage.iter_entries())
+    return len(entries), sum(len(entry['text'].split()) for entry in entries)
+
+
+def totals(statistics):
+    summary = statistics.summary(TIMEZONE)
+    return summary['total_entries'], summary['total_words']
+
+
+def test_follows_the_writes(storage, entries):
+    statistics = JournalStatistics(storage)
+    for entry in entries:
+        storage.add(entry)
+    assert totals(statistics) == expected_totals(storage)
+
+    storage.update(dict(entries[0], text='one two three four five six seven eight nine ten eleven twelve thirteen'))
+    storage.delete(entries[11]['id'])
+    summary = statistics.summary(TIMEZONE)
+    assert (summary['total_entries'], summary['total_words']) == expected_totals(storage)
+    assert [entry['id'] for entry in summary['longest_entries'][:2]] == [entries[0]['id'], entries[10]['id']]
+    assert summary['version'] == storage.version()
+
+
+def test_longest_streak(storage):
+    statistics = JournalStatistics(storage)
+    base = datetime(2024, 1, 1, 9, tzinfo=timezone.utc)
+    for days in (0, 1, 2, 2, 5, 6, 7, 8, 20):
+        storage.add(make_entry(base + timedelta(days=days)))
+    longest = statistics.summary(TIMEZONE)['streaks']['longest']
+    assert longest == {"days": 4, "start": '2024-01-06', "end": '2024-01-09'}
+
+
+def test_persisted(storage, entries):
+    statistics = JournalStatistics(storage)
+    for entry in entries[:5]:
+        storage.add(entry)
+    statistics.summary(TIMEZONE)
+    storage.delete(entries[0]['id'])
+
+    # As read by another process
+    assert totals(JournalStatistics(storage)) == expected_totals(storage)
+
+
+def test_write_of_a_second_instance(open_storage, entries):
+    first, second = open_storage(), open_storage()
+    statistics = JournalStatistics(first)
+    first.add(entries[0])
+    assert totals(statistics) == expected_totals(first)
+
+    # Missed by the statistics of the first instance, then a write of its own
+    second.add(entries[1])
+    first.add(entries[2])
+    assert totals(statistics) == expected_totals(first) == (3, 6)
+
+    second.delete(entries[0]['id'])
+    assert totals(statistics) == expected_totals(first)
+
+
+def test_two_instances_tracking_statistics(open_storage, entries):
+    first, second = open_storage(), open_storage()
+    first_statistics, second_statistics = JournalStatistics(first), JournalStatistics(second)
+    for i, entry in enumerate(entries):
+        (first if i % 2 else second).add(entry)
+    second.update(dict(entries[1], text='short'))
+    assert totals(first_statistics) == totals(second_statistics) == expected_totals(first)
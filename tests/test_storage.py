@@ -0,0 +1,179 @@
+# tests/test_storage.py
+#
+# The JournalStorage interface, for every backend.
+
+import pytest
+from app.database import EntryNotFoundError, StaleEntryError
+from conftest import make_entry, sorted_ids
+
+
+def test_add_get_update_delete(storage, entries):
+    version = storage.version()
+    for entry in entries:
+        storage.add(entry)
+    assert storage.count() == len(entries)
+    assert storage.version() == version + len(entries)
+    assert storage.get_entry(entries[3]['id'])['title'] == 'entry 3'
+
+    storage.update(dict(entries[3], title='changed'))
+    assert storage.get_entry(entries[3]['id'])['title'] == 'changed'
+
+    storage.delete(entries[3]['id'])
+    assert storage.get_entry(entries[3]['id']) is None
+    assert storage.count() == len(entries) - 1
+
+
+def test_update_of_unknown_entry_raises(storage, entries):
+    storage.add(entries[0])
+    with pytest.raises(EntryNotFoundError):
+        storage.update(entries[1])
+    assert storage.get_entry(entries[1]['id']) is None
+
+
+def test_stale_update_raises(storage, entries):
+    storage.add(entries[0])
+    expected_version = storage.get_entry(entries[0]['id'])['revision']
+    storage.update(dict(entries[0], title='first'), expected_version=expected_version)
+    with pytest.raises(StaleEntryError):
+        storage.update(dict(entries[0], title='second'), expected_version=expected_version)
+    assert storage.get_entry(entries[0]['id'])['title'] == 'first'
+
+
+def test_listings_are_ordered_by_datetime_and_id(storage, entries):
+    for entry in entries:
+        storage.add(entry)
+    expected = sorted_ids(entries)
+
+    assert [entry['id'] for entry in storage.list_entries()] == expected
+    assert [summary['id'] for summary in storage.list_summaries()] == expected
+    assert [entry['id'] for entry in storage.list_entries(offset=2, limit=4)] == expected[2:6]
+    assert [summary['id'] for summary in storage.list_summaries(offset=2, limit=4)] == expected[2:6]
+
+
+def test_updated_datetime_moves_the_entry(storage, entries):
+    for entry in entries:
+        storage.add(entry)
+    moved = dict(entries[8], datetime_utc=entries[7]['datetime_utc'])
+    storage.update(moved)
+    expected = sorted_ids([moved if entry['id'] == moved['id'] else entry for entry in entries])
+    assert [summary['id'] for summary in storage.list_summaries()] == expected
+
+
+@pytest.mark.parametrize('limit', [1, 2, 5])
+def test_cursor_paging_visits_every_entry_once(storage, entries, limit):
+    for entry in entries:
+        storage.add(entry)
+
+    ids, before, before_id = [], None, None
+    while True:
+        page = storage.list_summaries(limit=limit, before=before, before_id=before_id)
+        if not page:
+            break
+        ids += [summary['id'] for summary in page]
+        before, before_id = page[-1]['datetime_utc'], page[-1]['id']
+    assert ids == sorted_ids(entries)
+
+
+def test_get_summaries(storage, entries):
+    for entry in entries:
+        storage.add(entry)
+    entry_ids = [entries[5]['id'], 'unknown', entries[0]['id']]
+    summaries = storage.get_summaries(entry_ids)
+    assert [summary['id'] for summary in summaries] == [entries[5]['id'], entries[0]['id']]
+    assert summaries[0]['title'] == 'entry 5'
+    assert summaries[0]['datetime_utc'] == entries[5]['datetime_utc']
+
+
+def test_write_batch_is_one_version(storage, entries):
+    for entry in entries[:3]:
+        storage.add(entry)
+    version = storage.version()
+    new_version = storage.write_batch([
+        ('add', entries[3]['id'], entries[3]),
+        ('update', entries[0]['id'], dict(entries[0], title='changed')),
+        ('delete', entries[1]['id'], None)
+    ])
+    assert new_version == storage.version() == version + 1
+    assert storage.get_entry(entries[0]['id'])['title'] == 'changed'
+    assert storage.get_entry(entries[1]['id']) is None
+    assert sorted_ids(storage.list_entries()) == sorted_ids([storage.get_entry(entries[i]['id']) for i in (0, 2, 3)])
+
+
+def test_import_entries(storage, entries):
+    storage.add(entries[0])
+    storage.import_entries(entries[1:], replace=True)
+    assert storage.get_entry(entries[0]['id']) is None
+    assert [entry['id'] for entry in storage.list_entries()] == sorted_ids(entries[1:])
+
+    storage.import_entries([entries[0]], replace=False)
+    assert storage.count() == len(entries)
+
+
+def test_write_of_a_second_instance(open_storage, entries):
+    first, second = open_storage(), open_storage()
+    first.add(entries[0])
+    assert second.get_entry(entries[0]['id']) is not None
+
+    second.add(entries[1])
+    second.update(dict(entries[0], title='changed'))
+    assert first.get_entry(entries[0]['id'])['title'] == 'changed'
+    assert first.get_entry(entries[1]['id']) is not None
+    assert first.version() == second.version()
+
+    first.add(entries[2])
+    assert [summary['id'] for summary in second.list_summaries()] == sorted_ids(entries[:3])
+    assert [entry['id'] for entry in first.list_entries()] == sorted_ids(entries[:3])
+
+
+def test_listener_gets_the_signature_before_the_write(storage, entries):
+    calls = []
+    storage.subscribe(lambda storage, changes, old_signature: calls.append((changes, old_signature)))
+
+    signature = storage.signature()
+    storage.add(entries[0])
+    assert calls[-1][0][0][:2] == ('add', entries[0]['id'])
+    assert calls[-1][1] == signature
+
+    signature = storage.signature()
+    storage.delete(entries[0]['id'])
+    assert calls[-1][0] == [('delete', entries[0]['id'], None)]
+    assert calls[-1][1] == signature
+
+
+def test_changes_since(open_storage, entries):
+    first, second = open_storage(), open_storage()
+    first.add(entries[0])
+    version = first.version()
+    assert first.changes_since(version) == (version, set())
+
+    second.add(entries[1])
+    second.write_batch([('update', entries[0]['id'], dict(entries[0], title='changed')),
+                        ('add', entries[2]['id'], entries[2])])
+    second.delete(entries[1]['id'])
+    assert first.changes_since(version) == (version + 3, {entry['id'] for entry in entries[:3]})
+    assert first.changes_since(version + 2) == (version + 3, {entries[1]['id']})
+
+    # Replaced as a whole
+    second.import_entries(entries[3:5], replace=False)
+    assert first.changes_since(version) is None
+    assert first.changes_since(first.version()) == (first.version(), set())
+
+
+def test_changes_since_without_the_changes(storage, entries, monkeypatch):
+    import app.database
+    monkeypatch.setattr(app.database, 'LOG_COMPACTION_THRESHOLD', 500)
+    for entry in entries:
+        storage.add(entry)
+    # The older half was dropped
+    assert storage.changes_since(0) is None
+    assert storage.changes_since(storage.version() - 1) == (storage.version(), {entries[-1]['id']})
+
+    # A write that isn't in the log, e.g. of an older release
+    version = storage.version()
+    monkeypatch.setattr(storage, '_log_changes', lambda version, entry_ids=None: None)
+    storage.delete(entries[0]['id'])
+    assert storage.changes_since(version) is None
+    monkeypatch.undo()
+    storage.delete(entries[1]['id'])
+    assert storage.changes_since(version) is None
+    assert storage.changes_since(version + 1) == (version + 2, {entries[1]['id']})
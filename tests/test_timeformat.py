@@ -0,0 +1,62 @@
+# tests/test_timeformat.py
+#
+# The display of datetimes in the timezone of the reader, and its caching.
+# ADMIN_JSON_FILE is copied to `tmp_path` before the admin picks a timezone.
+
+import shutil
+from datetime import datetime, timezone
+import pytest
+import app.authentication, app.timeformat
+from app.timeformat import _format, display_timezone, format_datetime, format_datetimes, format_timestamp
+from config import DISPLAY_TIMEZONE
+from conftest import make_entry
+
+
+@pytest.fixture
+def admin_file(tmp_path, monkeypatch):
+    path = tmp_path / 'admin.json'
+    shutil.copy(app.authentication.ADMIN_JSON_FILE, path)
+    monkeypatch.setattr(app.authentication, 'ADMIN_JSON_FILE', path)
+    monkeypatch.setattr(app.timeformat, 'ADMIN_JSON_FILE', path)
+    return path
+
+
+def test_format_datetime():
+    value = '2024-07-01T12:30:00+00:00'
+    assert format_datetime(value, '%Y-%m-%d %H:%M %Z', 'Europe/Paris') == '2024-07-01 14:30 CEST'
+    assert format_datetime(value, '%H:%M %Z', 'Asia/Kolkata') == '18:00 IST'
+    # Naive datetimes are in UTC
+    assert format_datetime(datetime(2024, 1, 1, 12), '%H:%M %Z', 'Europe/Paris') == '13:00 CET'
+    assert format_timestamp(0, '%Y-%m-%d %H:%M', 'UTC') == '1970-01-01 00:00'
+
+
+def test_formatted_datetimes_are_cached():
+    values = ['2024-07-01T12:30:00+00:00', '2024-07-02T12:30:00+00:00', '2024-07-01T12:30:00+00:00']
+    formatted = format_datetimes(values, '%d %H:%M', 'UTC')
+    assert formatted == ['01 12:30', '02 12:30', '01 12:30']
+    hits = _format.cache_info().hits
+    assert format_datetimes(values, '%d %H:%M', 'UTC') == formatted
+    assert _format.cache_info().hits == hits + 3
+
+
+def test_display_timezone_follows_the_admin_preference(admin_file):
+    assert display_timezone() == DISPLAY_TIMEZONE
+    app.authentication.save_admin_preferences(timezone='Europe/Paris')
+    assert display_timezone() == 'Europe/Paris'
+    assert format_datetime('2024-07-01T12:30:00+00:00', '%H:%M') == '14:30'
+
+    # An unknown timezone saved by hand falls back to the default
+    admin_file.write_text(admin_file.read_text().replace('Europe/Paris', 'Mars/Olympus_Mons'))
+    assert display_timezone() == DISPLAY_TIMEZONE
+
+
+def test_preferences_route(client, admin_file):
+    from app.database import get_storage
+    get_storage().add(make_entry(datetime(2024, 7, 1, 12, 30, tzinfo=timezone.utc), title='summer'))
+
+    response = client.post('/preferences', data={"timezone": 'America/New_York'})
+    assert response.status_code == 302
+    assert 'Jul 01, 2024 08:30:00 AM EDT' in client.get('/view_entries').get_data(as_text=True)
+
+    assert client.post('/preferences', data={"timezone": 'Nowhere'}, follow_redirects=True).status_code == 200
+    assert display_timezone() == 'America/New_York'